@@ -1,21 +1,32 @@
 import os
 import numpy as np
 import SimpleITK as sitk
-import torch
-import nibabel as nib 
-from .io_utils import load_dicom_volume, copy_dicom_files, setup_input_ts_folder, check_target_series_in_folder
-from .image_processing import reorient_and_rotate_images
-from .totalsegmentator_integration import run_totalsegmentator
+from . import config
+from .io_utils import load_dicom_volume
+from .dicom_index import get_series_index
+from .image_processing import reorient_and_rotate_images, fuse_label_maps
+from .totalsegmentator_integration import segment_series
 
 class CTProcessingPipeline:
-    def __init__(self, source_path, target_study, target_number, new_spacing=[1,1,1], temp_file="temp_dict.pkl"):
+    def __init__(self, source_path, target_study, target_number, new_spacing=[1,1,1], temp_file="temp_dict.pkl", segmentation_options=None, vertebrae=None):
         """Handles loading, segmentation, and reorientation of CT volumes"""
         self.source_path=source_path
         self.target_study=target_study
         self.target_number=target_number
         self.new_spacing=new_spacing
         self.temp_file=temp_file
-        self.device=torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+        self.segmentation_options=segmentation_options
+        self.segmentation_dir=None
+        self.vertebrae=config.VERTEBRAE if vertebrae is None else vertebrae
+        self._device=None
+
+    @property
+    def device(self):
+        """Torch device used for segmentation, resolved on first use so that torch is only imported when needed"""
+        if self._device is None:
+            import torch
+            self._device=torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+        return self._device
 
     def load_and_resample_volume(self):
         """Loads and converts a DICOM volume to a NumPy array"""
@@ -23,35 +34,30 @@ class CTProcessingPipeline:
         np_volume=sitk.GetArrayFromImage(volume)
         return np_volume
 
-    def prepare_and_segment(self):
-        """Prepares input folders, copies DICOM files, and runs totalsegmentator"""
-        input_ts_path=setup_input_ts_folder()
-        destination_path=os.path.join(os.getcwd(),'input_ts')
-        copy_dicom_files(self.source_path,destination_path,self.target_study,self.target_number)
+    def select_segmentation_series(self):
+        """Selects the CT series to segment, falling back to series 5 and preferring series 4 for iMAR studies"""
+        index=get_series_index(self.source_path)
+        records=index.select(series_number=self.target_number,study_description=self.target_study)
         
-        if not os.listdir(destination_path):
+        if not records:
             self.target_number="5"
-            copy_dicom_files(self.source_path,destination_path,self.target_study,self.target_number)
+            records=index.select(series_number=self.target_number,study_description=self.target_study)
 
-        if check_target_series_in_folder(self.source_path,"iMAR"):
-            input_ts_path=setup_input_ts_folder()
+        if index.select(series_description="iMAR"):
             self.target_number="4"
-            copy_dicom_files(self.source_path,destination_path,self.target_study,self.target_number)
+            records=index.select(series_number=self.target_number,study_description=self.target_study)
+        return records
 
-        run_totalsegmentator(input_ts_path,"segmentations_totalsegmentator_")
+    def prepare_and_segment(self):
+        """Selects the CT series and runs totalsegmentator, reusing cached outputs for unchanged inputs"""
+        records=self.select_segmentation_series()
+        roi_subset=[f"vertebrae_{vert}" for vert in self.vertebrae] if config.SEGMENTATION_ROI_SUBSET else None
+        self.segmentation_dir=segment_series(records,options=self.segmentation_options,roi_subset=roi_subset)
 
     def combine_and_reorient_segmentations(self):
         """Combines vertebrae segmentations into a single mask and reorients the images"""
-        vertebrae_lumbar=["T12","L1","L2","L3","L4","L5","S1"]
-        combined_mask=None
-
-        for idx,vert in enumerate(vertebrae_lumbar,start=1):
-            path_image=os.path.join(os.getcwd(),f'segmentations_totalsegmentator_/vertebrae_{vert}.nii.gz')
-            nifti_img=nib.load(path_image)
-            mask_data=nifti_img.get_fdata()
-            if combined_mask is None:
-                combined_mask=np.zeros_like(mask_data)
-            combined_mask[mask_data>0]=idx
+        paths=[os.path.join(self.segmentation_dir,f'vertebrae_{vert}.nii.gz') for vert in self.vertebrae]
+        combined_mask=fuse_label_maps(paths)
 
         loaded_volume=self.load_and_resample_volume()
         rotated_array,rotated_mask=reorient_and_rotate_images(loaded_volume,combined_mask)
@@ -2,7 +2,7 @@ import os
 import numpy as np
 import SimpleITK as sitk
 from .io_utils import check_target_series_in_folder, filter_dicom_pet, filter_dicom_ct, load_dicom_series_from_pydicom, save_dictionary_to_file, load_dictionary_from_file
-from .image_processing import resample_image, crop_and_resize_pet
+from .image_processing import resample_image, crop_and_resize_pet, resample_image_region, pet_source_rows, crop_and_resize_pet_region, first_nonzero_row
 from .utils import dicom_to_numpy, find_first_nonzero_slice
 
 
@@ -33,18 +33,43 @@ class PetProcessor:
         self.pet_image=load_dicom_series_from_pydicom(self.pet_image_dicom)
         self.ct_image=load_dicom_series_from_pydicom(self.ct_image_dicom)
 
-    def resample_and_process(self):
-        "Resamples and processes PET and CT images"
-        
+    def resample_and_process(self,roi=None):
+        """Resamples and processes PET and CT images
+
+        With roi, a tuple of slices of the final PET volume (the frame of the transformed vertebra masks), only
+        that region is computed and returned, equal to the same crop of the full result
+        """
+        if roi is not None:
+            return self.resample_and_process_roi(roi)
         self.resampled_pet=resample_image(self.pet_image,self.ct_image)
-        resampled_pet_np=sitk.GetArrayFromImage(self.resampled_pet)
-        resampled_pet_np=resampled_pet_np[::-1]
+        resampled_pet_np=sitk.GetArrayViewFromImage(self.resampled_pet)[::-1]
         threshold=find_first_nonzero_slice(resampled_pet_np)
         self.pet_image_np_final=crop_and_resize_pet(resampled_pet_np,threshold)
         self.ct_image_np=dicom_to_numpy(self.ct_image_dicom)
         
         return self.ct_image_np,self.pet_image_np_final
 
+    def resample_and_process_roi(self,roi):
+        """Resamples the PET only on the rows needed for the threshold and on the sub-grid under the roi
+
+        Both are resampled exactly, so the result is bit-identical to the same crop of resample_and_process()
+        """
+        size_x,size_y,size_z=self.ct_image.GetSize()
+        threshold=first_nonzero_row(self.pet_image,self.ct_image)
+        
+        rows,y_range,x_range=(slice(*region.indices(size)[:2]) for region,size in zip(roi,(size_z,size_y,size_x)))
+        source_start,source_stop=pet_source_rows(threshold,size_z,rows)
+        self.resampled_pet=resample_image_region(
+            self.pet_image,self.ct_image,
+            (x_range.start,y_range.start,size_z-source_stop),
+            (x_range.stop-x_range.start,y_range.stop-y_range.start,source_stop-source_start)
+        )
+        source=sitk.GetArrayViewFromImage(self.resampled_pet)[::-1]
+        self.pet_image_np_final=crop_and_resize_pet_region(source,threshold,size_z,rows,source_start)
+        self.ct_image_np=dicom_to_numpy(self.ct_image_dicom)
+        
+        return self.ct_image_np,self.pet_image_np_final
+
     def process_all(self,directory_index=None,specific_directory=None,save_dict=False,load_dict=False,dict_file="data_dict.pkl"):
         "Processes all PET data and optionally saves or loads the result"
         
@@ -11,6 +11,7 @@ class SUVProcessor:
         self.suv_metadata_dict={}
         self.patients_processed_list=[]
         self.suv_volume_dict={}
+        self.metadata_table=None
 
     @staticmethod
     def parse_time(time_str):
@@ -31,6 +32,11 @@ class SUVProcessor:
         "Calculates the decayed dose using exponential decay"
         return injected_dose_bq*np.exp(-decay_constant*time_diff_seconds)
 
+    @staticmethod
+    def calculate_suv_factor(metadata):
+        "Calculates the factor converting BQML pixel values to body-weight SUV"
+        return metadata['patient_weight_g']/metadata['decayed_dose_bq']
+
     @staticmethod
     def calculate_time_difference(injection_time,acquisition_time):
         "Calculates the time difference in seconds, accounting for day rollover"
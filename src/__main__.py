@@ -0,0 +1,118 @@
+import os
+import sys
+import argparse
+from . import config
+
+STAGES=("segment","register","metadata","suv","stats")
+SEGMENTATION_FILE="ct_masks_dict.pkl"
+REGISTRATION_FILE="pet_ct_dict.pkl"
+METADATA_FILE="metadata_dict.pkl"
+SUV_FILE="suv_dict.pkl"
+STATISTICS_FILE="mean_suv_dict.pkl"
+
+def _checkpoint_stage(checkpoint_file,stage):
+    """Returns the lazy view of a stage in the checkpoint store that the orchestrator keeps next to checkpoint_file"""
+    from .result_store import ResultStore
+    return ResultStore(os.path.splitext(checkpoint_file)[0]).stage(stage)
+
+def _invalidate_suv(logger):
+    """Removes the SUV volumes and masks derived from earlier segmentations or registrations, so that suv recomputes them"""
+    from .result_store import ResultStore, SUV_STAGE, MASK_STAGE
+    store=ResultStore(os.path.splitext(SUV_FILE)[0])
+    if store.patients(SUV_STAGE) or store.patients(MASK_STAGE):
+        logger.info(f"Removing the SUV checkpoints in {store.root}, computed from the previous results")
+    store.clear(SUV_STAGE)
+    store.clear(MASK_STAGE)
+
+def run_segment(args,logger):
+    """First step: CT segmentation of every patient, committed to the segmentation checkpoint store"""
+    from .orchestrator import process_patients_segmentation
+    if args.fresh:
+        _invalidate_suv(logger)
+    process_patients_segmentation(
+        args.data_folder,logger,limit=args.limit,save_temp=True,load_temp=not args.fresh,
+        temp_file=SEGMENTATION_FILE,n_workers=args.workers
+    )
+
+def run_register(args,logger):
+    """Second step: PET registration, only resampling under the vertebra crop with --roi"""
+    from .orchestrator import process_patients_registration
+    from .result_store import SEGMENTATION_STAGE
+    if args.fresh:
+        _invalidate_suv(logger)
+    process_patients_registration(
+        args.data_folder,logger,config.TARGET_DESCRIPTION_PET,config.TARGET_DESCRIPTION_NUMBER_CT,config.TARGET_STUDY,
+        limit=args.limit,save_dict=True,load_dict=not args.fresh,dict_file=REGISTRATION_FILE,n_workers=args.workers,
+        roi_masks=_checkpoint_stage(SEGMENTATION_FILE,SEGMENTATION_STAGE) if args.roi else None
+    )
+
+def run_metadata(args,logger):
+    """SUV metadata of the patients not in config.EXCLUDE_PATIENTS_SUV, read from the PET headers only"""
+    from .orchestrator import process_metadata
+    process_metadata(args.data_folder,config.EXCLUDE_PATIENTS_SUV,None,logger,temp_file=METADATA_FILE,load_temp=not args.fresh)
+
+def run_suv(args,logger):
+    """Third step: crops and masks the registered PET, scales it to SUV and keeps the cropped masks for the statistics
+
+    Only the patients of the current registrations are kept; their masks are written before the stale ones are removed
+    """
+    from .orchestrator import orchestrate_pet_processing, calculate_suv
+    from .result_store import ResultStore, SEGMENTATION_STAGE, REGISTRATION_STAGE, MASK_STAGE
+    masked_pet_images_dict,masked_images_dict=orchestrate_pet_processing(
+        _checkpoint_stage(SEGMENTATION_FILE,SEGMENTATION_STAGE),_checkpoint_stage(REGISTRATION_FILE,REGISTRATION_STAGE),
+        padding=config.PADDING,ct_masks_flipped=config.CT_MASKS_FLIPPED
+    )
+    suv_volume_dict=calculate_suv(args.data_folder,masked_pet_images_dict,logger,temp_file=SUV_FILE,load_temp=not args.fresh)
+    masked_images_dict={patient_id:masked_images_dict[patient_id] for patient_id in masked_images_dict.keys()&suv_volume_dict.keys()}
+    store=ResultStore(os.path.splitext(SUV_FILE)[0])
+    store.put_all(MASK_STAGE,masked_images_dict)
+    for patient_id in store.patients(MASK_STAGE):
+        if patient_id not in masked_images_dict:
+            store.remove(MASK_STAGE,patient_id)
+
+def run_stats(args,logger):
+    """Mean SUV by vertebra and by vertebral level from the committed SUV volumes and masks"""
+    from .io_utils import save_dictionary_to_file
+    from .result_store import SUV_STAGE, MASK_STAGE
+    from .suv_analysis import compute_mean_suv_across_patients
+    mean_suv_by_vertebra_by_patient,mean_suv_by_vertebral_level_across_patients=compute_mean_suv_across_patients(
+        _checkpoint_stage(SUV_FILE,SUV_STAGE),_checkpoint_stage(SUV_FILE,MASK_STAGE)
+    )
+    for label,values in mean_suv_by_vertebral_level_across_patients.items():
+        logger.info(f"Mean SUV of {label}: {sum(values)/len(values):.3f} over {len(values)} patients")
+    save_dictionary_to_file({
+        'mean_suv_by_vertebra_by_patient':mean_suv_by_vertebra_by_patient,
+        'mean_suv_by_vertebral_level_across_patients':mean_suv_by_vertebral_level_across_patients
+    },STATISTICS_FILE)
+    logger.info(f"Saved SUV statistics to {STATISTICS_FILE}")
+
+STAGE_RUNNERS={"segment":run_segment,"register":run_register,"metadata":run_metadata,"suv":run_suv,"stats":run_stats}
+
+def main(argv=None):
+    """Runs the selected pipeline stages, in pipeline order, with the options of config.py
+
+    Each stage resumes from the checkpoints of the previous ones in the working directory, so stages can run
+    as separate jobs; the modules of a stage, and their imaging libraries, are only imported when it runs
+    """
+    parser=argparse.ArgumentParser(prog="python -m src",description="Run stages of the PET/CT vertebra SUV pipeline")
+    parser.add_argument("stages",nargs="*",metavar="stage",help=f"stages to run, among {', '.join(STAGES)} (default: all)")
+    parser.add_argument("--data-folder",default=config.DATA_FOLDER)
+    parser.add_argument("--limit",type=int,default=None)
+    parser.add_argument("--workers",type=int,default=None)
+    parser.add_argument("--roi",action="store_true",help="register the PET only under the padded vertebra crop")
+    parser.add_argument("--fresh",action="store_true",help="recompute instead of resuming from existing checkpoints")
+    args=parser.parse_args(argv)
+    unknown=[stage_name for stage_name in args.stages if stage_name not in STAGES]
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(unknown)}")
+
+    from .logging_setup import configure_logging
+    logger=configure_logging()
+    for stage_name in STAGES:
+        if stage_name in (args.stages or STAGES):
+            STAGE_RUNNERS[stage_name](args,logger)
+            logger.info(f"Stage {stage_name} complete")
+    return 0
+
+if __name__=="__main__":
+    sys.exit(main())
@@ -0,0 +1,172 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import tempfile
+import statistics
+import tracemalloc
+from datetime import datetime
+import numpy as np
+import SimpleITK as sitk
+from . import config
+from .synthetic_data import generate_cohort
+from .dicom_index import get_series_index
+from .io_utils import filter_dicom_ct, filter_dicom_pet, load_dicom_volume, load_dicom_series_from_pydicom
+from .image_processing import fuse_label_maps, reorient_and_rotate_images, resample_image, crop_and_resize_pet
+from .pet_mask_processing import transform_data_dict, get_masks_and_pet_dict, crop_all_images_and_masks, multiply_pet_data_and_masks
+from .orchestrator import calculate_suv
+from .suv_analysis import compute_mean_suv_across_patients
+from .utils import find_first_nonzero_slice
+
+def measure(stage, function, repeats=3, setup=None, voxels=None):
+    """Times a stage over several repeats, then measures its peak traced memory in one extra run"""
+    walls=[]
+    cpus=[]
+    for _ in range(repeats):
+        args=setup() if setup else ()
+        wall_start,cpu_start=time.perf_counter(),time.process_time()
+        function(*args)
+        walls.append(time.perf_counter()-wall_start)
+        cpus.append(time.process_time()-cpu_start)
+    args=setup() if setup else ()
+    tracemalloc.start()
+    try:
+        function(*args)
+        peak_bytes=tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {
+        'stage':stage,
+        'repeats':repeats,
+        'wall_s_min':min(walls),
+        'wall_s_median':statistics.median(walls),
+        'cpu_s_median':statistics.median(cpus),
+        'peak_traced_bytes':peak_bytes,
+        'voxels':voxels
+    }
+
+def run_benchmarks(workdir, n_patients=2, ct_shape=(64,128,128), ct_spacing=(1.0,1.0,1.0), pet_spacing=(4.0,4.0,4.0), repeats=3):
+    """Generates a synthetic cohort in workdir and benchmarks every pipeline stage on it"""
+    logger=logging.getLogger("benchmark")
+    logger.addHandler(logging.NullHandler())
+    logger.propagate=False
+    data_folder=os.path.join(workdir,"Data")
+    segmentation_folder=os.path.join(workdir,"segmentations")
+    cohort=generate_cohort(data_folder,n_patients,ct_shape,ct_spacing,pet_spacing,segmentation_folder=segmentation_folder)
+    patient_id=next(iter(cohort))
+    patient_folder=cohort[patient_id]['patient_folder']
+    mask_paths=[os.path.join(cohort[patient_id]['segmentation_folder'],f"vertebrae_{vert}.nii.gz") for vert in config.VERTEBRAE]
+    ct_voxels=int(np.prod(ct_shape))
+    results=[]
+
+    cold_dirs=iter(range(repeats+1))
+    results.append(measure(
+        "dicom_index_cold",lambda: get_series_index(patient_folder,cache_dir=os.path.join(workdir,"index",str(next(cold_dirs)))),repeats
+    ))
+    get_series_index(patient_folder)
+    results.append(measure("dicom_index_warm",lambda: get_series_index(patient_folder),repeats))
+    results.append(measure("filter_dicom_ct",lambda: filter_dicom_ct(patient_folder,config.TARGET_DESCRIPTION_NUMBER_CT),repeats,voxels=ct_voxels))
+    results.append(measure("filter_dicom_pet",lambda: filter_dicom_pet(patient_folder,config.TARGET_DESCRIPTION_PET),repeats))
+    results.append(measure("load_dicom_volume",lambda: load_dicom_volume(patient_folder,config.TARGET_STUDY,config.TARGET_NUMBER),repeats,voxels=ct_voxels))
+    results.append(measure(
+        "load_dicom_series_from_pydicom",load_dicom_series_from_pydicom,repeats,
+        setup=lambda: (filter_dicom_ct(patient_folder,config.TARGET_DESCRIPTION_NUMBER_CT),),voxels=ct_voxels
+    ))
+    results.append(measure("fuse_label_maps",lambda: fuse_label_maps(mask_paths),repeats,voxels=ct_voxels))
+
+    ct_array=sitk.GetArrayFromImage(load_dicom_volume(patient_folder,config.TARGET_STUDY,config.TARGET_NUMBER))
+    combined_mask=fuse_label_maps(mask_paths)
+    results.append(measure("reorient_and_rotate_images",lambda: reorient_and_rotate_images(ct_array,combined_mask),repeats,voxels=ct_voxels))
+
+    ct_image=load_dicom_series_from_pydicom(filter_dicom_ct(patient_folder,config.TARGET_DESCRIPTION_NUMBER_CT))
+    pet_image=load_dicom_series_from_pydicom(filter_dicom_pet(patient_folder,config.TARGET_DESCRIPTION_PET))
+    results.append(measure("resample_image",lambda: resample_image(pet_image,ct_image),repeats,voxels=ct_voxels))
+
+    resampled_pet=sitk.GetArrayFromImage(resample_image(pet_image,ct_image))[::-1]
+    threshold=find_first_nonzero_slice(resampled_pet)
+    results.append(measure("crop_and_resize_pet",lambda: crop_and_resize_pet(resampled_pet,threshold),repeats,voxels=ct_voxels))
+
+    ct_dict={}
+    pet_dict={}
+    for current_id,paths in cohort.items():
+        folder=paths['patient_folder']
+        current_mask=fuse_label_maps([os.path.join(paths['segmentation_folder'],f"vertebrae_{vert}.nii.gz") for vert in config.VERTEBRAE])
+        current_ct=sitk.GetArrayFromImage(load_dicom_volume(folder,config.TARGET_STUDY,config.TARGET_NUMBER))
+        ct_dict[current_id]=list(reorient_and_rotate_images(current_ct,current_mask))
+        current_ct_image=load_dicom_series_from_pydicom(filter_dicom_ct(folder,config.TARGET_DESCRIPTION_NUMBER_CT))
+        current_pet_image=load_dicom_series_from_pydicom(filter_dicom_pet(folder,config.TARGET_DESCRIPTION_PET))
+        current_pet=sitk.GetArrayFromImage(resample_image(current_pet_image,current_ct_image))[::-1]
+        pet_dict[current_id]=[None,crop_and_resize_pet(current_pet,find_first_nonzero_slice(current_pet))]
+    masks_and_pet_dict=get_masks_and_pet_dict(transform_data_dict(ct_dict,ct_masks_flipped=config.CT_MASKS_FLIPPED),pet_dict)
+    cropped_data=crop_all_images_and_masks(masks_and_pet_dict,padding=config.PADDING)
+    results.append(measure("multiply_pet_data_and_masks",lambda: multiply_pet_data_and_masks(cropped_data),repeats))
+
+    masked_pet_images,masked_images=multiply_pet_data_and_masks(cropped_data)
+    suv_file=os.path.join(workdir,"suv_dict.pkl")
+    results.append(measure(
+        "calculate_suv",lambda: calculate_suv(data_folder,masked_pet_images_dict=masked_pet_images,logger=logger,temp_file=suv_file),repeats
+    ))
+    suv_volume_dict=calculate_suv(data_folder,masked_pet_images_dict=masked_pet_images,logger=logger,temp_file=suv_file)
+    results.append(measure(
+        "compute_mean_suv_across_patients",lambda: compute_mean_suv_across_patients(suv_volume_dict,masked_images),repeats
+    ))
+    return results
+
+def compare_with_baseline(results, baseline, tolerance=0.2):
+    """Returns the stages whose median wall time exceeds the baseline by more than the tolerance"""
+    baseline_by_stage={entry['stage']:entry for entry in baseline['results']}
+    regressions=[]
+    for entry in results:
+        reference=baseline_by_stage.get(entry['stage'])
+        if reference and reference['wall_s_median']>0:
+            ratio=entry['wall_s_median']/reference['wall_s_median']
+            if ratio>1+tolerance:
+                regressions.append({'stage':entry['stage'],'ratio':ratio})
+    return regressions
+
+def main(argv=None):
+    """Runs the stage benchmarks on a synthetic cohort and writes the results as JSON"""
+    parser=argparse.ArgumentParser(description="Benchmark the PET/CT pipeline stages on synthetic data")
+    parser.add_argument("--patients",type=int,default=2)
+    parser.add_argument("--ct-shape",type=int,nargs=3,default=[64,128,128],metavar=("Z","Y","X"))
+    parser.add_argument("--pet-spacing",type=float,nargs=3,default=[4.0,4.0,4.0],metavar=("Z","Y","X"))
+    parser.add_argument("--repeats",type=int,default=3)
+    parser.add_argument("--output",default="benchmark_results.json")
+    parser.add_argument("--baseline",default=None,help="previous results file to check for regressions")
+    parser.add_argument("--tolerance",type=float,default=0.2)
+    args=parser.parse_args(argv)
+
+    previous_cwd=os.getcwd()
+    output_path=os.path.abspath(args.output)
+    with tempfile.TemporaryDirectory(prefix="petct_benchmark_") as workdir:
+        os.chdir(workdir)
+        try:
+            results=run_benchmarks(workdir,args.patients,tuple(args.ct_shape),pet_spacing=tuple(args.pet_spacing),repeats=args.repeats)
+        finally:
+            os.chdir(previous_cwd)
+    report={
+        'created':datetime.now().isoformat(),
+        'python':platform.python_version(),
+        'numpy':np.__version__,
+        'machine':platform.machine(),
+        'cpu_count':os.cpu_count(),
+        'parameters':{'patients':args.patients,'ct_shape':args.ct_shape,'pet_spacing':args.pet_spacing,'repeats':args.repeats},
+        'results':results
+    }
+    with open(output_path,'w') as file:
+        json.dump(report,file,indent=2)
+    for entry in results:
+        print(f"{entry['stage']:<36}{entry['wall_s_median']*1000:>10.1f} ms{entry['peak_traced_bytes']/2**20:>10.1f} MiB")
+    if args.baseline:
+        with open(args.baseline,'r') as file:
+            regressions=compare_with_baseline(results,json.load(file),args.tolerance)
+        for regression in regressions:
+            print(f"Regression in {regression['stage']}: {regression['ratio']:.2f}x baseline")
+        return 1 if regressions else 0
+    return 0
+
+if __name__=="__main__":
+    sys.exit(main())
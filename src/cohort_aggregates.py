@@ -0,0 +1,355 @@
+import os
+import json
+import math
+import numpy as np
+import pandas as pd
+from . import config
+from .demographics import normalize_patient_id, index_patient_info
+
+AGGREGATES_VERSION=1
+ALL_STRATUM="all"
+
+class RunningStatistics:
+    def __init__(self,count=0,mean=0.0,m2=0.0,minimum=math.inf,maximum=-math.inf):
+        """Count, mean, sum of squared deviations, min and max, updated in constant memory (Welford) and mergeable (Chan et al.)"""
+        self.count=int(count)
+        self.mean=float(mean)
+        self.m2=float(m2)
+        self.minimum=float(minimum)
+        self.maximum=float(maximum)
+
+    @classmethod
+    def from_summary(cls,count,mean,std,minimum,maximum):
+        """Builds the statistics of a group from its count, mean, population standard deviation, min and max"""
+        return cls(count,mean,std*std*count,minimum,maximum)
+
+    def update(self,value):
+        """Adds one value"""
+        value=float(value)
+        self.count+=1
+        delta=value-self.mean
+        self.mean+=delta/self.count
+        self.m2+=delta*(value-self.mean)
+        self.minimum=min(self.minimum,value)
+        self.maximum=max(self.maximum,value)
+        return self
+
+    def merge(self,other):
+        """Adds the values summarized by other statistics"""
+        if other.count==0:
+            return self
+        count=self.count+other.count
+        delta=other.mean-self.mean
+        self.mean+=delta*other.count/count
+        self.m2+=other.m2+delta*delta*self.count*other.count/count
+        self.count=count
+        self.minimum=min(self.minimum,other.minimum)
+        self.maximum=max(self.maximum,other.maximum)
+        return self
+
+    @property
+    def variance(self):
+        """Population variance, as np.var"""
+        return self.m2/self.count if self.count else math.nan
+
+    @property
+    def std(self):
+        """Population standard deviation, as np.std"""
+        return math.sqrt(self.variance) if self.count else math.nan
+
+    def to_dict(self):
+        """Returns a JSON-serializable description"""
+        return {
+            'count':self.count,'mean':self.mean,'m2':self.m2,
+            'min':self.minimum if self.count else None,'max':self.maximum if self.count else None
+        }
+
+    @classmethod
+    def from_dict(cls,description):
+        """Rebuilds the statistics from their description"""
+        if not description['count']:
+            return cls()
+        return cls(description['count'],description['mean'],description['m2'],description['min'],description['max'])
+
+class QuantileSketch:
+    def __init__(self,relative_accuracy=None,max_buckets=2048):
+        """Mergeable quantile sketch with logarithmic buckets (DDSketch): quantiles are within relative_accuracy of a true value
+
+        When a sign has more than max_buckets buckets the lowest ones are collapsed, which only affects the
+        accuracy of the smallest magnitudes
+        """
+        self.relative_accuracy=config.AGGREGATE_RELATIVE_ACCURACY if relative_accuracy is None else relative_accuracy
+        self.max_buckets=max_buckets
+        self.gamma=(1+self.relative_accuracy)/(1-self.relative_accuracy)
+        self._log_gamma=math.log(self.gamma)
+        self.positive={}
+        self.negative={}
+        self.zeros=0
+        self.count=0
+
+    def _keys(self,magnitudes):
+        """Returns the bucket keys of positive magnitudes"""
+        return np.ceil(np.log(magnitudes)/self._log_gamma).astype(np.int64)
+
+    def _bucket_value(self,key):
+        """Returns the representative magnitude of a bucket"""
+        return 2*self.gamma**key/(self.gamma+1)
+
+    def _collapse(self,buckets):
+        """Merges the lowest buckets until at most max_buckets remain"""
+        if len(buckets)<=self.max_buckets:
+            return
+        keys=sorted(buckets)
+        excess=keys[:len(keys)-self.max_buckets+1]
+        buckets[excess[-1]]=sum(buckets.pop(key) for key in excess[:-1])+buckets[excess[-1]]
+
+    def add_many(self,values):
+        """Adds an array of values, ignoring NaN"""
+        values=np.asarray(values,dtype=np.float64).ravel()
+        values=values[~np.isnan(values)]
+        self.count+=values.size
+        self.zeros+=int(np.count_nonzero(values==0))
+        for buckets,magnitudes in ((self.positive,values[values>0]),(self.negative,-values[values<0])):
+            if not magnitudes.size:
+                continue
+            keys,counts=np.unique(self._keys(magnitudes),return_counts=True)
+            for key,count in zip(keys.tolist(),counts.tolist()):
+                buckets[key]=buckets.get(key,0)+count
+            self._collapse(buckets)
+        return self
+
+    def add(self,value):
+        """Adds one value"""
+        return self.add_many([value])
+
+    def merge(self,other):
+        """Adds the values of another sketch with the same relative accuracy"""
+        if not math.isclose(self.relative_accuracy,other.relative_accuracy):
+            raise ValueError("Only sketches with the same relative accuracy can be merged")
+        for buckets,other_buckets in ((self.positive,other.positive),(self.negative,other.negative)):
+            for key,count in other_buckets.items():
+                buckets[key]=buckets.get(key,0)+count
+            self._collapse(buckets)
+        self.zeros+=other.zeros
+        self.count+=other.count
+        return self
+
+    def quantile(self,q):
+        """Returns the approximate q-th percentile (0 to 100), or NaN when empty"""
+        if not self.count:
+            return math.nan
+        rank=q/100*(self.count-1)
+        seen=0
+        for key in sorted(self.negative,reverse=True):
+            seen+=self.negative[key]
+            if seen>rank:
+                return -self._bucket_value(key)
+        seen+=self.zeros
+        if seen>rank:
+            return 0.0
+        for key in sorted(self.positive):
+            seen+=self.positive[key]
+            if seen>rank:
+                return self._bucket_value(key)
+        return self._bucket_value(max(self.positive)) if self.positive else 0.0
+
+    def to_dict(self):
+        """Returns a JSON-serializable description"""
+        return {
+            'relative_accuracy':self.relative_accuracy,'max_buckets':self.max_buckets,'zeros':self.zeros,'count':self.count,
+            'positive':{str(key):count for key,count in self.positive.items()},
+            'negative':{str(key):count for key,count in self.negative.items()}
+        }
+
+    @classmethod
+    def from_dict(cls,description):
+        """Rebuilds a sketch from its description"""
+        sketch=cls(description['relative_accuracy'],description['max_buckets'])
+        sketch.positive={int(key):count for key,count in description['positive'].items()}
+        sketch.negative={int(key):count for key,count in description['negative'].items()}
+        sketch.zeros=description['zeros']
+        sketch.count=description['count']
+        return sketch
+
+class LevelAggregate:
+    def __init__(self,relative_accuracy=None):
+        """Cohort aggregate of one vertebral level: distribution of the per-patient values and pooled voxel statistics"""
+        self.patient_values=RunningStatistics()
+        self.sketch=QuantileSketch(relative_accuracy)
+        self.voxels=RunningStatistics()
+
+    def add(self,statistics,value_key='mean'):
+        """Adds one patient's statistics record of this level (see suv_analysis.compute_suv_statistics_for_patient)"""
+        value=statistics[value_key]
+        if value is None or not np.isfinite(value):
+            return self
+        self.patient_values.update(value)
+        self.sketch.add(value)
+        if statistics.get('count'):
+            self.voxels.merge(RunningStatistics.from_summary(
+                statistics['count'],statistics['mean'],statistics['std'],statistics['min'],statistics['max']
+            ))
+        return self
+
+    def merge(self,other):
+        """Adds another aggregate of the same level"""
+        self.patient_values.merge(other.patient_values)
+        self.sketch.merge(other.sketch)
+        self.voxels.merge(other.voxels)
+        return self
+
+    def summary(self,percentiles=None):
+        """Returns the patient count, mean, std, min, max and approximate percentiles of the per-patient values"""
+        percentiles=config.SUV_PERCENTILES if percentiles is None else percentiles
+        values=self.patient_values
+        return {
+            'patients':values.count,'mean':values.mean if values.count else math.nan,'std':values.std,
+            'min':values.minimum if values.count else math.nan,'max':values.maximum if values.count else math.nan,
+            'median':self.sketch.quantile(50),'percentiles':{q:self.sketch.quantile(q) for q in percentiles},
+            'voxels':self.voxels.count,'voxel_mean':self.voxels.mean if self.voxels.count else math.nan,
+            'voxel_std':self.voxels.std
+        }
+
+    def boxplot_stats(self,label=None):
+        """Returns the box of the per-patient values for matplotlib's bxp, with whiskers at 1.5 IQR clipped to min/max"""
+        q1,median,q3=(self.sketch.quantile(q) for q in (25,50,75))
+        iqr=q3-q1
+        return {
+            'label':label,'med':median,'q1':q1,'q3':q3,'mean':self.patient_values.mean,'fliers':[],
+            'whislo':max(self.patient_values.minimum,q1-1.5*iqr),'whishi':min(self.patient_values.maximum,q3+1.5*iqr)
+        }
+
+    def to_dict(self):
+        """Returns a JSON-serializable description"""
+        return {'patient_values':self.patient_values.to_dict(),'sketch':self.sketch.to_dict(),'voxels':self.voxels.to_dict()}
+
+    @classmethod
+    def from_dict(cls,description):
+        """Rebuilds the aggregate from its description"""
+        aggregate=cls()
+        aggregate.patient_values=RunningStatistics.from_dict(description['patient_values'])
+        aggregate.sketch=QuantileSketch.from_dict(description['sketch'])
+        aggregate.voxels=RunningStatistics.from_dict(description['voxels'])
+        return aggregate
+
+def _bin_label(value,edges):
+    """Returns the [low,high) bin of a value, 'unknown' when missing or outside the edges"""
+    if value is None or pd.isna(value):
+        return "unknown"
+    index=int(np.searchsorted(edges,value,side='right'))-1
+    if index<0 or index>=len(edges)-1:
+        return "unknown"
+    return f"[{edges[index]:g},{edges[index+1]:g})"
+
+def stratum_key(demographics,strata):
+    """Returns the stratum of a patient's demographics row (Age and Bmi binned by config.STRATA_BINS), e.g. 'Sex=F|Age=[50,65)'"""
+    parts=[]
+    for column in strata:
+        value=None if demographics is None else demographics.get(column)
+        if column in config.STRATA_BINS:
+            parts.append(f"{column}={_bin_label(value,config.STRATA_BINS[column])}")
+        else:
+            parts.append(f"{column}={'unknown' if value is None or pd.isna(value) else value}")
+    return "|".join(parts)
+
+class CohortAggregates:
+    def __init__(self,strata=None,relative_accuracy=None,value_key='mean'):
+        """Per-level cohort aggregates, overall and by stratum of the given demographic columns (e.g. ['Sex','Age'])
+
+        Memory depends on the number of levels and strata, not on the number of patients. Aggregates built in
+        different processes or runs over disjoint patients can be merged.
+        """
+        self.strata=list(strata or [])
+        self.relative_accuracy=config.AGGREGATE_RELATIVE_ACCURACY if relative_accuracy is None else relative_accuracy
+        self.value_key=value_key
+        self.patients=0
+        self.levels={}
+
+    def add(self,statistics_by_vertebra,demographics=None):
+        """Adds one patient's per-vertebra statistics, in the overall aggregate and in the patient's stratum"""
+        keys=[ALL_STRATUM]+([stratum_key(demographics,self.strata)] if self.strata else [])
+        for key in keys:
+            levels=self.levels.setdefault(key,{})
+            for label,statistics in statistics_by_vertebra.items():
+                levels.setdefault(int(label),LevelAggregate(self.relative_accuracy)).add(statistics,self.value_key)
+        self.patients+=1
+        return self
+
+    def merge(self,other):
+        """Adds the aggregates of other patients computed elsewhere"""
+        if other.strata!=self.strata or other.value_key!=self.value_key:
+            raise ValueError("Only aggregates with the same strata and value can be merged")
+        for key,levels in other.levels.items():
+            own=self.levels.setdefault(key,{})
+            for label,aggregate in levels.items():
+                own.setdefault(label,LevelAggregate(self.relative_accuracy)).merge(aggregate)
+        self.patients+=other.patients
+        return self
+
+    def stratum_keys(self):
+        """Returns the strata with at least one patient, overall first"""
+        return [ALL_STRATUM]+sorted(key for key in self.levels if key!=ALL_STRATUM)
+
+    def summary(self,stratum=ALL_STRATUM,percentiles=None):
+        """Returns the summary of every level of a stratum"""
+        return {label:aggregate.summary(percentiles) for label,aggregate in sorted(self.levels.get(stratum,{}).items())}
+
+    def to_frame(self,percentiles=None):
+        """Returns the summaries of all strata and levels as a dataframe indexed by stratum and level"""
+        rows=[]
+        for key in self.stratum_keys():
+            for label,summary in self.summary(key,percentiles).items():
+                row={'stratum':key,'level':label,**{name:value for name,value in summary.items() if name!='percentiles'}}
+                row.update({f"p{q}":value for q,value in summary['percentiles'].items()})
+                rows.append(row)
+        return pd.DataFrame(rows).set_index(['stratum','level']) if rows else pd.DataFrame()
+
+    def to_dict(self):
+        """Returns a JSON-serializable description"""
+        return {
+            'version':AGGREGATES_VERSION,'strata':self.strata,'relative_accuracy':self.relative_accuracy,
+            'value_key':self.value_key,'patients':self.patients,
+            'levels':{key:{str(label):aggregate.to_dict() for label,aggregate in levels.items()} for key,levels in self.levels.items()}
+        }
+
+    @classmethod
+    def from_dict(cls,description):
+        """Rebuilds the aggregates from their description"""
+        if description.get('version')!=AGGREGATES_VERSION:
+            raise ValueError(f"Unsupported aggregates version: {description.get('version')}")
+        aggregates=cls(description['strata'],description['relative_accuracy'],description['value_key'])
+        aggregates.patients=description['patients']
+        aggregates.levels={
+            key:{int(label):LevelAggregate.from_dict(aggregate) for label,aggregate in levels.items()}
+            for key,levels in description['levels'].items()
+        }
+        return aggregates
+
+    def save(self,path):
+        """Atomically writes the aggregates as JSON"""
+        temp_path=f"{path}.{os.getpid()}.tmp"
+        with open(temp_path,'w') as file:
+            json.dump(self.to_dict(),file)
+        os.replace(temp_path,path)
+
+    @classmethod
+    def load(cls,path):
+        """Reads aggregates written by save"""
+        with open(path,'r') as file:
+            return cls.from_dict(json.load(file))
+
+def aggregate_statistics(statistics_by_patient,patient_info_dataframe=None,strata=None,aggregates=None):
+    """Adds per-patient statistics (a dictionary, or an iterable of (patient_id,statistics) pairs) to aggregates
+
+    Demographics for the strata are looked up in the create_patient_info_dataframe table by normalized patient ID
+    """
+    aggregates=CohortAggregates(strata) if aggregates is None else aggregates
+    patient_info=index_patient_info(patient_info_dataframe) if patient_info_dataframe is not None else None
+    items=statistics_by_patient.items() if isinstance(statistics_by_patient,dict) else statistics_by_patient
+    for patient_id,statistics_by_vertebra in items:
+        demographics=None
+        key=normalize_patient_id(patient_id)
+        if patient_info is not None and key in patient_info.index:
+            demographics=patient_info.loc[key].to_dict()
+        aggregates.add(statistics_by_vertebra,demographics)
+    return aggregates
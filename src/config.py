@@ -2,12 +2,46 @@ LOG_LEVEL="INFO"
 LOG_FORMAT="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 LOG_FILENAME="config.log"
 
+#Per-stage metrics (JSON lines, opt-in: set a filename such as "metrics.jsonl"), optional tracemalloc peaks and cProfile dumps (list of stage names, or True for all)
+METRICS_FILENAME=None
+TRACE_MEMORY=False
+PROFILE_STAGES=[]
+PROFILE_DIR="profiles"
+
 DATA_FOLDER="Data"
+CACHE_DIR=".cache"
+DICOM_INDEX_MEMORY_FOLDERS=2
+RESULT_STORE_DIR="results"
+SHARD_ROOT="shards"
+SHARD_LOCK_TIMEOUT=4*3600
+
+#Parallel execution of per-patient stages
+N_WORKERS=1
+MAX_PATIENTS_IN_FLIGHT=None
+DECODE_THREADS=None
+
+#Decoded-series cache, in memory (bytes, 0 disables it) and optionally on disk
+VOLUME_CACHE_BYTES=2**30
+VOLUME_CACHE_DIR=None
+
+#Resource budget shared by the concurrent patients (None uses all cores and a fraction of the physical memory)
+CPU_CORES=None
+MEMORY_BUDGET_BYTES=None
+MEMORY_BUDGET_FRACTION=0.8
+MEMORY_BYTES_PER_CT_VOXEL=40
+MEMORY_BYTES_PER_PET_VOXEL=8
 
 #First step - segmentation
 TARGET_STUDY="PET-CT"
 TARGET_NUMBER="3"
 NEW_SPACING=[1,1,1]
+TOTALSEGMENTATOR_OPTIONS={}
+SEGMENTATION_WORK_DIR=None
+SEGMENTATION_BACKEND="command"
+SEGMENTATION_WORKER=False
+SEGMENTATION_WORKER_TIMEOUT=3600
+SEGMENTATION_ROI_SUBSET=False
+VERTEBRAE=["T12","L1","L2","L3","L4","L5","S1"]
 
 #Second step - registration
 TARGET_DESCRIPTION_PET="[WB_CTAC]"
@@ -19,4 +53,12 @@ EXCLUDE_PATIENTS_PET=[2,3]
 PADDING=20
 CT_MASKS_FLIPPED=False
 EXCLUDE_PATIENTS_SUV=list(range(2,50))
+#Patients excluded by ID, for runs whose listing order differs (see sharding)
+EXCLUDE_PATIENT_IDS=[]
+SUV_DTYPE="float32"
+SUV_PERCENTILES=[5,25,75,95]
+
+#Streaming cohort aggregates: quantile sketch accuracy and bins of the numeric strata
+AGGREGATE_RELATIVE_ACCURACY=0.01
+STRATA_BINS={"Age":[0,50,65,120],"Bmi":[0,18.5,25,30,100]}
 METADATA_PATH="0179945-DegenScoliPETCT-2014-2024-v2.xlsx"
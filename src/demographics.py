@@ -1,4 +1,13 @@
+import os
+import json
+import pickle
+import hashlib
+import numpy as np
 import pandas as pd
+from . import config
+
+DEMOGRAPHICS_CACHE_VERSION=1
+DEMOGRAPHICS_COLUMNS=["PrimaryMRN","Height","WeightInGrams","AgeAtEncounter","Sex"]
 
 def parse_height(height_str):
     """Parses a height string into total inches"""
@@ -16,6 +25,27 @@ def parse_height(height_str):
     total_inches=feet*12+inches
     return total_inches*0.0254
 
+def parse_heights(heights):
+    """Vectorized parse_height: parses a column of height strings into meters (NaN for non-strings)
+
+    Strings with more than one foot mark, on which parse_height fails, also give NaN
+    """
+    heights=pd.Series(heights)
+    is_string=heights.map(lambda value:isinstance(value,str),na_action=None).to_numpy(dtype=bool)
+    cleaned=heights.where(is_string).astype('string').str.replace('"','',regex=False).str.replace("''",'',regex=False).str.strip()
+    n_marks=cleaned.str.count("'")
+    parts=cleaned.str.split("'",n=1,expand=True).reindex(columns=[0,1])
+    has_feet=(n_marks==1).fillna(False).to_numpy(dtype=bool)
+    feet_part=parts[0].where(has_feet).str.strip()
+    inches_part=parts[1].where(has_feet,cleaned).str.strip()
+    feet_valid=feet_part.str.isdigit().fillna(False).to_numpy(dtype=bool)
+    inches_valid=inches_part.str.replace('.','',n=1,regex=False).str.isdigit().fillna(False).to_numpy(dtype=bool)
+    feet=np.where(feet_valid,pd.to_numeric(feet_part.where(feet_valid),errors='coerce').to_numpy(dtype=np.float64,na_value=np.nan),0.0)
+    inches=np.where(inches_valid,pd.to_numeric(inches_part.where(inches_valid),errors='coerce').to_numpy(dtype=np.float64,na_value=np.nan),0.0)
+    meters=(feet*12+inches)*0.0254
+    meters[~is_string|(n_marks>1).fillna(False).to_numpy(dtype=bool)]=np.nan
+    return pd.Series(meters,index=heights.index)
+
 def calculate_bmi(weight_g,height_m):
     """Calculates BMI given weight in grams and height in meters"""
     if height_m==0:return None
@@ -28,19 +58,99 @@ def height_weight_to_bmi(height_str,weight_g):
     if height_m is None:return None
     return calculate_bmi(weight_g,height_m)
 
+def heights_weights_to_bmi(heights,weights):
+    """Vectorized height_weight_to_bmi: BMI for columns of height strings and weights in grams (NaN when unknown)"""
+    height_m=parse_heights(heights).to_numpy()
+    weight_kg=pd.to_numeric(pd.Series(weights),errors='coerce').to_numpy(dtype=np.float64,na_value=np.nan)/1000
+    with np.errstate(divide='ignore',invalid='ignore'):
+        return np.where(height_m>0,weight_kg/height_m**2,np.nan)
+
 def pad_numbers_to_max_length(numbers):
     """Pads a list of numbers with leading zeros to match the length of the largest number"""
     max_length=len(str(max(numbers)))
     padded_numbers=[str(number).zfill(max_length) for number in numbers]
     return padded_numbers
 
-def create_patient_info_dataframe(metadata_path):
+def _file_sha256(path):
+    """Hashes a file in chunks"""
+    digest=hashlib.sha256()
+    with open(path,'rb') as file:
+        for chunk in iter(lambda:file.read(1<<20),b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _demographics_cache_paths(metadata_path,cache_dir=None):
+    """Returns the cache file prefix of a metadata spreadsheet"""
+    cache_dir=cache_dir if cache_dir is not None else os.path.join(config.CACHE_DIR,"demographics")
+    key=hashlib.sha1(os.path.abspath(metadata_path).encode()).hexdigest()
+    return os.path.join(cache_dir,key)
+
+def _write_table(table,prefix):
+    """Writes a table as parquet, falling back to a pickle when no parquet engine is installed or it rejects a column type
+
+    The engines report unsupported types as TypeError, ValueError or NotImplementedError subclasses
+    (pyarrow's ArrowTypeError, ArrowInvalid, ArrowNotImplementedError); I/O errors are raised
+    """
+    try:
+        table.to_parquet(prefix+".parquet.tmp")
+        os.replace(prefix+".parquet.tmp",prefix+".parquet")
+        return "parquet"
+    except (ImportError,TypeError,ValueError,NotImplementedError):
+        if os.path.exists(prefix+".parquet.tmp"):
+            os.remove(prefix+".parquet.tmp")
+        with open(prefix+".pkl.tmp",'wb') as file:
+            pickle.dump(table,file)
+        os.replace(prefix+".pkl.tmp",prefix+".pkl")
+        return "pickle"
+
+def _read_table(prefix,file_format):
+    """Reads a table written by _write_table"""
+    if file_format=="parquet":
+        return pd.read_parquet(prefix+".parquet")
+    with open(prefix+".pkl",'rb') as file:
+        return pickle.load(file)
+
+def read_metadata_table(metadata_path,cache_dir=None):
+    """Reads the demographic columns of the metadata spreadsheet, cached on disk by mtime, size and content hash
+
+    The cache is used as is while the file's mtime and size are unchanged; otherwise the content hash decides
+    whether the spreadsheet really changed and has to be parsed again
+    """
+    stat=os.stat(metadata_path)
+    prefix=_demographics_cache_paths(metadata_path,cache_dir)
+    try:
+        with open(prefix+".json",'r') as file:
+            key=json.load(file)
+    except (OSError,ValueError):
+        key={}
+    if key.get('version')==DEMOGRAPHICS_CACHE_VERSION:
+        try:
+            if key['mtime']==stat.st_mtime_ns and key['size']==stat.st_size:
+                return _read_table(prefix,key['format'])
+            sha256=_file_sha256(metadata_path)
+            if key['sha256']==sha256:
+                table=_read_table(prefix,key['format'])
+                key.update({'mtime':stat.st_mtime_ns,'size':stat.st_size})
+                with open(prefix+".json",'w') as file:
+                    json.dump(key,file)
+                return table
+        except (OSError,ValueError,KeyError,pickle.UnpicklingError):
+            pass
+    table=pd.read_excel(metadata_path,usecols=DEMOGRAPHICS_COLUMNS)
+    os.makedirs(os.path.dirname(prefix),exist_ok=True)
+    file_format=_write_table(table,prefix)
+    with open(prefix+".json",'w') as file:
+        json.dump({
+            'version':DEMOGRAPHICS_CACHE_VERSION,'mtime':stat.st_mtime_ns,'size':stat.st_size,
+            'sha256':_file_sha256(metadata_path),'format':file_format
+        },file)
+    return table
+
+def create_patient_info_dataframe(metadata_path,cache_dir=None):
     """Creates a patient info dataframe from an Excel metadata file"""
-    metadata=pd.read_excel(metadata_path)
+    metadata=read_metadata_table(metadata_path,cache_dir=cache_dir)
     patients_ids=pad_numbers_to_max_length(metadata["PrimaryMRN"])
-    heights=metadata["Height"]
-    weights=metadata["WeightInGrams"]
-    bmi_values=[height_weight_to_bmi(h,w) for h,w in zip(heights,weights)]
+    bmi_values=heights_weights_to_bmi(metadata["Height"],metadata["WeightInGrams"])
     patient_info_dataframe=pd.DataFrame({
         'patients_ids':patients_ids,
         'Age':metadata["AgeAtEncounter"],
@@ -48,3 +158,21 @@ def create_patient_info_dataframe(metadata_path):
         'Bmi':bmi_values
     })
     return patient_info_dataframe
+
+def normalize_patient_id(patient_id):
+    """Normalizes a patient ID for joins, so that zero-padded and unpadded numeric IDs match"""
+    patient_id=str(patient_id).strip()
+    return (patient_id.lstrip('0') or '0') if patient_id.isdigit() else patient_id
+
+def index_patient_info(patient_info_dataframe):
+    """Indexes the patient info by normalized patient ID, keeping the first row of each patient"""
+    indexed=patient_info_dataframe.set_index(patient_info_dataframe['patients_ids'].map(normalize_patient_id).rename('patient_key'))
+    return indexed[~indexed.index.duplicated(keep='first')]
+
+def join_with_demographics(results_by_patient,patient_info_dataframe):
+    """Joins per-patient results (a dictionary of per-vertebra values, or a dataframe indexed by patient ID) with demographics"""
+    results=results_by_patient if isinstance(results_by_patient,pd.DataFrame) else pd.DataFrame.from_dict(results_by_patient,orient='index')
+    results=results.rename_axis('patient_id').reset_index()
+    results['patient_key']=results['patient_id'].map(normalize_patient_id)
+    joined=results.join(index_patient_info(patient_info_dataframe),on='patient_key',how='left')
+    return joined.drop(columns='patient_key').set_index('patient_id')
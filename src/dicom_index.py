@@ -0,0 +1,181 @@
+import os
+import json
+import hashlib
+from collections import OrderedDict
+from . import config
+from .instrumentation import stage
+
+INDEX_VERSION=5
+_memory_cache=OrderedDict()
+
+def clear_series_index_cache():
+    """Empties the in-memory copies of the folder indexes; the on-disk indexes are kept"""
+    _memory_cache.clear()
+
+def _index_cache_path(folder_path,cache_dir=None):
+    """Returns the on-disk location of the index of the given folder"""
+    cache_dir=cache_dir if cache_dir is not None else os.path.join(config.CACHE_DIR,"dicom_index")
+    key=hashlib.sha1(os.path.abspath(folder_path).encode()).hexdigest()
+    return os.path.join(cache_dir,key+".json")
+
+def _to_int(value):
+    """Converts a DICOM IS value to int, returning None when missing or malformed"""
+    try:
+        return int(value) if value is not None and value!='' else None
+    except (TypeError,ValueError):
+        return None
+
+def _to_float_list(value):
+    """Converts a DICOM multi-valued DS value to a list of floats"""
+    try:
+        return [float(v) for v in value] if value is not None else None
+    except (TypeError,ValueError):
+        return None
+
+def _to_float(value):
+    """Converts a DICOM DS value to float, returning None when missing or malformed"""
+    try:
+        return float(value) if value is not None and value!='' else None
+    except (TypeError,ValueError):
+        return None
+
+def _to_str(value):
+    """Converts a DICOM string value to str, keeping None when missing"""
+    return str(value) if value is not None else None
+
+def _first_item(ds,keyword):
+    """Returns the first item of a sequence element, or an empty dict when it is missing"""
+    sequence=ds.get(keyword)
+    return sequence[0] if sequence else {}
+
+def read_header_record(path,stat=None):
+    """Reads the header of a single file (without pixel data) into an index record"""
+    stat=stat if stat is not None else os.stat(path)
+    record={
+        'filename':os.path.basename(path),
+        'mtime':stat.st_mtime_ns,
+        'size':stat.st_size,
+        'readable':False
+    }
+    import pydicom
+    try:
+        with open(path,'rb') as fp:
+            ds=pydicom.dcmread(fp,stop_before_pixels=True,force=True)
+            pixel_data_offset=fp.tell()
+    except Exception:
+        return record
+    radiopharmaceutical=_first_item(ds,'RadiopharmaceuticalInformationSequence')
+    record.update({
+        'readable':True,
+        'SOPInstanceUID':_to_str(ds.get('SOPInstanceUID')),
+        'SeriesInstanceUID':_to_str(ds.get('SeriesInstanceUID')),
+        'SeriesNumber':_to_int(ds.get('SeriesNumber')),
+        'SeriesDescription':_to_str(ds.get('SeriesDescription')),
+        'StudyDescription':_to_str(ds.get('StudyDescription')),
+        'ImagePositionPatient':_to_float_list(ds.get('ImagePositionPatient')),
+        'InstanceNumber':_to_int(ds.get('InstanceNumber')),
+        'PixelSpacing':_to_float_list(ds.get('PixelSpacing')),
+        'SliceThickness':_to_float(ds.get('SliceThickness')),
+        'Rows':_to_int(ds.get('Rows')),
+        'Columns':_to_int(ds.get('Columns')),
+        'BitsAllocated':_to_int(ds.get('BitsAllocated')),
+        'BitsStored':_to_int(ds.get('BitsStored')),
+        'PixelRepresentation':_to_int(ds.get('PixelRepresentation')),
+        'SamplesPerPixel':_to_int(ds.get('SamplesPerPixel')),
+        'NumberOfFrames':_to_int(ds.get('NumberOfFrames')),
+        'RescaleSlope':_to_float(ds.get('RescaleSlope')),
+        'RescaleIntercept':_to_float(ds.get('RescaleIntercept')),
+        'Modality':_to_str(ds.get('Modality')),
+        'AcquisitionTime':_to_str(ds.get('AcquisitionTime')),
+        'PatientWeight':_to_float(ds.get('PatientWeight')),
+        'Units':_to_str(ds.get('Units')),
+        'DecayCorrection':_to_str(ds.get('DecayCorrection')),
+        'RadiopharmaceuticalStartTime':_to_str(radiopharmaceutical.get('RadiopharmaceuticalStartTime')),
+        'RadionuclideTotalDose':_to_float(radiopharmaceutical.get('RadionuclideTotalDose')),
+        'RadionuclideHalfLife':_to_float(radiopharmaceutical.get('RadionuclideHalfLife')),
+        'TransferSyntaxUID':_to_str(ds.file_meta.get('TransferSyntaxUID')) if hasattr(ds,'file_meta') else None,
+        'HasPixelData':pixel_data_offset<stat.st_size,
+        'PixelDataOffset':pixel_data_offset if pixel_data_offset<stat.st_size else None
+    })
+    return record
+
+def _load_index_file(cache_path):
+    """Loads a persisted index, returning an empty one when missing, stale or corrupt"""
+    try:
+        with open(cache_path,'r') as file:
+            data=json.load(file)
+    except (OSError,ValueError):
+        return {}
+    if data.get('version')!=INDEX_VERSION:
+        return {}
+    return data.get('entries',{})
+
+def _save_index_file(cache_path,folder_path,entries):
+    """Atomically writes the index of a folder to disk"""
+    os.makedirs(os.path.dirname(cache_path),exist_ok=True)
+    temp_path=f"{cache_path}.{os.getpid()}.tmp"
+    with open(temp_path,'w') as file:
+        json.dump({'version':INDEX_VERSION,'folder':folder_path,'entries':entries},file)
+    os.replace(temp_path,cache_path)
+
+class SeriesIndex:
+    def __init__(self,folder_path,records):
+        """Header-only index of the files of a patient folder, in folder listing order"""
+        self.folder_path=folder_path
+        self.records=records
+
+    def select(self,series_number=None,study_description=None,series_description=None,dcm_only=False,require_pixels=False,require_position=False):
+        """Returns the records matching all of the given criteria"""
+        selected=[]
+        for record in self.records:
+            if not record['readable']:
+                continue
+            if dcm_only and not record['filename'].lower().endswith('.dcm'):
+                continue
+            if series_number is not None and (record['SeriesNumber'] is None or str(record['SeriesNumber'])!=str(series_number)):
+                continue
+            if study_description is not None and study_description not in (record['StudyDescription'] or ''):
+                continue
+            if series_description is not None and series_description not in (record['SeriesDescription'] or ''):
+                continue
+            if require_pixels and not record['HasPixelData']:
+                continue
+            if require_position and record['ImagePositionPatient'] is None:
+                continue
+            selected.append(record)
+        return selected
+
+def get_series_index(folder_path,cache_dir=None):
+    """Returns the series index of a folder, re-reading only the files whose mtime or size changed
+
+    The indexes of the config.DICOM_INDEX_MEMORY_FOLDERS most recent folders are also kept in memory. Only lookups that actually read headers are recorded as a header_scan stage
+    """
+    folder_path=os.path.abspath(folder_path)
+    cache_path=_index_cache_path(folder_path,cache_dir)
+    cached=_memory_cache.pop(cache_path,None)
+    if cached is None:
+        cached=_load_index_file(cache_path)
+    entries={}
+    stale=[]
+    for filename in os.listdir(folder_path):
+        path=os.path.join(folder_path,filename)
+        if not os.path.isfile(path):
+            continue
+        stat=os.stat(path)
+        record=cached.get(filename)
+        if record is None or record['mtime']!=stat.st_mtime_ns or record['size']!=stat.st_size:
+            stale.append((filename,path,stat))
+            record=None
+        entries[filename]=record
+    if stale:
+        with stage("header_scan") as metrics:
+            for filename,path,stat in stale:
+                entries[filename]=read_header_record(path,stat)
+            metrics['files']=len(stale)
+    if stale or len(entries)!=len(cached):
+        _save_index_file(cache_path,folder_path,entries)
+    _memory_cache[cache_path]=entries
+    while len(_memory_cache)>max(config.DICOM_INDEX_MEMORY_FOLDERS,0):
+        _memory_cache.popitem(last=False)
+    records=[dict(record,path=os.path.join(folder_path,filename)) for filename,record in entries.items()]
+    return SeriesIndex(folder_path,records)
@@ -1,24 +1,48 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import SimpleITK as sitk
-import cv2
+import nibabel as nib
+from .orientation import LUMBAR_VIEW_PLAN, SEGMENTATION_VIEW_PLAN, CUSTOM_TRANSFORM_PLAN
+from .instrumentation import instrumented
 
+@instrumented("reorientation")
 def reorient_and_rotate_images(resampled_array,resampled_mask):
-    """Reorients and rotates the given CT volume and its corresponding mask"""
-    reoriented_array=np.transpose(resampled_array,(2,1,0))
-    processed_array=np.rot90(np.flipud(reoriented_array),k=1,axes=(1,2))
-    processed_mask=np.rot90(np.fliplr(resampled_mask),k=1,axes=(1,2))
-    flipped_second_dim=np.flipud(processed_mask.swapaxes(0,1)).swapaxes(0,1)
-    rotated_array=np.array([np.rot90(slice,2) for slice in processed_array])
-    mirrored_array=np.flip(np.flip(rotated_array,axis=2),axis=1)
-    rotated_mask=np.array([np.rot90(slice,2) for slice in flipped_second_dim[::-1]])
-    mirrored_mask=np.round(np.flip(np.flip(rotated_mask,axis=2),axis=1))
+    """Reorients and rotates the given CT volume (DICOM order) and its corresponding mask (NIfTI order)
+
+    Both go through the same lumbar view plan, the mask after aligning its axes with the DICOM array,
+    and each volume is copied exactly once
+    """
+    mirrored_array=LUMBAR_VIEW_PLAN.materialize(resampled_array)
+    mirrored_mask=SEGMENTATION_VIEW_PLAN.materialize(resampled_mask)
+    if np.issubdtype(mirrored_mask.dtype,np.floating):
+        np.rint(mirrored_mask,out=mirrored_mask)
     return mirrored_array,mirrored_mask
 
+def _load_label_data(nifti_img):
+    """Reads a NIfTI label map in its on-disk integer type, without converting it to float"""
+    proxy=nifti_img.dataobj
+    if getattr(proxy,'slope',1)==1 and getattr(proxy,'inter',0)==0 and hasattr(proxy,'get_unscaled'):
+        return proxy.get_unscaled()
+    return np.asanyarray(proxy)
+
+@instrumented("label_fusion")
+def fuse_label_maps(paths,labels=None,n_threads=None):
+    """Fuses binary NIfTI masks into one uint8 label map, later masks overwriting earlier ones"""
+    labels=list(range(1,len(paths)+1)) if labels is None else labels
+    nifti_images=[nib.load(path) for path in paths]
+    combined_mask=np.zeros(nifti_images[0].shape,dtype=np.uint8)
+    n_threads=n_threads or min(len(paths),os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=max(n_threads,1)) as executor:
+        for label,mask_data in zip(labels,executor.map(_load_label_data,nifti_images)):
+            np.copyto(combined_mask,np.uint8(label),where=mask_data>0)
+    return combined_mask
+
 def custom_transform(volume):
     """Applies a custom transformation to the given volume"""
-    transformed_volume=np.flip(np.transpose(volume,(1,2,0)),axis=2)[::-1]
-    return transformed_volume
+    return CUSTOM_TRANSFORM_PLAN.apply(volume)
 
+@instrumented("resampling")
 def resample_image(image,reference_image):
     """Resamples an image to match a reference image"""
     resampler=sitk.ResampleImageFilter()
@@ -28,12 +52,125 @@ def resample_image(image,reference_image):
     resampler.SetDefaultPixelValue(0)  
     return resampler.Execute(image)
 
-def crop_and_resize_pet(image,threshold):
-    """Crops a PET image above a threshold and resizes it to its original dimensions"""
-    if threshold>=image.shape[0]:
+def _subgrid_axis_is_exact(reference_image,axis,start,size):
+    """Checks that a sub-grid starting at index start along an axis has bit-identical physical points to the full grid
+
+    ITK computes each scanline start as origin+M*index, so a shifted origin reproduces the full grid exactly
+    only when that floating-point arithmetic does; this holds for axis-aligned directions only
+    """
+    direction=np.array(reference_image.GetDirection(),dtype=np.float64).reshape(3,3)
+    if np.count_nonzero(direction-np.diag(np.diag(direction))):
+        return False
+    step=direction[axis,axis]*reference_image.GetSpacing()[axis]
+    origin=reference_image.GetOrigin()[axis]
+    sub_origin=reference_image.TransformIndexToPhysicalPoint([start if i==axis else 0 for i in range(3)])[axis]
+    offsets=np.arange(size,dtype=np.float64)
+    return bool(np.array_equal(sub_origin+step*offsets,origin+step*(offsets+start)))
+
+@instrumented("resampling")
+def resample_image_region(image,reference_image,index,size,exact=True):
+    """Resamples an image onto the region of a reference image's grid starting at index (x,y,z) with the given size
+
+    With exact=True the values are bit-identical to the same region of resample_image(image,reference_image):
+    whole x scanlines are resampled, as ITK steps along them from their first voxel, and the y and z ranges
+    are only narrowed where the shifted grid origin reproduces the full grid's points exactly
+    """
+    index=[int(i) for i in index]
+    size=[int(n) for n in size]
+    grid_index,grid_size=list(index),list(size)
+    if exact:
+        full_size=reference_image.GetSize()
+        for axis in range(3):
+            if axis==0 or not _subgrid_axis_is_exact(reference_image,axis,index[axis],size[axis]):
+                grid_index[axis],grid_size[axis]=0,full_size[axis]
+    resampler=sitk.ResampleImageFilter()
+    resampler.SetOutputOrigin(reference_image.TransformIndexToPhysicalPoint(grid_index))
+    resampler.SetOutputSpacing(reference_image.GetSpacing())
+    resampler.SetOutputDirection(reference_image.GetDirection())
+    resampler.SetSize(grid_size)
+    resampler.SetInterpolator(sitk.sitkLinear)
+    resampler.SetTransform(sitk.Transform())
+    resampler.SetDefaultPixelValue(0)
+    resampler.SetOutputPixelType(image.GetPixelID())
+    resampled=resampler.Execute(image)
+    if grid_index==index and grid_size==size:
+        return resampled
+    return resampled[tuple(slice(i-g,i-g+n) for i,g,n in zip(index,grid_index,size))]
+
+def first_nonzero_row(image,reference_image,chunk_rows=8):
+    """Returns the first non-zero row of the mid x plane of resample_image(image,reference_image) flipped along z
+
+    Equal to utils.find_first_nonzero_slice on the full flipped result: the rows are resampled exactly in chunks
+    from the top and the search stops at the first chunk with a non-zero value. When the z axis cannot be
+    narrowed exactly, the mid x plane of the full grid is resampled once instead
+    """
+    size_x,size_y,size_z=reference_image.GetSize()
+    mid_x=size_x//2
+    for start in range(0,size_z,chunk_rows):
+        stop=min(start+chunk_rows,size_z)
+        if not _subgrid_axis_is_exact(reference_image,2,size_z-stop,stop-start):
+            start,stop=0,size_z
+        region=resample_image_region(image,reference_image,(mid_x,0,size_z-stop),(1,size_y,stop-start))
+        rows=sitk.GetArrayViewFromImage(region)[::-1,:,0]
+        nonzero_rows=np.flatnonzero(np.any(rows!=0,axis=1))
+        if nonzero_rows.size:
+            return start+int(nonzero_rows[0])
+        if stop==size_z:
+            return None
+    return None
+
+def linear_resize_coordinates(source_length,target_length,dtype=np.float32):
+    """Returns the lower/upper source indices and weights of a 1D linear resize with OpenCV's pixel-centre convention"""
+    scale=source_length/target_length
+    positions=(np.arange(target_length)+0.5)*scale-0.5
+    lower=np.floor(positions).astype(np.intp)
+    weights=(positions-lower).astype(dtype)
+    weights[lower<0]=0
+    lower[lower<0]=0
+    at_end=lower>=source_length-1
+    weights[at_end]=0
+    lower[at_end]=source_length-1
+    upper=np.minimum(lower+1,source_length-1)
+    return lower,upper,weights
+
+def _resize_rows(source,lower,upper,weights,out,chunk_rows=32):
+    """Writes source[lower]*(1-weights)+source[upper]*weights into out along the first axis, a chunk of rows at a time"""
+    compute_dtype=out.dtype if np.issubdtype(out.dtype,np.floating) else np.float32
+    for start in range(0,out.shape[0],chunk_rows):
+        rows=slice(start,min(start+chunk_rows,out.shape[0]))
+        row_weights=weights[rows,None,None]
+        chunk=source[lower[rows]].astype(compute_dtype,copy=False)
+        chunk*=1-row_weights
+        chunk+=source[upper[rows]]*row_weights
+        if compute_dtype!=out.dtype:
+            np.rint(chunk,out=chunk)
+        out[rows]=chunk
+    return out
+
+def _pet_resize_coordinates(threshold,length,dtype):
+    """Returns the resize coordinates of crop_and_resize_pet as indices of the uncropped volume"""
+    if threshold is None or threshold>=length:
         raise ValueError("Threshold must be less than the height of the image.")
-    cropped_image=image[threshold:,:,:] 
-    resized_image=np.zeros_like(image)
-    for i in range(image.shape[2]):
-        resized_image[:,:,i]=cv2.resize(cropped_image[:,:,i],(image.shape[1],image.shape[0]),interpolation=cv2.INTER_LINEAR)
-    return resized_image
+    compute_dtype=dtype if np.issubdtype(dtype,np.floating) else np.float32
+    lower,upper,weights=linear_resize_coordinates(length-threshold,length,dtype=compute_dtype)
+    return lower+threshold,upper+threshold,weights
+
+@instrumented("pet_crop")
+def crop_and_resize_pet(image,threshold,chunk_rows=32):
+    """Crops a PET image above a threshold and resizes it to its original dimensions"""
+    lower,upper,weights=_pet_resize_coordinates(threshold,image.shape[0],image.dtype)
+    return _resize_rows(image,lower,upper,weights,np.empty_like(image),chunk_rows)
+
+def pet_source_rows(threshold,length,rows):
+    """Returns the range of input rows that crop_and_resize_pet reads to produce the given output rows"""
+    lower,upper,_=_pet_resize_coordinates(threshold,length,np.float32)
+    start,stop,_=rows.indices(length)
+    return int(lower[start:stop].min()),int(upper[start:stop].max())+1
+
+@instrumented("pet_crop")
+def crop_and_resize_pet_region(source,threshold,length,rows,source_start,chunk_rows=32):
+    """Returns crop_and_resize_pet(image,threshold)[rows] from source=image[source_start:...], which must cover pet_source_rows"""
+    lower,upper,weights=_pet_resize_coordinates(threshold,length,source.dtype)
+    start,stop,_=rows.indices(length)
+    out=np.empty((stop-start,)+source.shape[1:],dtype=source.dtype)
+    return _resize_rows(source,lower[start:stop]-source_start,upper[start:stop]-source_start,weights[start:stop],out,chunk_rows)
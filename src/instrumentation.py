@@ -0,0 +1,227 @@
+import os
+import sys
+import json
+import time
+import uuid
+import cProfile
+import threading
+import functools
+import tracemalloc
+from contextlib import contextmanager
+from . import config
+
+try:
+    import resource
+except ImportError:
+    resource=None
+
+RUN_ID_VARIABLE="PETCT_RUN_ID"
+
+_local=threading.local()
+_profiler_lock=threading.Lock()
+
+def start_run():
+    """Starts a new metrics run, inherited by worker processes started afterwards, and returns its ID"""
+    run_id=uuid.uuid4().hex[:12]
+    os.environ[RUN_ID_VARIABLE]=run_id
+    return run_id
+
+def current_run_id():
+    """Returns the ID of the current metrics run, starting one if needed"""
+    return os.environ.get(RUN_ID_VARIABLE) or start_run()
+
+def _stack():
+    """Returns the stack of open stages of the current thread"""
+    if not hasattr(_local,'stack'):
+        _local.stack=[]
+    return _local.stack
+
+def _max_rss_bytes():
+    """Returns the peak resident set size of the process so far, or None where unavailable"""
+    if resource is None:
+        return None
+    max_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform=="darwin" else max_rss*1024
+
+def count_voxels(value):
+    """Returns the number of voxels in an array, a SimpleITK image or a tuple/list of them, or None"""
+    if hasattr(value,'GetNumberOfPixels'):
+        return int(value.GetNumberOfPixels())
+    if hasattr(value,'shape') and hasattr(value,'size'):
+        return int(value.size)
+    if isinstance(value,(tuple,list)):
+        counts=[count_voxels(item) for item in value]
+        counts=[count for count in counts if count is not None]
+        return sum(counts) if counts else None
+    return None
+
+def _profile_enabled(name):
+    """Tells whether config.PROFILE_STAGES asks for a cProfile dump of the given stage"""
+    stages=config.PROFILE_STAGES
+    return stages is True or (bool(stages) and name in stages)
+
+def write_metrics(record,path=None):
+    """Appends one metrics record as a JSON line, in a single write so that worker processes do not interleave"""
+    path=config.METRICS_FILENAME if path is None else path
+    if not path:
+        return
+    line=(json.dumps(record,default=str)+"\n").encode()
+    fd=os.open(path,os.O_WRONLY|os.O_APPEND|os.O_CREAT,0o644)
+    try:
+        os.write(fd,line)
+    finally:
+        os.close(fd)
+
+@contextmanager
+def stage(name,patient_id=None,voxels=None,record=True):
+    """Measures a pipeline stage and emits its wall time, CPU time, peak memory and voxel count as a JSON line
+
+    Yields the metrics dictionary, so voxel counts or other fields can be filled in by the caller.
+    Nested stages inherit the patient ID of the enclosing one. Peak traced memory is only collected
+    when tracemalloc is running (config.TRACE_MEMORY starts it for the outermost stage).
+    """
+    stack=_stack()
+    if patient_id is None and stack:
+        patient_id=stack[-1]['patient_id']
+    parent=next((frame for frame in reversed(stack) if frame['record']),None)
+    frame={'name':name,'patient_id':patient_id,'record':record}
+    stack.append(frame)
+    metrics={'stage':name,'patient_id':patient_id,'voxels':voxels}
+    if not record:
+        try:
+            yield metrics
+        finally:
+            stack.pop()
+        return
+
+    started_tracing=config.TRACE_MEMORY and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    if tracemalloc.is_tracing():
+        current,peak=tracemalloc.get_traced_memory()
+        if parent is not None and 'traced_peak' in parent:
+            parent['traced_peak']=max(parent['traced_peak'],peak)
+        tracemalloc.reset_peak()
+        frame['traced_start']=frame['traced_peak']=current
+    profiler=None
+    if _profile_enabled(name) and _profiler_lock.acquire(blocking=False):
+        profiler=cProfile.Profile()
+        profiler.enable()
+    error=None
+    start=time.time()
+    wall_start,cpu_start=time.perf_counter(),time.process_time()
+    try:
+        yield metrics
+    except BaseException as e:
+        error=type(e).__name__
+        raise
+    finally:
+        wall=time.perf_counter()-wall_start
+        cpu=time.process_time()-cpu_start
+        if profiler is not None:
+            profiler.disable()
+            _profiler_lock.release()
+            os.makedirs(config.PROFILE_DIR,exist_ok=True)
+            profiler.dump_stats(os.path.join(config.PROFILE_DIR,f"{name}_{patient_id}_{os.getpid()}_{int(start*1000)}.prof"))
+        peak_traced=None
+        if 'traced_start' in frame and tracemalloc.is_tracing():
+            frame['traced_peak']=max(frame['traced_peak'],tracemalloc.get_traced_memory()[1])
+            peak_traced=frame['traced_peak']-frame['traced_start']
+            if parent is not None and 'traced_peak' in parent:
+                parent['traced_peak']=max(parent['traced_peak'],frame['traced_peak'])
+        if started_tracing:
+            tracemalloc.stop()
+        stack.pop()
+        metrics.update({
+            'run_id':current_run_id(),
+            'parent':parent['name'] if parent is not None else None,
+            'pid':os.getpid(),
+            'start':start,
+            'wall_s':wall,
+            'cpu_s':cpu,
+            'max_rss_bytes':_max_rss_bytes(),
+            'peak_traced_bytes':peak_traced,
+            'error':error
+        })
+        write_metrics(metrics)
+
+def patient_scope(patient_id):
+    """Attributes the stages run inside it to a patient, without measuring anything itself"""
+    return stage(None,patient_id=patient_id,record=False)
+
+def instrumented(name):
+    """Decorates a function so that each call is measured as a stage, counting the voxels of its result"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args,**kwargs):
+            with stage(name) as metrics:
+                result=function(*args,**kwargs)
+                metrics['voxels']=count_voxels(result)
+            return result
+        return wrapper
+    return decorator
+
+def run_patient_stage(worker,patient_id,args):
+    """Runs worker(*args) as a stage named after the worker, attributing the nested stages to the patient"""
+    with stage(worker.__name__.lstrip('_'),patient_id=patient_id) as metrics:
+        result=worker(*args)
+        metrics['voxels']=count_voxels(result)
+    return result
+
+def read_metrics(path=None,run_id=None):
+    """Reads the metrics records of a JSON lines file, optionally keeping a single run"""
+    path=config.METRICS_FILENAME if path is None else path
+    if not path or not os.path.exists(path):
+        return []
+    records=[]
+    with open(path,'r') as file:
+        for line in file:
+            try:
+                record=json.loads(line)
+            except ValueError:
+                continue
+            if run_id is None or record.get('run_id')==run_id:
+                records.append(record)
+    return records
+
+def summarize_metrics(records):
+    """Aggregates metrics records per stage, in order of first appearance"""
+    summary={}
+    for record in records:
+        entry=summary.setdefault(record['stage'],{
+            'stage':record['stage'],'calls':0,'patients':set(),'errors':0,'wall_s':0.0,'cpu_s':0.0,
+            'max_wall_s':0.0,'voxels':0,'max_rss_bytes':0,'peak_traced_bytes':None
+        })
+        entry['calls']+=1
+        entry['errors']+=record.get('error') is not None
+        if record.get('patient_id') is not None:
+            entry['patients'].add(record['patient_id'])
+        entry['wall_s']+=record['wall_s']
+        entry['cpu_s']+=record['cpu_s']
+        entry['max_wall_s']=max(entry['max_wall_s'],record['wall_s'])
+        entry['voxels']+=record.get('voxels') or 0
+        entry['max_rss_bytes']=max(entry['max_rss_bytes'],record.get('max_rss_bytes') or 0)
+        if record.get('peak_traced_bytes') is not None:
+            entry['peak_traced_bytes']=max(entry['peak_traced_bytes'] or 0,record['peak_traced_bytes'])
+    for entry in summary.values():
+        entry['patients']=len(entry['patients'])
+    return list(summary.values())
+
+def format_metrics_summary(summary):
+    """Formats a per-stage summary as a fixed-width table"""
+    lines=[f"{'stage':<28}{'calls':>7}{'patients':>10}{'errors':>8}{'wall s':>10}{'cpu s':>10}{'max wall s':>12}{'Mvoxels/s':>11}{'max RSS MiB':>13}{'peak traced MiB':>17}"]
+    for entry in summary:
+        throughput=entry['voxels']/entry['wall_s']/1e6 if entry['wall_s']>0 and entry['voxels'] else 0.0
+        traced=f"{entry['peak_traced_bytes']/2**20:.1f}" if entry['peak_traced_bytes'] is not None else "-"
+        lines.append(
+            f"{entry['stage']:<28}{entry['calls']:>7}{entry['patients']:>10}{entry['errors']:>8}{entry['wall_s']:>10.2f}{entry['cpu_s']:>10.2f}"
+            f"{entry['max_wall_s']:>12.2f}{throughput:>11.1f}{entry['max_rss_bytes']/2**20:>13.1f}{traced:>17}"
+        )
+    return "\n".join(lines)
+
+def log_metrics_summary(logger,run_id=None,path=None):
+    """Logs the per-stage summary table of a run (the current one by default) and returns the summary"""
+    summary=summarize_metrics(read_metrics(path,current_run_id() if run_id is None else run_id))
+    if logger and summary:
+        logger.info("Stage metrics summary:\n"+format_metrics_summary(summary))
+    return summary
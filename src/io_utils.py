@@ -1,10 +1,12 @@
 import os
 import shutil
-import pydicom
 import numpy as np
-import SimpleITK as sitk
 import pickle
 from .utils import extract_pixel_array, compute_spacing_and_origin, compute_direction
+from .dicom_index import get_series_index
+from .volume_cache import load_records_volume
+
+DEFER_SIZE="4 KB"
 
 def setup_input_ts_folder(base_path='.', folder_name='input_ts'):
     """Sets up and clears the input folder for totalsegmentator"""
@@ -26,41 +28,41 @@ def copy_dicom_files(source_path, destination_path, study_description, series_nu
     if not os.path.exists(destination_path):
         os.makedirs(destination_path)
 
-    for curr_img in os.listdir(source_path):
-        path_fin=os.path.join(source_path,curr_img)
-        try:
-            dicom_file=pydicom.dcmread(path_fin)
-            if dicom_file.SeriesNumber==series_number and study_description in dicom_file.StudyDescription:
-                shutil.copy2(path_fin,os.path.join(destination_path,curr_img))
-                copied_count+=1
-        except Exception as e:
-            pass
+    index=get_series_index(source_path)
+    for record in index.select(series_number=series_number,study_description=study_description):
+        shutil.copy2(record['path'],os.path.join(destination_path,record['filename']))
+        copied_count+=1
     return copied_count
 
+def link_dicom_files(records, destination_path):
+    """Stages the files of the given index records in the destination folder using hardlinks, symlinks or copies"""
+    os.makedirs(destination_path,exist_ok=True)
+    for record in records:
+        target=os.path.join(destination_path,record['filename'])
+        try:
+            os.link(record['path'],target)
+        except OSError:
+            try:
+                os.symlink(os.path.abspath(record['path']),target)
+            except OSError:
+                shutil.copy2(record['path'],target)
+    return len(records)
+
 def check_target_series_in_folder(patient_folder_path, target_series):
     """Checks if the target series is present in the given folder"""
-    for dicom_file in os.listdir(patient_folder_path):
-        dicom_path=os.path.join(patient_folder_path,dicom_file)
-        dicom_read=pydicom.dcmread(dicom_path)
-        if target_series in dicom_read.SeriesDescription:
-            return True
-    return False
+    return bool(get_series_index(patient_folder_path).select(series_description=target_series))
 
 def load_dicom_volume(folder_path, target_study, target_number):
     """Loads DICOM volume as a SimpleITK image for the specified study and series number"""
-    files=[]
-    for f_name in os.listdir(folder_path):
-        if f_name.endswith('.dcm'):
-            dcm_file=pydicom.dcmread(os.path.join(folder_path,f_name))
-            if target_study in dcm_file.StudyDescription and str(dcm_file.SeriesNumber)==str(target_number):
-                files.append(dcm_file)
-
-    if not files:
+    records=get_series_index(folder_path).select(series_number=target_number,study_description=target_study,dcm_only=True)
+
+    if not records:
         raise FileNotFoundError("No DICOM files found for the specified study/series")
 
-    image_array=np.stack([f.pixel_array for f in files])
-    image_sitk=sitk.GetImageFromArray(image_array.astype(np.float32))
-    image_sitk.SetSpacing((float(files[0].PixelSpacing[0]),float(files[0].PixelSpacing[1]),float(files[0].SliceThickness)))
+    import SimpleITK as sitk
+    image_array=load_records_volume(records,rescale=False)
+    image_sitk=sitk.GetImageFromArray(image_array)
+    image_sitk.SetSpacing((records[0]['PixelSpacing'][0],records[0]['PixelSpacing'][1],records[0]['SliceThickness']))
     return image_sitk
 
 
@@ -75,38 +77,34 @@ def load_dictionary_from_file(filename):
         return pickle.load(file)
 
 def filter_dicom_pet(directory,target_description):
-    """Filters DICOM PET files matching the target description"""
+    """Filters DICOM PET files matching the target description, deferring pixel data until it is decoded"""
+    import pydicom
     pet_scans=[]
-    for filename in os.listdir(directory):
-        if filename.lower().endswith(".dcm"): 
-            filepath=os.path.join(directory,filename)
-            try:
-                dicom_data=pydicom.dcmread(filepath,force=True)
-                if hasattr(dicom_data,'PixelData'):
-                    if ('SeriesDescription' in dicom_data and 
-                        target_description in dicom_data.SeriesDescription and
-                        'ImagePositionPatient' in dicom_data):
-                        pet_scans.append(dicom_data)
-            except Exception as e:
-                print(f"Failed to read {filename}: {e}")
+    records=get_series_index(directory).select(
+        series_description=target_description,dcm_only=True,require_pixels=True,require_position=True
+    )
+    for record in records:
+        try:
+            pet_scans.append(pydicom.dcmread(record['path'],force=True,defer_size=DEFER_SIZE))
+        except Exception as e:
+            print(f"Failed to read {record['filename']}: {e}")
     return pet_scans
 
 def filter_dicom_ct(directory,target_description_number):
-    """Filters DICOM CT files matching the target series number"""
+    """Filters DICOM CT files matching the target series number, deferring pixel data until it is decoded"""
+    import pydicom
     ct_scans=[]
-    for filename in os.listdir(directory):
-        if filename.lower().endswith(".dcm"): 
-            filepath=os.path.join(directory,filename)
-            try:
-                dicom_data=pydicom.dcmread(filepath,force=True)
-                if dicom_data.SeriesNumber==target_description_number:
-                    ct_scans.append(dicom_data)
-            except Exception as e:
-                print(f"Failed to read {filename}: {e}")
+    records=get_series_index(directory).select(series_number=target_description_number,dcm_only=True)
+    for record in records:
+        try:
+            ct_scans.append(pydicom.dcmread(record['path'],force=True,defer_size=DEFER_SIZE))
+        except Exception as e:
+            print(f"Failed to read {record['filename']}: {e}")
     return ct_scans
 
 def load_dicom_series_from_pydicom(dicom_dataset_list):
     """Loads and converts a DICOM series into a SimpleITK image"""
+    import SimpleITK as sitk
     dicom_dataset_list.sort(key=lambda ds: ds.ImagePositionPatient[2])
     pixel_data=extract_pixel_array(dicom_dataset_list)
     first_dataset=dicom_dataset_list[0]
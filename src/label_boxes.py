@@ -0,0 +1,79 @@
+import numpy as np
+
+MAX_LABEL=63
+
+class LabelBoxes:
+    def __init__(self,shape,boxes):
+        """Bounding boxes of each label of a label map, stored as (start,stop) pairs per axis"""
+        self.shape=tuple(int(size) for size in shape)
+        self.boxes={int(label):tuple((int(start),int(stop)) for start,stop in box) for label,box in boxes.items()}
+
+    def labels(self):
+        """Returns the labels present in the label map"""
+        return sorted(self.boxes)
+
+    def union(self,labels=None):
+        """Returns the box enclosing the given labels (all labels by default), or None if none is present"""
+        labels=self.labels() if labels is None else [label for label in labels if label in self.boxes]
+        if not labels:
+            return None
+        return tuple(
+            (min(self.boxes[label][axis][0] for label in labels),max(self.boxes[label][axis][1] for label in labels))
+            for axis in range(len(self.shape))
+        )
+
+    def slices(self,label=None,labels=None,padding=0):
+        """Returns the slices of one label's box, or of the union of labels, grown by padding and clipped to the shape"""
+        box=self.boxes.get(label) if label is not None else self.union(labels)
+        if box is None:
+            return None
+        return tuple(slice(max(start-padding,0),min(stop+padding,size)) for (start,stop),size in zip(box,self.shape))
+
+    def cropped(self,slices):
+        """Returns the boxes expressed in the coordinates of a crop of the label map"""
+        offsets=[region.start or 0 for region in slices]
+        shape=[region.stop-offset for region,offset in zip(slices,offsets)]
+        boxes={}
+        for label,box in self.boxes.items():
+            clipped=tuple(
+                (max(start-offset,0),min(stop-offset,size)) for (start,stop),offset,size in zip(box,offsets,shape)
+            )
+            if all(start<stop for start,stop in clipped):
+                boxes[label]=clipped
+        return LabelBoxes(shape,boxes)
+
+    def to_dict(self):
+        """Returns a JSON-serializable description of the boxes"""
+        return {'shape':list(self.shape),'boxes':{str(label):[list(pair) for pair in box] for label,box in self.boxes.items()}}
+
+    @classmethod
+    def from_dict(cls,description):
+        """Rebuilds the boxes from their JSON-serializable description"""
+        return cls(description['shape'],{int(label):box for label,box in description['boxes'].items()})
+
+def compute_label_boxes(mask,chunk_rows=16):
+    """Computes the bounding box of every label in one pass, from per-axis projections of label bitsets"""
+    mask=np.asarray(mask)
+    axis0=np.zeros(mask.shape[0],dtype=np.uint64)
+    plane=np.zeros(mask.shape[1:],dtype=np.uint64)
+    one=np.uint64(1)
+    for start in range(0,mask.shape[0],chunk_rows):
+        chunk=mask[start:start+chunk_rows]
+        if chunk.size and (chunk.min()<0 or chunk.max()>MAX_LABEL):
+            raise ValueError(f"Labels must be between 0 and {MAX_LABEL}")
+        bits=np.left_shift(one,chunk.astype(np.uint64))
+        axis0[start:start+chunk.shape[0]]=np.bitwise_or.reduce(bits.reshape(chunk.shape[0],-1),axis=1)
+        plane|=np.bitwise_or.reduce(bits,axis=0)
+    projections=[axis0,np.bitwise_or.reduce(plane,axis=1),np.bitwise_or.reduce(plane,axis=0)]
+    present=int(np.bitwise_or.reduce(axis0)) if axis0.size else 0
+    boxes={}
+    for label in range(1,MAX_LABEL+1):
+        if not present>>label&1:
+            continue
+        bit=np.uint64(1<<label)
+        box=[]
+        for projection in projections:
+            indices=np.flatnonzero(projection&bit)
+            box.append((indices[0],indices[-1]+1))
+        boxes[label]=box
+    return LabelBoxes(mask.shape,boxes)
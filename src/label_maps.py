@@ -0,0 +1,18 @@
+import os
+import numpy as np
+import nibabel as nib
+from . import config
+
+def write_label_masks(output_dir,labels,spacing=(1.0,1.0,1.0),vertebrae=None):
+    """Writes a label map in DICOM (z,y,x) order as one binary vertebrae_<name>.nii.gz per label (1 for the first vertebra)"""
+    vertebrae=config.VERTEBRAE if vertebrae is None else vertebrae
+    os.makedirs(output_dir,exist_ok=True)
+    # Inverse of orientation.NIFTI_TO_DICOM_PLAN, so the masks line up with the CT like TotalSegmentator outputs
+    nifti_labels=np.transpose(labels[::-1,::-1],(2,1,0))
+    affine=np.diag([-spacing[2],-spacing[1],spacing[0],1.0])
+    paths=[]
+    for label,vert in enumerate(vertebrae,start=1):
+        path=os.path.join(output_dir,f"vertebrae_{vert}.nii.gz")
+        nib.save(nib.Nifti1Image((nifti_labels==label).astype(np.uint8),affine),path)
+        paths.append(path)
+    return paths
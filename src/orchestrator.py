@@ -1,163 +1,260 @@
 import os
 import numpy as np
+import pandas as pd
 from . import config
-from .io_utils import save_dictionary_to_file, load_dictionary_from_file, filter_dicom_pet
-from .pet_mask_processing import transform_data_dict, get_masks_and_pet_dict, crop_all_images_and_masks, multiply_pet_data_and_masks
-from .CTpipeline import CTProcessingPipeline
-from .PETpipeline import PetProcessor
+from .io_utils import save_dictionary_to_file, load_dictionary_from_file
+from .pet_mask_processing import transform_data_dict, get_masks_and_pet_dict, crop_all_images_and_masks, multiply_pet_data_and_masks, mask_and_scale_pet, crop_single_image_and_mask, mask_roi
 from .SUVpipeline import SUVProcessor
+from .parallel import map_patients
+from .resources import estimate_task_memory
+from .result_store import ResultStore, SEGMENTATION_STAGE, REGISTRATION_STAGE, SUV_STAGE, MASK_STAGE, STATISTICS_STAGE
+from .suv_metadata import build_metadata_table, valid_metadata_rows, metadata_table_to_dict, read_metadata_record, compute_decay_columns
+from .suv_analysis import compute_suv_statistics_for_patient
+from .cohort_aggregates import aggregate_statistics
+from .label_boxes import compute_label_boxes
+from .orientation import CUSTOM_TRANSFORM_PLAN
+from .instrumentation import start_run, stage, log_metrics_summary
 
-def process_patients_segmentation(data_folder, logger,limit=None, save_temp=False, load_temp=False, temp_file="temp_dict.pkl"):
-    """Runs the CT processing pipeline for the specified number of patients"""
+def _segment_patient(source_path, target_study, target_number, temp_file):
+    """Runs the CT processing pipeline for one patient, importing it (and SimpleITK, nibabel, torch) on first use"""
+    from .CTpipeline import CTProcessingPipeline
+    processor=CTProcessingPipeline(
+        source_path=source_path,
+        target_study=target_study,
+        target_number=target_number,
+        temp_file=temp_file
+    )
+    return processor.process()
+
+def _register_patient(data_folder, patient_id, target_description_pet, target_description_number_ct, target_study, roi=None):
+    """Runs the PET registration pipeline for one patient
+
+    With roi, [start,stop] pairs in the frame of the transformed vertebra mask, the PET is only resampled under
+    that region and the result carries the roi as a third element, so that the mask crop can be aligned with it.
+    The pipeline and its imaging libraries are imported on first use
+    """
+    from .PETpipeline import PetProcessor
+    processor=PetProcessor(
+        base_path=data_folder,
+        dataset_folder="",
+        target_description_pet=target_description_pet,
+        target_description_number_ct=target_description_number_ct,
+        target_study=target_study
+    )
+    processor.load_images(specific_directory=patient_id)
+    if roi is not None:
+        ct_np,pet_np_final=processor.resample_and_process(roi=tuple(slice(start,stop) for start,stop in roi))
+        return [ct_np,pet_np_final,roi]
+    ct_np,pet_np_final=processor.resample_and_process()
+    return [ct_np,pet_np_final]
+
+def _checkpoint_store(checkpoint_file, stage, resume, logger=None):
+    """Returns a ResultStore next to a legacy checkpoint file, where each finished patient is committed on its own
+
+    The store lives in a folder named after the file without its extension. Without resume the stage is
+    cleared, otherwise an existing legacy pickle is imported once so that its patients are skipped.
+    """
+    store=ResultStore(os.path.splitext(checkpoint_file)[0])
+    if not resume:
+        store.clear(stage)
+    elif not store.patients(stage) and os.path.exists(checkpoint_file):
+        if logger:
+            logger.info(f"Importing existing dictionary from {checkpoint_file}")
+        store.put_all(stage,load_dictionary_from_file(checkpoint_file))
+    return store
+
+def _load_checkpoint(checkpoint_file, stage, logger=None):
+    """Returns the results checkpointed next to a legacy checkpoint file without writing anything
+
+    A checkpoint store named after the file without its extension takes precedence over the legacy pickle
+    """
+    store=ResultStore(os.path.splitext(checkpoint_file)[0])
+    if store.patients(stage):
+        if logger:
+            logger.info(f"Loading existing results from {store.root}")
+        return store.stage(stage)
+    if os.path.exists(checkpoint_file):
+        if logger:
+            logger.info(f"Loading existing dictionary from {checkpoint_file}")
+        return load_dictionary_from_file(checkpoint_file)
+    return {}
+
+def process_patients_segmentation(data_folder, logger,limit=None, save_temp=False, load_temp=False, temp_file="temp_dict.pkl", n_workers=None, max_in_flight=None, store=None, budget=None):
+    """Runs the CT processing pipeline for the specified number of patients, optionally in worker processes
+
+    When a ResultStore is given, or save_temp checkpoints to a store named after temp_file, each patient is
+    committed to it as soon as it finishes, load_temp resumes from the patients already committed, and a lazy
+    view of the store is returned. load_temp alone reads an existing checkpoint without writing to disk. With a resources.ResourceBudget the patients are admitted
+    largest-first within its memory, from estimates read off the DICOM headers
+    """
+    start_run()
     patient_ids=os.listdir(data_folder)
+    n_workers=config.N_WORKERS if n_workers is None else n_workers
+    max_in_flight=config.MAX_PATIENTS_IN_FLIGHT if max_in_flight is None else max_in_flight
     
     if limit is None:
         limit=len(patient_ids)
     
-    if load_temp and os.path.exists(temp_file):
-        logger.info(f"Loading existing dictionary from {temp_file}")
-        result_dict=load_dictionary_from_file(temp_file)
+    if store is None and save_temp:
+        store=_checkpoint_store(temp_file,SEGMENTATION_STAGE,load_temp,logger)
+    if store is not None and load_temp:
+        result_dict=store.stage(SEGMENTATION_STAGE)
+    elif load_temp:
+        result_dict=dict(_load_checkpoint(temp_file,SEGMENTATION_STAGE,logger))
     else:
         result_dict={}
     
-    for i,patient_id in enumerate(patient_ids[:limit]):
+    tasks=[]
+    for patient_id in patient_ids[:limit]:
         if patient_id in result_dict:
             logger.info(f"Skipping already processed patient ID: {patient_id}")
             continue
-        logger.info(f"Processing patient ID: {patient_id}")
-        source_path=os.path.join(data_folder,patient_id)
-        processor=CTProcessingPipeline(
-            source_path=source_path,
-            target_study=config.TARGET_STUDY,
-            target_number=config.TARGET_NUMBER,
-            temp_file=temp_file
-        )
-        try:
-            result=processor.process(save_temp=False,load_temp=False)
-            result_dict[patient_id]=result
-            logger.info(f"Processing complete for patient ID: {patient_id}")
-        except Exception as e:
-            logger.error(f"Error processing patient {patient_id}: {e}")
+        source_path=os.path.abspath(os.path.join(data_folder,patient_id))
+        tasks.append((patient_id,(source_path,config.TARGET_STUDY,config.TARGET_NUMBER,temp_file)))
+    
+    for patient_id,result in map_patients(
+        _segment_patient,tasks,logger,n_workers=n_workers,max_in_flight=max_in_flight,
+        budget=budget,estimates=estimate_task_memory(data_folder,tasks) if budget is not None else None
+    ):
+        logger.info(f"Processing complete for patient ID: {patient_id}")
+        if store is not None:
+            store.put(SEGMENTATION_STAGE,patient_id,result)
             continue
-        
-        if save_temp:
-            save_dictionary_to_file(result_dict,temp_file)
-            logger.info(f"Saved intermediate results to {temp_file}")
+        result_dict[patient_id]=result
     
+    log_metrics_summary(logger)
+    if store is not None:
+        return store.stage(SEGMENTATION_STAGE)
     return result_dict
 
 def process_patients_registration(
     data_folder, logger,target_description_pet, target_description_number_ct, target_study,
-    limit=None, save_dict=False, load_dict=False ,dict_file="registration_data.pkl"
+    limit=None, save_dict=False, load_dict=False ,dict_file="registration_data.pkl", n_workers=None, max_in_flight=None, store=None,
+    roi_masks=None, padding=None, budget=None
 ):
-    """Orchestrates the second step of the pipeline by looping over patients"""
+    """Orchestrates the second step of the pipeline by looping over patients, committing each one to a ResultStore
+
+    The store is the given one, or with save_dict a checkpoint store named after dict_file. load_dict resumes
+    from the patients already committed, and without save_dict reads them without writing to disk. With roi_masks, the segmentation results by patient,
+    the PET of each patient is only resampled under the padded vertebra crop of its mask. A resources.ResourceBudget
+    admits the patients largest-first within its memory
+    """
     
-    if load_dict and os.path.exists(dict_file):
-        logger.info(f"Loading data from {dict_file}")
-        return load_dictionary_from_file(dict_file)
+    if store is None and save_dict:
+        store=_checkpoint_store(dict_file,REGISTRATION_STAGE,load_dict,logger)
+    result_dict=dict(_load_checkpoint(dict_file,REGISTRATION_STAGE,logger)) if store is None and load_dict else {}
+    committed=set(store.patients(REGISTRATION_STAGE)) if store is not None and load_dict else set(result_dict)
     
+    start_run()
     patient_ids=os.listdir(data_folder)
     
     if limit is None:
         limit=len(patient_ids)
     
-    result_dict={}
+    n_workers=config.N_WORKERS if n_workers is None else n_workers
+    max_in_flight=config.MAX_PATIENTS_IN_FLIGHT if max_in_flight is None else max_in_flight
+    padding=config.PADDING if padding is None else padding
     
+    tasks=[]
     for i,patient_id in enumerate(patient_ids[:limit]):
-        logger.info(f"Processing patient ID: {patient_id}")
-        
         if i in config.EXCLUDE_PATIENTS_PET:
             logger.info(f"Skipping patient ID: {patient_id}")
             continue
-        processor=PetProcessor(
-            base_path=data_folder,
-            dataset_folder="",
-            target_description_pet=target_description_pet,
-            target_description_number_ct=target_description_number_ct,
-            target_study=target_study
-        )
-        try:
-            processor.load_images(specific_directory=patient_id)
-            ct_np,pet_np_final=processor.resample_and_process()
-            result_dict[patient_id]=[ct_np,pet_np_final]
-            logger.info(f"Processing complete for patient: {patient_id}")
-        except Exception as e:
-            logger.error(f"Error processing patient {patient_id}: {e}")
+        if patient_id in committed:
+            logger.info(f"Skipping already processed patient ID: {patient_id}")
+            continue
+        roi=None
+        if roi_masks is not None and patient_id in roi_masks:
+            roi=mask_roi(CUSTOM_TRANSFORM_PLAN.apply(roi_masks[patient_id][1]),padding)
+        tasks.append((patient_id,(data_folder,patient_id,target_description_pet,target_description_number_ct,target_study,roi)))
     
-    if save_dict:
-        save_dictionary_to_file(result_dict,dict_file)
-        logger.info(f"Saved data to {dict_file}")
+    for patient_id,result in map_patients(
+        _register_patient,tasks,logger,n_workers=n_workers,max_in_flight=max_in_flight,
+        budget=budget,estimates=estimate_task_memory(data_folder,tasks) if budget is not None else None
+    ):
+        logger.info(f"Processing complete for patient: {patient_id}")
+        if store is not None:
+            store.put(REGISTRATION_STAGE,patient_id,result)
+            continue
+        result_dict[patient_id]=result
+    
+    log_metrics_summary(logger)
+    if store is not None:
+        return store.stage(REGISTRATION_STAGE)
     return result_dict
 
-def orchestrate_pet_processing(ct_dict, pet_dict,padding=20, ct_masks_flipped=False):
-    """Orchestrates PET data processing, including transformation, cropping, and mask application"""
+def orchestrate_pet_processing(ct_dict, pet_dict,padding=20, ct_masks_flipped=False, suv_factors=None, dtype=None, return_boxes=False):
+    """Orchestrates PET data processing, including transformation, cropping, and mask application
+
+    When per-patient SUV factors are given the masked PET is returned directly as SUV. With
+    return_boxes=True the per-vertebra bounding boxes of the cropped masks are returned as well
+    """
     
     transformed_data=transform_data_dict(ct_dict,ct_masks_flipped=ct_masks_flipped)
     masks_and_pet_dict=get_masks_and_pet_dict(transformed_data,pet_dict)
-    cropped_data=crop_all_images_and_masks(masks_and_pet_dict,padding=padding)
-    masked_pet_images,masked_images=multiply_pet_data_and_masks(cropped_data)
+    cropped_data,boxes_dict=crop_all_images_and_masks(masks_and_pet_dict,padding=padding,return_boxes=True)
+    masked_pet_images,masked_images=multiply_pet_data_and_masks(cropped_data,suv_factors=suv_factors,dtype=dtype)
+    if return_boxes:
+        return masked_pet_images,masked_images,boxes_dict
     return masked_pet_images,masked_images
 
-def process_metadata(path_patient, exclude_indices, masked_pet_images_dict, logger,temp_file="metadata_dict.pkl", load_temp=False):
-    """Processes metadata for all patients with an option to save/load intermediate results"""
-    
-    if load_temp and os.path.exists(temp_file):
-        logger.info(f"Loading existing metadata dictionary from {temp_file}")
-        return load_dictionary_from_file(temp_file)
+def process_metadata(path_patient, exclude_indices, masked_pet_images_dict, logger,temp_file="metadata_dict.pkl", load_temp=False, n_workers=None):
+    """Processes metadata for all patients with an option to save/load intermediate results
+
+    The SUV fields are taken from the indexed header of each patient's first PET slice and the decay
+    math runs on the whole cohort at once; the table is kept as pipeline.metadata_table
+    """
     
     pipeline=SUVProcessor(
         path_patient=path_patient,
         exclude_indices=exclude_indices,
         masked_pet_images_dict=masked_pet_images_dict
     )
-    patient_ids=os.listdir(pipeline.path_patient)
     
-    for i,curr_pat in enumerate(patient_ids):
-        
-        if i in pipeline.exclude_indices:
-            continue
-        path_curr_pat=os.path.join(pipeline.path_patient,curr_pat)
-        dicom_files=filter_dicom_pet(path_curr_pat,"[WB_CTAC]")
-        
-        if not dicom_files:
-            logger.info(f"No PET DICOM files found for patient {curr_pat}")
-            continue
-        sorted_dicom=pipeline.sort_dicom_slices(dicom_files)
-        first_ds=sorted_dicom[0]
-        
-        try:
-            metadata=pipeline.extract_metadata(first_ds)
-            time_diff_seconds=pipeline.calculate_time_difference(
-                metadata['injection_time'],metadata['acquisition_time']
-            )
-            decay_constant=pipeline.calculate_decay_constant(metadata['half_life_seconds'])
-            metadata['decayed_dose_bq']=pipeline.calculate_decayed_dose(
-                metadata['injected_dose_bq'],decay_constant,time_diff_seconds
-            )
-            
-            if metadata['units']!="BQML":
-                raise ValueError(f"Units are {metadata['units']}, but 'BQML' is required for SUV calculation")
-            pipeline.suv_metadata_dict[curr_pat]=metadata
-            pipeline.patients_processed_list.append(curr_pat)
-            logger.info(f"Processed patient {curr_pat}")
-        except Exception as e:
-            logger.error(f"Error processing patient {curr_pat}: {e}")
-            continue
+    if load_temp and os.path.exists(temp_file):
+        logger.info(f"Loading existing metadata dictionary from {temp_file}")
+        pipeline.suv_metadata_dict=load_dictionary_from_file(temp_file)
+        pipeline.patients_processed_list=list(pipeline.suv_metadata_dict)
+        return pipeline
+    
+    patient_ids=os.listdir(pipeline.path_patient)
+    selected_ids=[curr_pat for i,curr_pat in enumerate(patient_ids) if i not in pipeline.exclude_indices]
+    table=build_metadata_table(pipeline.path_patient,selected_ids,logger,n_workers=n_workers)
+    pipeline.metadata_table=valid_metadata_rows(table,logger)
+    pipeline.suv_metadata_dict=metadata_table_to_dict(pipeline.metadata_table)
+    pipeline.patients_processed_list=list(pipeline.suv_metadata_dict)
+    logger.info(f"Processed metadata of {len(pipeline.patients_processed_list)} patients")
     
     save_dictionary_to_file(pipeline.suv_metadata_dict,temp_file)
     logger.info(f"Saved metadata dictionary to {temp_file}")
     return pipeline
 
-def calculate_suv(path_patient, masked_pet_images_dict=None, logger=None, temp_file="suv_dict.pkl", load_temp=False):
-    """Calculates SUV volumes for patients using metadata and pixel data, with save/load options"""
+def calculate_suv(path_patient, masked_pet_images_dict=None, logger=None, temp_file="suv_dict.pkl", load_temp=False, store=None, in_place=False, dtype=None):
+    """Calculates SUV volumes for patients using metadata and pixel data, with save/load options
+
+    Volumes are scaled in one pass into a config.SUV_DTYPE buffer, or in place when in_place=True
+    and the masked PET volume is writeable and already of that dtype. Each patient is committed to
+    the given ResultStore, or to a checkpoint store named after temp_file, as soon as it is computed;
+    load_temp resumes from the committed patients, or only loads them when no PET volumes are given.
+    Patients of the checkpoint store missing from masked_pet_images_dict are removed, so it matches the input
+    """
     
-    if load_temp and os.path.exists(temp_file):
-        if logger:
-            logger.info(f"Loading existing SUV volumes dictionary from {temp_file}")
-        return load_dictionary_from_file(temp_file)
+    if load_temp and masked_pet_images_dict is None:
+        if store is not None:
+            return store.stage(SUV_STAGE)
+        return _load_checkpoint(temp_file,SUV_STAGE,logger)
     
     if masked_pet_images_dict is None:
         raise ValueError("masked_pet_images_dict is required when load_temp=False")
+    
+    if store is None:
+        store=_checkpoint_store(temp_file,SUV_STAGE,load_temp,logger)
+        for curr_pat in store.patients(SUV_STAGE):
+            if curr_pat not in masked_pet_images_dict:
+                store.remove(SUV_STAGE,curr_pat)
+                if logger:
+                    logger.warning(f"Removed the checkpointed SUV of patient {curr_pat}, which is not in the masked PET volumes")
+    start_run()
     pipeline=process_metadata(
         path_patient=path_patient,
         exclude_indices=config.EXCLUDE_PATIENTS_SUV,
@@ -173,28 +270,126 @@ def calculate_suv(path_patient, masked_pet_images_dict=None, logger=None, temp_f
             if logger:
                 logger.info(f"No pixel data found for patient {curr_pat}")
             continue
+        if load_temp and store.has(SUV_STAGE,curr_pat):
+            if logger:
+                logger.info(f"Skipping already processed patient {curr_pat}")
+            continue
         try:
-            suv_volume=(
-                (pixel_data_volume.astype(np.float64)*metadata['patient_weight_g'])/
-                metadata['decayed_dose_bq']
-            )
-            pipeline.suv_volume_dict[curr_pat]=suv_volume
+            suv_dtype=np.dtype(config.SUV_DTYPE if dtype is None else dtype)
+            reuse_buffer=in_place and pixel_data_volume.flags.writeable and pixel_data_volume.dtype==suv_dtype
+            with stage("suv",patient_id=curr_pat,voxels=pixel_data_volume.size):
+                suv_volume=mask_and_scale_pet(
+                    pixel_data_volume,
+                    factor=SUVProcessor.calculate_suv_factor(metadata),
+                    out=pixel_data_volume if reuse_buffer else None,
+                    dtype=suv_dtype
+                )
+            store.put(SUV_STAGE,curr_pat,suv_volume)
             if logger:
                 logger.info(f"Computed SUV for patient {curr_pat}")
         except Exception as e:
             if logger:
                 logger.error(f"Error computing SUV for patient {curr_pat}: {e}")
             continue
-    save_dictionary_to_file(pipeline.suv_volume_dict,temp_file)
-    
+    log_metrics_summary(logger)
     if logger:
-        logger.info(f"Saved SUV volumes dictionary to {temp_file}")
+        logger.info(f"Saved SUV volumes to {store.root}")
+    return store.stage(SUV_STAGE)
+
+def _stream_patient(data_folder, patient_id, padding, percentiles, dtype, store, resume, temp_file="temp_dict.pkl"):
+    """Runs CT, PET, masking, SUV and statistics for one patient and returns only its small statistics record
+
+    The volumes are local to this call, so they are released before the next patient starts; with a
+    ResultStore the SUV volume and cropped mask are also written to it as on-disk artifacts
+    """
+    if resume and store is not None and store.has(STATISTICS_STAGE,patient_id):
+        return store.get(STATISTICS_STAGE,patient_id,mmap=False)
+    source_path=os.path.abspath(os.path.join(data_folder,patient_id))
+    row=read_metadata_record(source_path)
+    if row is None:
+        raise FileNotFoundError("No PET DICOM files found")
+    metadata=pd.DataFrame.from_records([row],index=[patient_id])
+    if metadata['units'].iloc[0]!="BQML":
+        raise ValueError(f"Units are {metadata['units'].iloc[0]}, but 'BQML' is required for SUV calculation")
+    suv_factor=float(compute_decay_columns(metadata)['suv_factor'].iloc[0])
     
-    return pipeline.suv_volume_dict
+    _,ct_mask=_segment_patient(source_path,config.TARGET_STUDY,config.TARGET_NUMBER,temp_file)
+    mask=CUSTOM_TRANSFORM_PLAN.apply(ct_mask)
+    boxes=compute_label_boxes(mask)
+    slices=boxes.slices(labels=[label for label in boxes.labels() if label>1],padding=padding)
+    roi=[[region.start,region.stop] for region in slices] if slices is not None else None
+    _,pet_volume,*_=_register_patient(
+        data_folder,patient_id,config.TARGET_DESCRIPTION_PET,config.TARGET_DESCRIPTION_NUMBER_CT,config.TARGET_STUDY,roi
+    )
+    cropped_mask,cropped_pet=crop_single_image_and_mask(mask,pet_volume,padding=padding,boxes=boxes,image_roi=roi)
+    cropped_boxes=boxes.cropped(slices) if slices is not None else boxes
+    suv_volume=mask_and_scale_pet(cropped_pet,cropped_mask,suv_factor,dtype=dtype)
+    statistics=compute_suv_statistics_for_patient(suv_volume,cropped_mask,percentiles=percentiles,boxes=cropped_boxes)
+    record={'suv_factor':suv_factor,'statistics':statistics}
+    if store is not None:
+        store.put(SUV_STAGE,patient_id,suv_volume)
+        store.put(MASK_STAGE,patient_id,cropped_mask)
+        store.put(STATISTICS_STAGE,patient_id,record)
+    return record
 
+def stream_cohort(data_folder, logger, limit=None, exclude_indices=None, padding=None, percentiles=None,
+                  dtype=None, store=None, resume=False, n_workers=None, max_in_flight=None, budget=None, temp_file="temp_dict.pkl"):
+    """Streams the cohort patient by patient through CT, PET, mask, SUV and per-vertebra statistics
 
+    Yields (patient_id, record) with the SUV factor and the per-vertebra statistics of each patient, so memory
+    does not grow with the cohort. Patients at the listing positions in exclude_indices (by default those
+    excluded from registration or SUV) are skipped. With a ResultStore the artifacts of each patient are
+    committed to it, and resume=True yields the stored records of committed patients instead of recomputing them.
+    temp_file is handed to the CT pipeline of each patient, as in process_patients_segmentation.
+    With a resources.ResourceBudget the patients are admitted largest-first, and still yielded in listing order
+    """
+    start_run()
+    patient_ids=os.listdir(data_folder)
+    limit=len(patient_ids) if limit is None else limit
+    exclude_indices=set(config.EXCLUDE_PATIENTS_PET)|set(config.EXCLUDE_PATIENTS_SUV) if exclude_indices is None else set(exclude_indices)
+    padding=config.PADDING if padding is None else padding
+    n_workers=config.N_WORKERS if n_workers is None else n_workers
+    max_in_flight=config.MAX_PATIENTS_IN_FLIGHT if max_in_flight is None else max_in_flight
+    
+    tasks=[]
+    for i,patient_id in enumerate(patient_ids[:limit]):
+        if i in exclude_indices:
+            logger.info(f"Skipping patient ID: {patient_id}")
+            continue
+        tasks.append((patient_id,(data_folder,patient_id,padding,percentiles,dtype,store,resume,temp_file)))
+    
+    yield from map_patients(
+        _stream_patient,tasks,logger,n_workers=n_workers,max_in_flight=max_in_flight,
+        budget=budget,estimates=estimate_task_memory(data_folder,tasks) if budget is not None else None
+    )
+    log_metrics_summary(logger)
 
+def collect_streamed_statistics(records, logger=None):
+    """Returns the statistics by patient and the mean SUVs by vertebral level of (patient_id, record) pairs
 
+    Labels are keyed as np.uint8, the dtype of the fused label maps, as in compute_mean_suv_across_patients,
+    whether the record was just computed or resumed from the store
+    """
+    statistics_by_patient={}
+    mean_suv_by_vertebral_level_across_patients={}
+    for patient_id,record in records:
+        statistics_by_patient[patient_id]={np.uint8(label):statistics for label,statistics in record['statistics'].items()}
+        for label,statistics in statistics_by_patient[patient_id].items():
+            mean_suv_by_vertebral_level_across_patients.setdefault(label,[]).append(statistics['mean'])
+        if logger:
+            logger.info(f"Processing complete for patient ID: {patient_id}")
+    return statistics_by_patient,mean_suv_by_vertebral_level_across_patients
 
+def process_cohort_streaming(data_folder, logger, **kwargs):
+    """Runs stream_cohort to completion and returns the statistics by patient and the mean SUVs by vertebral level"""
+    return collect_streamed_statistics(stream_cohort(data_folder,logger,**kwargs),logger)
 
+def aggregate_cohort_streaming(data_folder, logger, patient_info_dataframe=None, strata=None, aggregates=None, **kwargs):
+    """Runs stream_cohort and folds each finished patient into CohortAggregates, keeping nothing per patient
 
+    Pass existing aggregates to extend them, e.g. loaded from a previous run over other patients
+    """
+    return aggregate_statistics(
+        ((patient_id,record['statistics']) for patient_id,record in stream_cohort(data_folder,logger,**kwargs)),
+        patient_info_dataframe,strata,aggregates
+    )
@@ -0,0 +1,74 @@
+import numpy as np
+
+class OrientationPlan:
+    def __init__(self,perm=(0,1,2),flips=(False,False,False)):
+        """Axis permutation followed by axis flips: out=flip(transpose(volume,perm),flips)"""
+        self.perm=tuple(int(axis) for axis in perm)
+        self.flips=tuple(bool(flip) for flip in flips)
+
+    def transpose(self,axes):
+        """Appends a np.transpose with the given axes"""
+        return OrientationPlan([self.perm[axis] for axis in axes],[self.flips[axis] for axis in axes])
+
+    def swapaxes(self,axis1,axis2):
+        """Appends a swap of two axes"""
+        axes=list(range(len(self.perm)))
+        axes[axis1],axes[axis2]=axes[axis2],axes[axis1]
+        return self.transpose(axes)
+
+    def flip(self,axis):
+        """Appends a reversal of one axis"""
+        flips=list(self.flips)
+        flips[axis]=not flips[axis]
+        return OrientationPlan(self.perm,flips)
+
+    def flipud(self):
+        """Appends np.flipud (equivalently volume[::-1])"""
+        return self.flip(0)
+
+    def fliplr(self):
+        """Appends np.fliplr"""
+        return self.flip(1)
+
+    def rot90(self,k=1,axes=(0,1)):
+        """Appends np.rot90 with the same conventions as NumPy"""
+        k%=4
+        if k==0:
+            return self
+        if k==2:
+            return self.flip(axes[0]).flip(axes[1])
+        if k==1:
+            return self.flip(axes[1]).swapaxes(axes[0],axes[1])
+        return self.swapaxes(axes[0],axes[1]).flip(axes[1])
+
+    def rot90_slices(self,k=1):
+        """Appends np.rot90 applied to every 2D slice along the first axis"""
+        return self.rot90(k,axes=(1,2))
+
+    def then(self,other):
+        """Composes this plan with another one applied after it"""
+        plan=self.transpose(other.perm)
+        return OrientationPlan(plan.perm,[a!=b for a,b in zip(plan.flips,other.flips)])
+
+    def apply(self,volume):
+        """Returns the reoriented volume as a view, without copying"""
+        view=np.transpose(volume,self.perm)
+        return view[tuple(slice(None,None,-1) if flip else slice(None) for flip in self.flips)]
+
+    def materialize(self,volume,dtype=None):
+        """Returns the reoriented volume as a single contiguous copy"""
+        return np.ascontiguousarray(self.apply(volume),dtype=dtype)
+
+    def __eq__(self,other):
+        return isinstance(other,OrientationPlan) and self.perm==other.perm and self.flips==other.flips
+
+    def __hash__(self):
+        return hash((self.perm,self.flips))
+
+    def __repr__(self):
+        return f"OrientationPlan(perm={self.perm}, flips={self.flips})"
+
+LUMBAR_VIEW_PLAN=OrientationPlan().transpose((2,1,0)).flipud().rot90(1,axes=(1,2)).rot90_slices(2).flip(2).flip(1)
+NIFTI_TO_DICOM_PLAN=OrientationPlan(perm=(2,1,0),flips=(True,True,False))
+SEGMENTATION_VIEW_PLAN=NIFTI_TO_DICOM_PLAN.then(LUMBAR_VIEW_PLAN)
+CUSTOM_TRANSFORM_PLAN=OrientationPlan().transpose((1,2,0)).flip(2).flipud()
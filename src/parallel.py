@@ -0,0 +1,124 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from .instrumentation import run_patient_stage
+from .resources import apply_thread_limits, thread_limits, largest_first
+from .volume_cache import clear_volume_cache
+from .dicom_index import clear_series_index_cache
+
+def _run_patient(worker,patient_id,args):
+    """Runs one patient as a stage, then empties the in-memory volume and series index caches so that nothing outlives the patient"""
+    try:
+        return run_patient_stage(worker,patient_id,args)
+    finally:
+        clear_volume_cache()
+        clear_series_index_cache()
+
+def _collect_result(patient_id,future,logger):
+    """Waits for a submitted patient and returns its result as a list with zero or one entry"""
+    try:
+        return [(patient_id,future.result())]
+    except Exception as e:
+        logger.error(f"Error processing patient {patient_id}: {e}")
+        return []
+
+def map_patients(worker,tasks,logger,n_workers=1,max_in_flight=None,budget=None,estimates=None):
+    """Runs worker(*args) for each (patient_id,args) task and yields (patient_id,result) in task order
+
+    Errors are logged per patient and the failing patient is skipped, as in the serial loops.
+    With n_workers>1 the tasks run in a process pool and at most max_in_flight patients
+    (default n_workers) are submitted but not yet collected, which bounds the volumes held at once.
+    Each patient is measured as a stage named after the worker, see instrumentation.stage, and the volume
+    cache of the process running it is emptied when it finishes.
+    With a resources.ResourceBudget, see _map_patients_with_budget.
+    """
+    if budget is not None:
+        yield from _map_patients_with_budget(worker,tasks,logger,n_workers,max_in_flight,budget,estimates or {})
+        return
+    if n_workers is None or n_workers<=1:
+        for patient_id,args in tasks:
+            logger.info(f"Processing patient ID: {patient_id}")
+            try:
+                result=_run_patient(worker,patient_id,args)
+            except Exception as e:
+                logger.error(f"Error processing patient {patient_id}: {e}")
+                continue
+            yield patient_id,result
+        return
+
+    max_in_flight=max(max_in_flight or n_workers,1)
+    pending=deque()
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        for patient_id,args in tasks:
+            if len(pending)>=max_in_flight:
+                yield from _collect_result(*pending.popleft(),logger)
+            logger.info(f"Processing patient ID: {patient_id}")
+            pending.append((patient_id,executor.submit(_run_patient,worker,patient_id,args)))
+        while pending:
+            yield from _collect_result(*pending.popleft(),logger)
+
+def _admission_index(remaining,head_id,in_use,held,max_in_flight,budget,estimates,running):
+    """Returns the index in remaining of the next patient to start, or None to wait for a running one
+
+    held counts the running and the finished but not yet yielded patients. The largest patient that fits is
+    preferred, as long as a slot and memory stay free for head_id, the next patient to yield, so that the
+    buffered results can always be released; with nothing running the head starts even beyond the budget.
+    """
+    head_index=next((i for i,(patient_id,_) in enumerate(remaining) if patient_id==head_id),None)
+    head_estimate=(estimates.get(head_id) or 0) if head_index is not None else 0
+    for i,(patient_id,_) in enumerate(remaining):
+        estimate=estimates.get(patient_id) or 0
+        if i==head_index:
+            if held<max_in_flight and budget.fits(in_use,estimate):
+                return i
+        elif head_index is None or held+1<max_in_flight and budget.fits(in_use+estimate,head_estimate):
+            if held<max_in_flight and budget.fits(in_use,estimate):
+                return i
+    if not running:
+        return head_index if head_index is not None else 0
+    return None
+
+def _map_patients_with_budget(worker,tasks,logger,n_workers,max_in_flight,budget,estimates):
+    """Runs the tasks largest-first, admitting a patient only while its memory estimate fits in the budget
+
+    Each worker is limited to its share of the budget cores in every threaded library. When the next patient
+    does not fit, smaller ones that fit are started in its place; a patient larger than the whole budget
+    only runs alone. Finished results are buffered and yielded in task order, as in map_patients, and keep
+    their memory estimate and their max_in_flight slot until they are yielded, see _admission_index; a single
+    worker runs the tasks in that order with the thread limits applied only for the duration of the call.
+    """
+    n_workers=max(n_workers or 1,1)
+    if n_workers==1:
+        with thread_limits(budget.cores):
+            yield from map_patients(worker,tasks,logger)
+        return
+
+    position={patient_id:i for i,(patient_id,_) in enumerate(tasks)}
+    remaining=largest_first(tasks,estimates)
+    finished={}
+    next_position=0
+
+    max_in_flight=max(max_in_flight or n_workers,1)
+    running={}
+    in_use=0
+    with ProcessPoolExecutor(max_workers=n_workers,initializer=apply_thread_limits,initargs=(budget.threads_per_task(n_workers),)) as executor:
+        while remaining or running:
+            while remaining:
+                index=_admission_index(
+                    remaining,tasks[next_position][0],in_use,len(running)+len(finished),max_in_flight,budget,estimates,running
+                )
+                if index is None:
+                    break
+                patient_id,args=remaining.pop(index)
+                logger.info(f"Processing patient ID: {patient_id}")
+                future=executor.submit(_run_patient,worker,patient_id,args)
+                running[future]=patient_id
+                in_use+=estimates.get(patient_id) or 0
+            done,_=wait(running,return_when=FIRST_COMPLETED)
+            for future in done:
+                patient_id=running.pop(future)
+                finished[position[patient_id]]=(patient_id,_collect_result(patient_id,future,logger))
+            while next_position in finished:
+                patient_id,results=finished.pop(next_position)
+                in_use-=estimates.get(patient_id) or 0
+                next_position+=1
+                yield from results
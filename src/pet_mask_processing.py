@@ -1,44 +1,58 @@
 import numpy as np
+from . import config
+from .orientation import CUSTOM_TRANSFORM_PLAN
+from .label_boxes import compute_label_boxes
+from .instrumentation import instrumented, patient_scope
 
 def custom_transform(volume):
     "Applies a custom transformation to the given volume"
-    transformed_volume=np.flip(np.transpose(volume,(1,2,0)),axis=2)[::-1]
-    return transformed_volume
+    return CUSTOM_TRANSFORM_PLAN.apply(volume)
 
 def transform_data_dict(data_dict,ct_masks_flipped=None):
     "Transforms a data dictionary with an optional mask flip"
     
     transformed_dict={}
+    ct_plan=CUSTOM_TRANSFORM_PLAN.flipud() if ct_masks_flipped else CUSTOM_TRANSFORM_PLAN
     for key,value in data_dict.items():
-        transformed_first=custom_transform(value[0])
-        transformed_second=custom_transform(value[1])
-        if ct_masks_flipped:
-            transformed_first=transformed_first[::-1]
+        transformed_first=ct_plan.apply(value[0])
+        transformed_second=CUSTOM_TRANSFORM_PLAN.apply(value[1])
         transformed_dict[key]=[transformed_first,transformed_second]
     return transformed_dict
 
 def get_masks_and_pet_dict(dict1,dict2):
-    "Generates a dictionary mapping common keys to masks and PET data"
+    "Generates a dictionary mapping common keys to masks and PET data, plus the PET region when it was registered on one"
     
     common_keys=set(dict1.keys())&set(dict2.keys())
     result_dict={}
     for key in common_keys:
         second_element_dict1=dict1[key][1]
         second_element_dict2=dict2[key][1]
-        result_dict[key]=[second_element_dict1,second_element_dict2]
+        result_dict[key]=[second_element_dict1,second_element_dict2,*dict2[key][2:3]]
     return result_dict
 
-def crop_single_image_and_mask(mask,image,padding=20):
-    "Crops a single image and mask based on non-zero mask regions with padding"
+def mask_roi(mask,padding=20):
+    "Returns the region that crop_single_image_and_mask keeps for a transformed mask as [start,stop] pairs, or None"
+    boxes=compute_label_boxes(mask)
+    slices=boxes.slices(labels=[label for label in boxes.labels() if label>1],padding=padding)
+    return [[region.start,region.stop] for region in slices] if slices is not None else None
+
+@instrumented("mask_crop")
+def crop_single_image_and_mask(mask,image,padding=20,boxes=None,image_roi=None):
+    """Crops a single image and mask based on the labels above 1 in the mask, with padding
+
+    image_roi gives the [start,stop] region of the mask frame that the image covers, when it was
+    registered only on that region
+    """
     
-    indices=np.argwhere(mask>1)
-    if indices.size==0:
-        return image,mask
-    min_indices=indices.min(axis=0)
-    max_indices=indices.max(axis=0)+1
-    min_indices=np.maximum(min_indices-padding,0)
-    max_indices=np.minimum(max_indices+padding,mask.shape)
-    slices=tuple(slice(start,end)for start,end in zip(min_indices,max_indices))
+    boxes=compute_label_boxes(mask) if boxes is None else boxes
+    slices=boxes.slices(labels=[label for label in boxes.labels() if label>1],padding=padding)
+    if slices is None:
+        return mask,image
+    if image_roi is not None:
+        if any(region.start<start or region.stop>stop for region,(start,stop) in zip(slices,image_roi)):
+            raise ValueError("The registered PET region does not cover the mask crop")
+        cropped_image=image[tuple(slice(region.start-start,region.stop-start) for region,(start,_) in zip(slices,image_roi))]
+        return mask[slices],cropped_image
     cropped_image=image[slices]
     cropped_mask=mask[slices]
     return cropped_mask,cropped_image
@@ -49,26 +63,52 @@ def normalize_mask(mask,normalize_multilabels=False):
         mask=np.where(mask>1,1,mask)
     return mask
 
-def crop_all_images_and_masks(masks_and_pet_dict,padding=20):
-    "Crops all images and masks in the dictionary with padding"
+@instrumented("mask_and_scale")
+def mask_and_scale_pet(image,mask=None,factor=1.0,out=None,dtype=None):
+    "Writes image*factor inside the mask and 0 outside in one pass into a preallocated (or given) buffer"
+    dtype=np.dtype(config.SUV_DTYPE if dtype is None else dtype)
+    if mask is None:
+        if out is None:
+            out=np.empty(image.shape,dtype=dtype)
+        return np.multiply(image,factor,out=out,casting='same_kind')
+    inside=np.asarray(mask)>0
+    if out is None:
+        out=np.zeros(image.shape,dtype=dtype)
+        return np.multiply(image,factor,out=out,where=inside,casting='same_kind')
+    np.multiply(image,factor,out=out,where=inside,casting='same_kind')
+    np.copyto(out,0,where=np.logical_not(inside,out=inside))
+    return out
+
+def crop_all_images_and_masks(masks_and_pet_dict,padding=20,boxes_dict=None,return_boxes=False):
+    "Crops all images and masks in the dictionary with padding, optionally returning the label boxes of the crops"
     cropped_dict={}
+    cropped_boxes_dict={}
     
-    for key,(mask,image)in masks_and_pet_dict.items():
-        cropped_image,cropped_mask=crop_single_image_and_mask(mask,image,padding=padding)
+    for key,(mask,image,*image_roi)in masks_and_pet_dict.items():
+        boxes=boxes_dict[key] if boxes_dict is not None and key in boxes_dict else compute_label_boxes(mask)
+        with patient_scope(key):
+            cropped_image,cropped_mask=crop_single_image_and_mask(
+                mask,image,padding=padding,boxes=boxes,image_roi=image_roi[0] if image_roi else None
+            )
         cropped_dict[key]=(cropped_mask,cropped_image)
+        slices=boxes.slices(labels=[label for label in boxes.labels() if label>1],padding=padding)
+        cropped_boxes_dict[key]=boxes.cropped(slices) if slices is not None else boxes
+    if return_boxes:
+        return cropped_dict,cropped_boxes_dict
     return cropped_dict
 
-def multiply_pet_data_and_masks(cropped_dict):
-    "Multiplies PET images with their corresponding normalized masks"
+def multiply_pet_data_and_masks(cropped_dict,suv_factors=None,dtype=None):
+    "Multiplies PET images with their binarized masks, applying each patient's SUV factor if given"
     
     masked_pet_images_dict={}
     masked_images_dict={}
     
     for key,(cropped_image,cropped_mask)in cropped_dict.items():
-        normalized_mask_0_1=normalize_mask(cropped_mask,normalize_multilabels=True)
-        normalized_mask_multi=normalize_mask(cropped_mask,normalize_multilabels=False)
-        multiplied_image=cropped_image*normalized_mask_0_1
-        masked_pet_images_dict[key]=multiplied_image
-        masked_images_dict[key]=normalized_mask_multi
+        if suv_factors is not None and key not in suv_factors:
+            continue
+        factor=1.0 if suv_factors is None else suv_factors[key]
+        with patient_scope(key):
+            masked_pet_images_dict[key]=mask_and_scale_pet(cropped_image,cropped_mask,factor,dtype=dtype)
+        masked_images_dict[key]=cropped_mask
     
     return masked_pet_images_dict,masked_images_dict
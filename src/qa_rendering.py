@@ -0,0 +1,140 @@
+import os
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from . import config
+from .orientation import CUSTOM_TRANSFORM_PLAN
+from .parallel import map_patients
+from .result_store import ResultStore, SEGMENTATION_STAGE, REGISTRATION_STAGE, SUV_STAGE, MASK_STAGE
+from .instrumentation import instrumented
+
+PLANES=(("sagittal",2,0.5),("coronal",1,2/3))
+
+def downsample_plane(plane,max_size=256):
+    """Strides a 2D plane so that its longest side is at most max_size pixels"""
+    step=max(int(np.ceil(max(plane.shape)/max_size)),1)
+    return plane[::step,::step]
+
+def extract_plane(volume,axis,index,roi=None,shape=None):
+    """Reads one plane of a (possibly memory-mapped or cropped) volume, so that only that plane is loaded
+
+    With roi, the [start,stop] pairs of the volume inside a larger frame of the given shape, the plane is
+    placed in that frame and NaN outside the region
+    """
+    if roi is None:
+        return np.asarray(np.take(volume,index,axis=axis),dtype=np.float32)
+    plane_shape=[size for i,size in enumerate(shape) if i!=axis]
+    plane=np.full(plane_shape,np.nan,dtype=np.float32)
+    start,stop=roi[axis]
+    if start<=index<stop:
+        window=tuple(slice(region_start,region_stop) for i,(region_start,region_stop) in enumerate(roi) if i!=axis)
+        plane[window]=np.take(volume,index-start,axis=axis)
+    return plane
+
+def _plane_index(volume,axis,fraction,mask=None):
+    """Returns the plane at a fraction of an axis, or the middle of the labelled extent of a (cropped) mask along it"""
+    if mask is not None:
+        labelled=np.flatnonzero(np.asarray(mask).any(axis=tuple(i for i in range(mask.ndim) if i!=axis)))
+        if labelled.size:
+            return int((labelled[0]+labelled[-1])//2)
+    return min(int(volume.shape[axis]*fraction),volume.shape[axis]-1)
+
+def _window(plane,low=1,high=99):
+    """Returns display limits from percentiles of the finite values of a plane"""
+    values=plane[np.isfinite(plane)]
+    if not values.size:
+        return 0.0,1.0
+    vmin,vmax=np.percentile(values,[low,high])
+    return float(vmin),float(vmax if vmax>vmin else vmin+1)
+
+def _open_store(store):
+    """Returns a ResultStore for a store or its root folder"""
+    return ResultStore(store) if isinstance(store,str) else store
+
+def _has_pet(store,patient_id,registration_store=None):
+    """Tells whether a patient has a PET layer to draw, in the registration store or as the SUV of a streaming store"""
+    store=_open_store(store)
+    if store.has(SEGMENTATION_STAGE,patient_id):
+        return _open_store(registration_store or store).has(REGISTRATION_STAGE,patient_id)
+    return store.has(SUV_STAGE,patient_id)
+
+def load_qa_volumes(store,patient_id,registration_store=None,ct_masks_flipped=None):
+    """Returns the CT, mask and PET of a patient as lazy views in the frame of the transformed masks, plus the PET roi
+
+    The segmentation is read from store and the registration from registration_store (by default the same
+    store, as the checkpoints of the orchestrator and python -m src keep them apart). For a streaming store,
+    which only holds the cropped masks and SUV volumes, the CT is None and the SUV takes the place of the PET.
+    The PET is None when the patient has not been registered
+    """
+    store=_open_store(store)
+    if not store.has(SEGMENTATION_STAGE,patient_id):
+        pet=store.get(SUV_STAGE,patient_id) if store.has(SUV_STAGE,patient_id) else None
+        return None,store.get(MASK_STAGE,patient_id),pet,None
+    ct_masks_flipped=config.CT_MASKS_FLIPPED if ct_masks_flipped is None else ct_masks_flipped
+    ct,mask=store.get(SEGMENTATION_STAGE,patient_id)[:2]
+    ct_plan=CUSTOM_TRANSFORM_PLAN.flipud() if ct_masks_flipped else CUSTOM_TRANSFORM_PLAN
+    ct=ct_plan.apply(ct)
+    mask=CUSTOM_TRANSFORM_PLAN.apply(mask)
+    pet=None
+    roi=None
+    registration_store=_open_store(registration_store or store)
+    if registration_store.has(REGISTRATION_STAGE,patient_id):
+        registration=registration_store.get(REGISTRATION_STAGE,patient_id)
+        pet=registration[1]
+        roi=registration[2] if len(registration)>2 else None
+    return ct,mask,pet,roi
+
+@instrumented("qa_render")
+def render_patient_qa(store_root,patient_id,output_dir,max_size=256,dpi=100,aspect=5,registration_root=None,logger=None):
+    """Writes a PNG montage of a patient's CT with the vertebra mask and PET overlays at mid-sagittal and coronal planes
+
+    Volumes are memory-mapped from the ResultStores (see load_qa_volumes) and only the drawn planes are read;
+    the figure is drawn with the Agg canvas, so no display is needed. A missing PET layer is logged when a
+    logger is given
+    """
+    ct,mask,pet,roi=load_qa_volumes(store_root,patient_id,registration_root)
+    if pet is None and logger is not None:
+        logger.warning(f"No registered PET for patient {patient_id}, its QA montage only shows the CT and mask")
+    base=ct if ct is not None else mask
+    figure=Figure(figsize=(4*len(PLANES),4))
+    FigureCanvasAgg(figure)
+    for column,(name,axis,fraction) in enumerate(PLANES):
+        index=_plane_index(base,axis,fraction,mask if ct is None else None)
+        ax=figure.add_subplot(1,len(PLANES),column+1)
+        if ct is not None:
+            ct_plane=downsample_plane(extract_plane(ct,axis,index),max_size)
+            vmin,vmax=_window(ct_plane)
+            ax.imshow(ct_plane,cmap="gray",vmin=vmin,vmax=vmax,aspect=aspect,interpolation="nearest")
+        else:
+            ax.imshow(np.zeros_like(downsample_plane(extract_plane(mask,axis,index),max_size)),cmap="gray",vmin=0,vmax=1,aspect=aspect,interpolation="nearest")
+        mask_plane=downsample_plane(extract_plane(mask,axis,index),max_size)
+        ax.imshow(np.ma.masked_equal(mask_plane,0),cmap="tab10",vmin=0,vmax=10,alpha=0.3,aspect=aspect,interpolation="nearest")
+        if pet is not None:
+            pet_plane=downsample_plane(extract_plane(pet,axis,index,roi,base.shape),max_size)
+            _,pet_max=_window(np.where(pet_plane>0,pet_plane,np.nan),0,99.5)
+            ax.imshow(np.ma.masked_invalid(np.where(pet_plane>0,pet_plane,np.nan)),cmap="hot",vmin=0,vmax=pet_max,alpha=0.4,aspect=aspect,interpolation="nearest")
+        ax.set_title(f"{patient_id} {name} {index}",fontsize=9)
+        ax.axis("off")
+    figure.tight_layout()
+    os.makedirs(output_dir,exist_ok=True)
+    path=os.path.join(output_dir,f"{patient_id}.png")
+    figure.savefig(path,dpi=dpi)
+    return path
+
+def render_cohort_qa(store,output_dir,logger,patient_ids=None,max_size=256,dpi=100,n_workers=None,max_in_flight=None,registration_store=None):
+    """Renders the QA montage of every patient of a ResultStore (or of the given ones) in worker processes
+
+    store holds the segmentations, with the registrations in registration_store (by default the same store),
+    or is a streaming store with cropped masks and SUV volumes. Patients without a PET layer are still rendered
+    and logged as a warning. Returns the written PNG paths by patient; patients that fail are logged and skipped
+    """
+    store=_open_store(store)
+    registration_store=_open_store(registration_store or store)
+    if patient_ids is None:
+        patient_ids=store.patients(SEGMENTATION_STAGE) or store.patients(MASK_STAGE)
+    n_workers=config.N_WORKERS if n_workers is None else n_workers
+    for patient_id in patient_ids:
+        if not _has_pet(store,patient_id,registration_store):
+            logger.warning(f"No registered PET for patient {patient_id}, its QA montage only shows the CT and mask")
+    tasks=[(patient_id,(store.root,patient_id,output_dir,max_size,dpi,5,registration_store.root)) for patient_id in patient_ids]
+    return dict(map_patients(render_patient_qa,tasks,logger,n_workers=n_workers,max_in_flight=max_in_flight))
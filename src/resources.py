@@ -0,0 +1,179 @@
+import os
+import sys
+from contextlib import contextmanager
+from . import config
+from .dicom_index import get_series_index
+
+THREAD_ENVIRONMENT_VARIABLES=[
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS",
+    "nnUNet_def_n_proc",
+    "nnUNet_n_proc_DA"
+]
+
+def available_memory_bytes():
+    """Returns the physical memory of the machine, or None where it cannot be read"""
+    try:
+        return os.sysconf('SC_PHYS_PAGES')*os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError,ValueError,OSError):
+        return None
+
+class ResourceBudget:
+    def __init__(self,cores=None,memory_bytes=None):
+        """Total cores and RAM that the concurrently running patients may use
+
+        By default the cores are config.CPU_CORES or all cores, and the memory is config.MEMORY_BUDGET_BYTES
+        or config.MEMORY_BUDGET_FRACTION of the physical memory (None when unknown, which disables admission)
+        """
+        cores=config.CPU_CORES if cores is None else cores
+        self.cores=max(int(cores or os.cpu_count() or 1),1)
+        if memory_bytes is None:
+            memory_bytes=config.MEMORY_BUDGET_BYTES
+        if memory_bytes is None:
+            physical=available_memory_bytes()
+            memory_bytes=int(physical*config.MEMORY_BUDGET_FRACTION) if physical else None
+        self.memory_bytes=memory_bytes
+
+    def threads_per_task(self,n_workers):
+        """Returns the threads each of n_workers concurrent tasks may use without oversubscribing the cores"""
+        return max(self.cores//max(n_workers or 1,1),1)
+
+    def fits(self,in_use,estimate):
+        """Tells whether a task with the given memory estimate can start while in_use bytes are reserved"""
+        return self.memory_bytes is None or in_use+(estimate or 0)<=self.memory_bytes
+
+    def __repr__(self):
+        return f"ResourceBudget(cores={self.cores}, memory_bytes={self.memory_bytes})"
+
+def thread_limit_environment(n_threads):
+    """Returns the environment variables limiting BLAS, OpenMP, ITK and nnU-Net threads to n_threads"""
+    return {name:str(n_threads) for name in THREAD_ENVIRONMENT_VARIABLES}
+
+def _limit_thread_pools(n_threads):
+    """Limits the BLAS and OpenMP thread pools already loaded in the process, e.g. NumPy's, with threadpoolctl
+
+    Returns the threadpool_limits object, whose restore_original_limits() undoes the limit, or None without threadpoolctl
+    """
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return None
+    return threadpool_limits(limits=n_threads)
+
+def apply_thread_limits(n_threads):
+    """Limits every threaded library of the pipeline to n_threads in the current process
+
+    BLAS and OpenMP libraries already loaded, such as NumPy's (also in pool workers forked after import numpy),
+    are limited with threadpoolctl, since they only read the environment variables when they load; the variables
+    reach libraries loaded later and the TotalSegmentator subprocess. SimpleITK, OpenCV and torch are configured
+    directly when importable; torch is only configured if it was already imported, so that this does not pull it in.
+    Volume decoding uses config.DECODE_THREADS.
+    """
+    n_threads=max(int(n_threads),1)
+    os.environ.update(thread_limit_environment(n_threads))
+    _limit_thread_pools(n_threads)
+    config.DECODE_THREADS=n_threads
+    try:
+        import SimpleITK as sitk
+        sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(n_threads)
+    except ImportError:
+        pass
+    try:
+        import cv2
+        cv2.setNumThreads(n_threads)
+    except ImportError:
+        pass
+    torch=sys.modules.get('torch')
+    if torch is not None and hasattr(torch,'set_num_threads'):
+        torch.set_num_threads(n_threads)
+    return n_threads
+
+def _library_thread_counts():
+    """Returns the current thread counts of the libraries that apply_thread_limits configures directly"""
+    counts={}
+    try:
+        import SimpleITK as sitk
+        counts['SimpleITK']=sitk.ProcessObject.GetGlobalDefaultNumberOfThreads()
+    except ImportError:
+        pass
+    try:
+        import cv2
+        counts['cv2']=cv2.getNumThreads()
+    except ImportError:
+        pass
+    torch=sys.modules.get('torch')
+    if torch is not None and hasattr(torch,'get_num_threads'):
+        counts['torch']=torch.get_num_threads()
+    return counts
+
+@contextmanager
+def thread_limits(n_threads):
+    """Applies apply_thread_limits for the duration of a block, then restores the environment, config and libraries"""
+    environment={name:os.environ.get(name) for name in THREAD_ENVIRONMENT_VARIABLES}
+    decode_threads=config.DECODE_THREADS
+    counts=_library_thread_counts()
+    thread_pools=_limit_thread_pools(max(int(n_threads),1))
+    try:
+        yield apply_thread_limits(n_threads)
+    finally:
+        if thread_pools is not None:
+            thread_pools.restore_original_limits()
+        for name,value in environment.items():
+            if value is None:
+                os.environ.pop(name,None)
+            else:
+                os.environ[name]=value
+        config.DECODE_THREADS=decode_threads
+        if 'SimpleITK' in counts:
+            import SimpleITK as sitk
+            sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(counts['SimpleITK'])
+        if 'cv2' in counts:
+            import cv2
+            cv2.setNumThreads(counts['cv2'])
+        if 'torch' in counts:
+            sys.modules['torch'].set_num_threads(counts['torch'])
+
+def series_voxel_counts(folder_path):
+    """Returns the voxel count of every series of a patient folder by (Modality, SeriesNumber), from headers only"""
+    counts={}
+    for record in get_series_index(folder_path).records:
+        if not record['readable'] or not record.get('HasPixelData') or not record.get('Rows') or not record.get('Columns'):
+            continue
+        key=(record.get('Modality'),record.get('SeriesNumber'))
+        counts[key]=counts.get(key,0)+record['Rows']*record['Columns']*(record.get('NumberOfFrames') or 1)
+    return counts
+
+def estimate_patient_memory(folder_path):
+    """Estimates the peak memory of one patient from the voxel counts of its largest CT and PET series
+
+    The volumes derived from the CT (resampled PET, masks, SUV) all live on the CT grid, so the estimate is
+    config.MEMORY_BYTES_PER_CT_VOXEL per CT voxel plus config.MEMORY_BYTES_PER_PET_VOXEL per PET voxel, plus
+    the decoded float32 series that the volume cache holds until the patient ends, up to config.VOLUME_CACHE_BYTES
+    """
+    ct_voxels=0
+    pet_voxels=0
+    for (modality,_),voxels in series_voxel_counts(folder_path).items():
+        if modality=='PT':
+            pet_voxels=max(pet_voxels,voxels)
+        else:
+            ct_voxels=max(ct_voxels,voxels)
+    cache_bytes=min(4*(ct_voxels+pet_voxels),config.VOLUME_CACHE_BYTES or 0)
+    return ct_voxels*config.MEMORY_BYTES_PER_CT_VOXEL+pet_voxels*config.MEMORY_BYTES_PER_PET_VOXEL+cache_bytes
+
+def estimate_task_memory(data_folder,tasks):
+    """Returns the memory estimate of each (patient_id,args) task, 0 for folders that cannot be scanned"""
+    estimates={}
+    for patient_id,_ in tasks:
+        try:
+            estimates[patient_id]=estimate_patient_memory(os.path.join(data_folder,patient_id))
+        except OSError:
+            estimates[patient_id]=0
+    return estimates
+
+def largest_first(tasks,estimates):
+    """Orders tasks by decreasing memory estimate, keeping the listing order between equal estimates"""
+    return sorted(tasks,key=lambda task: -(estimates.get(task[0]) or 0))
@@ -0,0 +1,237 @@
+import os
+import json
+import shutil
+from datetime import datetime
+from collections.abc import Mapping
+import numpy as np
+
+SEGMENTATION_STAGE="segmentation"
+REGISTRATION_STAGE="registration"
+METADATA_STAGE="metadata"
+SUV_STAGE="suv"
+MASK_STAGE="masks"
+STATISTICS_STAGE="statistics"
+MANIFEST_FILENAME="manifest.json"
+COMMIT_LOG_FILENAME="commits.jsonl"
+
+def _fsync_path(path):
+    """Flushes a file or directory to disk, ignoring platforms that cannot open directories"""
+    try:
+        fd=os.open(path,os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def _encode_value(value,entry_path,counter):
+    """Encodes a value into a JSON-serializable description, writing arrays as .npy files"""
+    if isinstance(value,np.ndarray):
+        filename=f"array_{len(counter)}.npy"
+        counter.append(filename)
+        np.save(os.path.join(entry_path,filename),np.ascontiguousarray(value),allow_pickle=False)
+        return {'kind':'array','file':filename}
+    if isinstance(value,(list,tuple)):
+        return {'kind':'list','items':[_encode_value(v,entry_path,counter) for v in value]}
+    if isinstance(value,dict):
+        return {
+            'kind':'dict',
+            'keys':[k.item() if isinstance(k,np.generic) else k for k in value],
+            'values':[_encode_value(v,entry_path,counter) for v in value.values()]
+        }
+    if isinstance(value,datetime):
+        return {'kind':'datetime','value':value.isoformat()}
+    if isinstance(value,np.generic):
+        return {'kind':'scalar','value':value.item()}
+    return {'kind':'scalar','value':value}
+
+def _decode_value(description,entry_path,mmap):
+    """Rebuilds a value from its description, opening arrays as read-only memory maps if requested"""
+    kind=description['kind']
+    if kind=='array':
+        return np.load(os.path.join(entry_path,description['file']),mmap_mode='r' if mmap else None,allow_pickle=False)
+    if kind=='list':
+        return [_decode_value(v,entry_path,mmap) for v in description['items']]
+    if kind=='dict':
+        return {k:_decode_value(v,entry_path,mmap) for k,v in zip(description['keys'],description['values'])}
+    if kind=='datetime':
+        return datetime.fromisoformat(description['value'])
+    return description['value']
+
+class ResultStore:
+    def __init__(self,root):
+        """On-disk store holding one entry per patient and stage, with arrays saved as raw .npy files
+
+        Every entry is written and flushed in a temporary directory, renamed into place and only then
+        recorded in the stage's append-only commit log, which alone decides which patients are complete.
+        """
+        self.root=root
+        self._commit_cache={}
+
+    def entry_path(self,stage,patient_id):
+        """Returns the directory of a patient's entry for a stage"""
+        return os.path.join(self.root,stage,str(patient_id))
+
+    def commit_log_path(self,stage):
+        """Returns the path of the append-only commit log of a stage"""
+        return os.path.join(self.root,stage,COMMIT_LOG_FILENAME)
+
+    def _scan_entries(self,stage):
+        """Lists the patients with an entry manifest on disk, for stores written before the commit log existed"""
+        stage_path=os.path.join(self.root,stage)
+        if not os.path.isdir(stage_path):
+            return []
+        return sorted(
+            name for name in os.listdir(stage_path)
+            if '.tmp-' not in name and '.old-' not in name and os.path.exists(os.path.join(stage_path,name,MANIFEST_FILENAME))
+        )
+
+    def _append_commit(self,stage,patient_id,removed=False):
+        """Appends a patient, or its removal, to the commit log of a stage and flushes it to disk"""
+        log_path=self.commit_log_path(stage)
+        if not os.path.exists(log_path):
+            lines=[json.dumps({'patient_id':name})+"\n" for name in self._scan_entries(stage) if name!=str(patient_id)]
+        else:
+            lines=[]
+        if removed:
+            lines.append(json.dumps({'patient_id':str(patient_id),'removed':datetime.now().isoformat()})+"\n")
+        else:
+            lines.append(json.dumps({'patient_id':str(patient_id),'committed':datetime.now().isoformat()})+"\n")
+        with open(log_path,'a+b') as file:
+            if file.tell()>0:
+                file.seek(-1,os.SEEK_END)
+                if file.read(1)!=b"\n":
+                    lines.insert(0,"\n")
+            file.write("".join(lines).encode())
+            file.flush()
+            os.fsync(file.fileno())
+
+    def put(self,stage,patient_id,value):
+        """Writes a patient's result for a stage, replacing any previous entry, and commits it to the stage log
+
+        A previous entry is renamed aside before the new one takes its place and only deleted afterwards,
+        so a crash at any point leaves either entry readable (see _recover_entry)
+        """
+        final_path=self.entry_path(stage,patient_id)
+        temp_path=f"{final_path}.tmp-{os.getpid()}"
+        if os.path.exists(temp_path):
+            shutil.rmtree(temp_path)
+        os.makedirs(temp_path)
+        files=[]
+        description=_encode_value(value,temp_path,files)
+        with open(os.path.join(temp_path,MANIFEST_FILENAME),'w') as file:
+            json.dump({'patient_id':str(patient_id),'stage':stage,'value':description},file)
+            file.flush()
+            os.fsync(file.fileno())
+        for filename in files:
+            _fsync_path(os.path.join(temp_path,filename))
+        old_path=f"{final_path}.old-{os.getpid()}"
+        if os.path.exists(old_path):
+            shutil.rmtree(old_path)
+        if os.path.exists(final_path):
+            os.replace(final_path,old_path)
+        os.replace(temp_path,final_path)
+        _fsync_path(os.path.dirname(final_path))
+        self._append_commit(stage,patient_id)
+        shutil.rmtree(old_path,ignore_errors=True)
+
+    def _recover_entry(self,stage,patient_id):
+        """Moves back a previous entry left aside by a put() interrupted before the new entry took its place"""
+        final_path=self.entry_path(stage,patient_id)
+        stage_path=os.path.dirname(final_path)
+        prefix=os.path.basename(final_path)+".old-"
+        for name in sorted(os.listdir(stage_path)) if os.path.isdir(stage_path) else []:
+            if name.startswith(prefix) and os.path.exists(os.path.join(stage_path,name,MANIFEST_FILENAME)):
+                try:
+                    os.replace(os.path.join(stage_path,name),final_path)
+                except OSError:
+                    continue
+                return True
+        return False
+
+    def _commit_index(self,stage):
+        """Returns the committed patients of a stage as an ordered dictionary, re-reading the log only when it changed"""
+        log_path=self.commit_log_path(stage)
+        try:
+            stat=os.stat(log_path)
+        except FileNotFoundError:
+            return dict.fromkeys(self._scan_entries(stage))
+        key=(stat.st_mtime_ns,stat.st_size)
+        cached=self._commit_cache.get(stage)
+        if cached is not None and cached[0]==key:
+            return cached[1]
+        patients={}
+        with open(log_path,'r') as file:
+            for line in file:
+                try:
+                    record=json.loads(line)
+                    if 'removed' in record:
+                        patients.pop(record['patient_id'],None)
+                    else:
+                        patients.setdefault(record['patient_id'],None)
+                except (ValueError,KeyError,TypeError):
+                    continue
+        self._commit_cache[stage]=(key,patients)
+        return patients
+
+    def has(self,stage,patient_id):
+        """Checks whether the patient is committed for the stage"""
+        return str(patient_id) in self._commit_index(stage)
+
+    def get(self,stage,patient_id,mmap=True):
+        """Reads a single patient's result for a stage without touching the other patients"""
+        entry_path=self.entry_path(stage,patient_id)
+        if not os.path.exists(entry_path):
+            self._recover_entry(stage,patient_id)
+        with open(os.path.join(entry_path,MANIFEST_FILENAME),'r') as file:
+            manifest=json.load(file)
+        return _decode_value(manifest['value'],entry_path,mmap)
+
+    def patients(self,stage):
+        """Lists the committed patients of a stage in commit order, reading only the commit log"""
+        return list(self._commit_index(stage))
+
+    def remove(self,stage,patient_id):
+        """Uncommits a patient from a stage by logging its removal, then deletes its entry"""
+        if not self.has(stage,patient_id):
+            return
+        self._append_commit(stage,patient_id,removed=True)
+        shutil.rmtree(self.entry_path(stage,patient_id),ignore_errors=True)
+
+    def clear(self,stage):
+        """Removes every entry of a stage, including its commit log"""
+        shutil.rmtree(os.path.join(self.root,stage),ignore_errors=True)
+        self._commit_cache.pop(stage,None)
+
+    def stage(self,stage,mmap=True):
+        """Returns a lazy, dictionary-like view of all patients of a stage"""
+        return StageView(self,stage,mmap=mmap)
+
+    def put_all(self,stage,result_dict):
+        """Writes every patient of a result dictionary to the stage"""
+        for patient_id,value in result_dict.items():
+            self.put(stage,patient_id,value)
+
+class StageView(Mapping):
+    def __init__(self,store,stage,mmap=True):
+        """Read-only mapping from patient ID to result that opens each entry only when accessed"""
+        self.store=store
+        self.stage_name=stage
+        self.mmap=mmap
+
+    def __getitem__(self,patient_id):
+        if not self.store.has(self.stage_name,patient_id):
+            raise KeyError(patient_id)
+        return self.store.get(self.stage_name,patient_id,mmap=self.mmap)
+
+    def __contains__(self,patient_id):
+        return self.store.has(self.stage_name,patient_id)
+
+    def __iter__(self):
+        return iter(self.store.patients(self.stage_name))
+
+    def __len__(self):
+        return len(self.store.patients(self.stage_name))
@@ -0,0 +1,296 @@
+import os
+import queue
+import atexit
+import itertools
+import threading
+import subprocess
+import multiprocessing
+from abc import ABC, abstractmethod
+import numpy as np
+from . import config
+from .dicom_index import get_series_index
+from .volume_assembly import assemble_volume
+from .label_maps import write_label_masks
+
+PYTHON_API_ALIASES={'ta':'task','rs':'roi_subset','nr':'nr_thr_resamp','ns':'nr_thr_saving','d':'device'}
+STAND_IN_BONE_HU=300
+PREDICTOR_STATE=("plans_manager","configuration_manager","list_of_parameters","network","dataset_json","trainer_name","allowed_mirroring_axes","label_manager")
+
+def build_totalsegmentator_arguments(options=None):
+    """Converts a dictionary of TotalSegmentator options into command-line arguments"""
+    arguments=[]
+    for flag,value in sorted((options or {}).items()):
+        if value is None or value is False:
+            continue
+        if value is True:
+            arguments.append(flag)
+        elif isinstance(value,(list,tuple)):
+            arguments.extend([flag,*[str(v) for v in value]])
+        else:
+            arguments.extend([flag,str(value)])
+    return arguments
+
+def build_python_api_arguments(options=None):
+    """Converts a dictionary of TotalSegmentator command-line options into python_api keyword arguments"""
+    arguments={}
+    for flag,value in (options or {}).items():
+        if value is None or value is False:
+            continue
+        name=flag.lstrip('-')
+        arguments[PYTHON_API_ALIASES.get(name,name.replace('-','_'))]=value
+    return arguments
+
+def _label_paths(output_path):
+    """Returns the vertebra label maps written in an output folder"""
+    return sorted(
+        os.path.join(output_path,filename) for filename in os.listdir(output_path)
+        if filename.startswith("vertebrae_") and filename.endswith(".nii.gz")
+    )
+
+def reuse_initialized_predictors(predictor_class,predictors):
+    """Makes predictor_class take the network and weights of an earlier predictor initialized from the same model
+
+    TotalSegmentator builds a new nnUNetPredictor for every input and reads the checkpoints again; with this,
+    only the first input per model folder, folds, checkpoint and device reads them, and predictors keeps them
+    """
+    initialize=getattr(predictor_class.initialize_from_trained_model_folder,'__wrapped__',predictor_class.initialize_from_trained_model_folder)
+    def initialize_once(predictor,model_training_output_dir,use_folds,checkpoint_name="checkpoint_final.pth"):
+        folds=tuple(use_folds) if isinstance(use_folds,(list,tuple)) else use_folds
+        key=(os.path.abspath(model_training_output_dir),folds,checkpoint_name,str(getattr(predictor,'device',None)))
+        if key not in predictors:
+            initialize(predictor,model_training_output_dir,use_folds,checkpoint_name)
+            predictors[key]={name:getattr(predictor,name) for name in PREDICTOR_STATE if hasattr(predictor,name)}
+        for name,value in predictors[key].items():
+            setattr(predictor,name,value)
+    initialize_once.__wrapped__=initialize
+    predictor_class.initialize_from_trained_model_folder=initialize_once
+
+class SegmentationBackend(ABC):
+    """Interface of the segmentation engines: load() once per process, then segment() any number of inputs"""
+    name=None
+    model="totalsegmentator"
+    worker_backend=None
+
+    def load(self):
+        """Loads the model; called once before the first segmentation"""
+
+    @abstractmethod
+    def segment(self,input_path,output_path,options=None,roi_subset=None):
+        """Segments the DICOM folder input_path into one vertebrae_<name>.nii.gz per vertebra and returns their paths"""
+
+class CommandLineBackend(SegmentationBackend):
+    """Runs the TotalSegmentator command-line tool in a fresh subprocess for every input
+
+    A subprocess cannot stay warm, so the segmentation worker runs the same model through python_api instead
+    """
+    name="command"
+    worker_backend="python_api"
+
+    def segment(self,input_path,output_path,options=None,roi_subset=None):
+        arguments=build_totalsegmentator_arguments(options)
+        if roi_subset:
+            arguments.extend(["--roi_subset",*roi_subset])
+        subprocess.run(["TotalSegmentator","-i",input_path,"-o",output_path,*arguments],check=True)
+        return _label_paths(output_path)
+
+class PythonApiBackend(SegmentationBackend):
+    """Calls totalsegmentator.python_api in-process and keeps its initialized nnU-Net predictors, so torch,
+    nnU-Net and the model weights are loaded once per process rather than once per input
+    """
+    name="python_api"
+
+    def __init__(self):
+        self.totalsegmentator=None
+        self.predictors={}
+
+    def load(self):
+        from totalsegmentator.python_api import totalsegmentator
+        from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+        reuse_initialized_predictors(nnUNetPredictor,self.predictors)
+        self.totalsegmentator=totalsegmentator
+
+    def segment(self,input_path,output_path,options=None,roi_subset=None):
+        if self.totalsegmentator is None:
+            self.load()
+        arguments=build_python_api_arguments(options)
+        if roi_subset:
+            arguments['roi_subset']=list(roi_subset)
+        self.totalsegmentator(input_path,output_path,**arguments)
+        return _label_paths(output_path)
+
+class StandInBackend(SegmentationBackend):
+    """Lightweight CPU stand-in that splits the bone of the spinal region into equal blocks, one per vertebra
+
+    Meant for test machines without the model; the outputs have the names and orientation of TotalSegmentator's
+    """
+    name="stand_in"
+    model="stand_in"
+
+    def segment(self,input_path,output_path,options=None,roi_subset=None):
+        records=get_series_index(input_path).select(require_pixels=True,require_position=True)
+        if not records:
+            raise FileNotFoundError("No DICOM files found for segmentation")
+        records=sorted(records,key=lambda record: record['ImagePositionPatient'][2])
+        volume=assemble_volume(records)
+        vertebrae=config.VERTEBRAE
+        if roi_subset:
+            vertebrae=[vert for vert in vertebrae if f"vertebrae_{vert}" in roi_subset]
+        labels=np.zeros(volume.shape,dtype=np.uint8)
+        bone=volume>STAND_IN_BONE_HU
+        slices=np.flatnonzero(bone.any(axis=(1,2)))
+        if slices.size and vertebrae:
+            bounds=np.linspace(slices[0],slices[-1]+1,len(vertebrae)+1).astype(int)
+            for label,(start,stop) in enumerate(zip(bounds[:-1],bounds[1:]),start=1):
+                labels[start:stop][bone[start:stop]]=label
+        spacing=(records[0]['SliceThickness'] or 1.0,*records[0]['PixelSpacing'])
+        return write_label_masks(output_path,labels,spacing,vertebrae)
+
+BACKENDS={backend.name:backend for backend in (CommandLineBackend,PythonApiBackend,StandInBackend)}
+_loaded_backends={}
+
+def register_backend(backend_class):
+    """Registers a SegmentationBackend subclass under its name, for config.SEGMENTATION_BACKEND"""
+    if backend_class.__abstractmethods__:
+        raise TypeError(f"Segmentation backend {backend_class.name} does not implement {', '.join(sorted(backend_class.__abstractmethods__))}")
+    BACKENDS[backend_class.name]=backend_class
+    return backend_class
+
+def get_backend(name=None):
+    """Returns the loaded backend of the given name (config.SEGMENTATION_BACKEND by default), loading it once per process"""
+    name=config.SEGMENTATION_BACKEND if name is None else name
+    if name not in _loaded_backends:
+        if name not in BACKENDS:
+            raise ValueError(f"Unknown segmentation backend: {name}")
+        backend=BACKENDS[name]()
+        backend.load()
+        _loaded_backends[name]=backend
+    return _loaded_backends[name]
+
+def worker_backend_name(name=None):
+    """Returns the backend the segmentation worker runs for a configured backend, which may keep its model warm in-process"""
+    name=config.SEGMENTATION_BACKEND if name is None else name
+    return getattr(BACKENDS.get(name),'worker_backend',None) or name
+
+def _serve(backend_name,jobs,results):
+    """Loads the backend once, then segments the jobs of the queue until it receives None"""
+    try:
+        backend=get_backend(backend_name)
+    except Exception as e:
+        results.put((None,None,f"{type(e).__name__}: {e}"))
+        return
+    results.put((None,[],None))
+    for job_id,input_path,output_path,options,roi_subset in iter(jobs.get,None):
+        try:
+            results.put((job_id,backend.segment(input_path,output_path,options,roi_subset),None))
+        except Exception as e:
+            results.put((job_id,None,f"{type(e).__name__}: {e}"))
+
+class SegmentationWorker:
+    def __init__(self,backend=None,timeout=None):
+        """Long-lived process that keeps a segmentation backend loaded and serves jobs over local queues"""
+        self.backend=worker_backend_name(backend)
+        self.timeout=config.SEGMENTATION_WORKER_TIMEOUT if timeout is None else timeout
+        self.process=None
+        self._jobs=None
+        self._results=None
+        self._job_ids=itertools.count()
+        self._lock=threading.Lock()
+
+    def start(self):
+        """Starts the worker process and waits until its backend is loaded"""
+        if self.is_alive():
+            return self
+        self._jobs=multiprocessing.Queue()
+        self._results=multiprocessing.Queue()
+        self.process=multiprocessing.Process(target=_serve,args=(self.backend,self._jobs,self._results),daemon=True)
+        self.process.start()
+        _,_,error=self._wait_result()
+        if error is not None:
+            self.stop()
+            raise RuntimeError(f"Segmentation backend {self.backend} failed to load: {error}")
+        return self
+
+    def is_alive(self):
+        """Tells whether the worker process is running"""
+        return self.process is not None and self.process.is_alive()
+
+    def _wait_result(self):
+        """Waits for the next result; if the worker dies or the timeout expires it is discarded, so the next job restarts it"""
+        waited=0.0
+        while True:
+            try:
+                return self._results.get(timeout=1.0)
+            except queue.Empty:
+                waited+=1.0
+                if not self.process.is_alive():
+                    exitcode=self.process.exitcode
+                    self._discard()
+                    raise RuntimeError(f"Segmentation worker exited with code {exitcode}")
+                if self.timeout is not None and waited>=self.timeout:
+                    self._discard()
+                    raise TimeoutError("Segmentation worker did not answer in time")
+
+    def _discard(self):
+        """Terminates the worker and drains and closes its queues, so that no late reply reaches a later job"""
+        if self.process is not None and self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.process=None
+        for job_queue in (self._jobs,self._results):
+            if job_queue is None:
+                continue
+            try:
+                while True:
+                    job_queue.get_nowait()
+            except (queue.Empty,OSError,ValueError):
+                pass
+            job_queue.cancel_join_thread()
+            job_queue.close()
+        self._jobs=None
+        self._results=None
+
+    def segment(self,input_path,output_path,options=None,roi_subset=None):
+        """Segments one input in the worker and returns the paths of the written label maps"""
+        with self._lock:
+            self.start()
+            job_id=next(self._job_ids)
+            self._jobs.put((job_id,input_path,output_path,options,list(roi_subset) if roi_subset else None))
+            result_id,paths,error=self._wait_result()
+        if error is not None:
+            raise RuntimeError(f"Segmentation failed: {error}")
+        if result_id!=job_id:
+            raise RuntimeError(f"Segmentation worker answered job {result_id} instead of {job_id}")
+        return paths
+
+    def stop(self):
+        """Asks the worker to finish and waits for it"""
+        if self.process is None:
+            return
+        if self.process.is_alive():
+            self._jobs.put(None)
+            self.process.join(timeout=10)
+        self._discard()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.stop()
+
+_worker=None
+
+def get_segmentation_worker():
+    """Returns this process's warm segmentation worker, starting it on first use"""
+    global _worker
+    if _worker is None or _worker.backend!=worker_backend_name():
+        if _worker is not None:
+            _worker.stop()
+        _worker=SegmentationWorker()
+        atexit.register(_worker.stop)
+    return _worker
+
+def segment_with_backend(input_path,output_path,options=None,roi_subset=None):
+    """Segments one input with config.SEGMENTATION_BACKEND, in the warm worker when config.SEGMENTATION_WORKER is set"""
+    if config.SEGMENTATION_WORKER:
+        return get_segmentation_worker().segment(input_path,output_path,options,roi_subset)
+    return get_backend().segment(input_path,output_path,options,roi_subset)
@@ -0,0 +1,330 @@
+import os
+import sys
+import json
+import time
+import socket
+import hashlib
+import logging
+import argparse
+import multiprocessing
+from collections.abc import Mapping
+from datetime import datetime
+from . import config
+from .io_utils import save_dictionary_to_file
+from .parallel import map_patients
+from .result_store import ResultStore, SUV_STAGE, MASK_STAGE, STATISTICS_STAGE
+from .orchestrator import _stream_patient, collect_streamed_statistics
+from .instrumentation import start_run, log_metrics_summary
+
+MANIFEST_FILENAME="cohort_manifest.json"
+MANIFEST_VERSION=1
+
+def shard_of(patient_id,n_shards):
+    """Returns the shard of a patient from a stable hash of its ID, the same on every machine and Python process"""
+    return int(hashlib.sha1(str(patient_id).encode()).hexdigest()[:16],16)%n_shards
+
+def resolve_excluded_ids(patient_ids,exclude_indices=None,exclude_ids=None):
+    """Turns positional exclusions of a listing (config.EXCLUDE_PATIENTS_PET/SUV by default) into patient IDs"""
+    if exclude_indices is None:
+        exclude_indices=set(config.EXCLUDE_PATIENTS_PET)|set(config.EXCLUDE_PATIENTS_SUV)
+    exclude_ids=config.EXCLUDE_PATIENT_IDS if exclude_ids is None else exclude_ids
+    exclude_indices=set(exclude_indices)
+    excluded={patient_id for i,patient_id in enumerate(patient_ids) if i in exclude_indices}
+    return sorted(excluded|{str(patient_id) for patient_id in exclude_ids})
+
+def load_or_create_manifest(root,data_folder,n_shards,limit=None,exclude_indices=None,exclude_ids=None):
+    """Returns the cohort manifest shared by all shards, creating it from this machine's listing if none exists
+
+    The first process to link its manifest into place wins, so every shard uses the same patient order and the
+    same excluded IDs even if the listing order differs between machines
+    """
+    path=os.path.join(root,MANIFEST_FILENAME)
+    if not os.path.exists(path):
+        os.makedirs(root,exist_ok=True)
+        patient_ids=os.listdir(data_folder)
+        patient_ids=patient_ids[:limit] if limit is not None else patient_ids
+        manifest={
+            'version':MANIFEST_VERSION,'data_folder':os.path.abspath(data_folder),'n_shards':n_shards,
+            'patients':patient_ids,'excluded':resolve_excluded_ids(patient_ids,exclude_indices,exclude_ids),
+            'created':datetime.now().isoformat()
+        }
+        temp_path=f"{path}.{socket.gethostname()}.{os.getpid()}.tmp"
+        with open(temp_path,'w') as file:
+            json.dump(manifest,file)
+            file.flush()
+            os.fsync(file.fileno())
+        try:
+            os.link(temp_path,path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(temp_path)
+    with open(path,'r') as file:
+        manifest=json.load(file)
+    if manifest['n_shards']!=n_shards:
+        raise ValueError(f"The manifest in {root} was created for {manifest['n_shards']} shards, not {n_shards}")
+    return manifest
+
+def cohort_patients(manifest):
+    """Returns the patients of the manifest that are not excluded, in manifest order"""
+    excluded=set(manifest['excluded'])
+    return [patient_id for patient_id in manifest['patients'] if patient_id not in excluded]
+
+def shard_patients(manifest,shard_index):
+    """Returns the patients of a shard in manifest order, without the excluded ones"""
+    return [patient_id for patient_id in cohort_patients(manifest) if shard_of(patient_id,manifest['n_shards'])==shard_index]
+
+def shard_store_path(root,shard_index):
+    """Returns the ResultStore folder of a shard"""
+    return os.path.join(root,"shards",f"{shard_index:04d}")
+
+def _lock_path(root,patient_id):
+    """Returns the lock file of a patient"""
+    return os.path.join(root,"locks",f"{patient_id}.lock")
+
+def _shard_lock_path(root,shard_index):
+    """Returns the lock file held by the process running a shard"""
+    return shard_store_path(root,shard_index)+".lock"
+
+def _lock_owner():
+    """Returns the host and process that lock files are written by"""
+    return {'host':socket.gethostname(),'pid':os.getpid()}
+
+def acquire_lock(path,timeout=None):
+    """Creates a lock file with O_EXCL, taking over one older than timeout seconds; returns whether it succeeded
+
+    A stale lock is renamed to a name unique to this process, then checked to be the file found stale (same
+    inode and mtime). If another process replaced it in between, the fresh lock is linked back and the claim
+    fails, so a live lock is never taken over
+    """
+    timeout=config.SHARD_LOCK_TIMEOUT if timeout is None else timeout
+    os.makedirs(os.path.dirname(path),exist_ok=True)
+    owner=json.dumps(dict(_lock_owner(),claimed=datetime.now().isoformat())).encode()
+    for _ in range(2):
+        try:
+            fd=os.open(path,os.O_CREAT|os.O_EXCL|os.O_WRONLY,0o644)
+        except FileExistsError:
+            try:
+                found=os.stat(path)
+            except FileNotFoundError:
+                continue
+            if timeout is None or time.time()-found.st_mtime<timeout:
+                return False
+            stale_path=f"{path}.stale-{socket.gethostname()}-{os.getpid()}"
+            try:
+                os.replace(path,stale_path)
+            except FileNotFoundError:
+                continue
+            taken=os.stat(stale_path)
+            if (taken.st_ino,taken.st_mtime_ns)!=(found.st_ino,found.st_mtime_ns):
+                try:
+                    os.link(stale_path,path)
+                except FileExistsError:
+                    pass
+                os.remove(stale_path)
+                return False
+            os.remove(stale_path)
+            continue
+        try:
+            os.write(fd,owner)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        return True
+    return False
+
+def refresh_lock(path):
+    """Renews the mtime of a held lock, so that long runs are not taken for stale"""
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+
+def release_lock(path):
+    """Removes a lock file if this process holds it, leaving alone a lock that was taken over"""
+    try:
+        with open(path,'r') as file:
+            owner=json.load(file)
+    except FileNotFoundError:
+        return
+    except ValueError:
+        owner={}
+    if {key:owner.get(key) for key in ('host','pid')}==_lock_owner():
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def claim_patient(root,patient_id,timeout=None):
+    """Claims a patient with a lock file (see acquire_lock); returns whether it succeeded"""
+    return acquire_lock(_lock_path(root,patient_id),timeout)
+
+def release_patient(root,patient_id):
+    """Removes the lock file of a patient held by this process"""
+    release_lock(_lock_path(root,patient_id))
+
+def _run_claimed_patient(root,store_root,data_folder,patient_id,padding,percentiles,dtype):
+    """Runs one patient of a shard if no other process holds it, and returns its statistics record or None"""
+    store=ResultStore(store_root)
+    if store.has(STATISTICS_STAGE,patient_id):
+        return store.get(STATISTICS_STAGE,patient_id,mmap=False)
+    if not claim_patient(root,patient_id):
+        return None
+    try:
+        if store.has(STATISTICS_STAGE,patient_id):
+            return store.get(STATISTICS_STAGE,patient_id,mmap=False)
+        return _stream_patient(data_folder,patient_id,padding,percentiles,dtype,store,True)
+    finally:
+        release_patient(root,patient_id)
+
+def run_shard(data_folder,root,shard_index,n_shards,logger,limit=None,exclude_indices=None,exclude_ids=None,
+              padding=None,percentiles=None,dtype=None,n_workers=None,max_in_flight=None):
+    """Streams the patients of one shard into the shard's own ResultStore and returns the IDs it committed
+
+    The process holds the shard's lock for the whole run, so each shard store has a single writer; another
+    process started on the same shard returns at once. Each patient is also claimed with its own lock file,
+    and patients already committed are skipped, so a shard can simply be restarted after a failure
+    """
+    shard_lock=_shard_lock_path(root,shard_index)
+    if not acquire_lock(shard_lock):
+        logger.info(f"Shard {shard_index}/{n_shards} is being run by another process")
+        return []
+    try:
+        return _run_locked_shard(data_folder,root,shard_index,n_shards,logger,shard_lock,limit,exclude_indices,exclude_ids,
+                                 padding,percentiles,dtype,n_workers,max_in_flight)
+    finally:
+        release_lock(shard_lock)
+
+def _run_locked_shard(data_folder,root,shard_index,n_shards,logger,shard_lock,limit,exclude_indices,exclude_ids,
+                      padding,percentiles,dtype,n_workers,max_in_flight):
+    """Runs the patients of a shard whose lock this process holds, renewing the lock after each patient"""
+    start_run()
+    manifest=load_or_create_manifest(root,data_folder,n_shards,limit,exclude_indices,exclude_ids)
+    padding=config.PADDING if padding is None else padding
+    n_workers=config.N_WORKERS if n_workers is None else n_workers
+    store_root=shard_store_path(root,shard_index)
+    tasks=[
+        (patient_id,(root,store_root,data_folder,patient_id,padding,percentiles,dtype))
+        for patient_id in shard_patients(manifest,shard_index)
+    ]
+    logger.info(f"Shard {shard_index}/{n_shards}: {len(tasks)} patients")
+    committed=[]
+    for patient_id,record in map_patients(_run_claimed_patient,tasks,logger,n_workers=n_workers,max_in_flight=max_in_flight):
+        refresh_lock(shard_lock)
+        if record is None:
+            logger.info(f"Patient ID {patient_id} is being processed by another process")
+            continue
+        committed.append(patient_id)
+        logger.info(f"Processing complete for patient ID: {patient_id}")
+    log_metrics_summary(logger)
+    return committed
+
+class ShardedStageView(Mapping):
+    def __init__(self,stores,stage,order,mmap=True):
+        """Read-only mapping over the same stage of several shard stores, in the cohort manifest order"""
+        self.stores=stores
+        self.stage_name=stage
+        self.mmap=mmap
+        self._locations={}
+        for store in stores:
+            for patient_id in store.patients(stage):
+                self._locations.setdefault(patient_id,store)
+        position={patient_id:i for i,patient_id in enumerate(order)}
+        self._order=sorted(self._locations,key=lambda patient_id: position.get(patient_id,len(position)))
+
+    def __getitem__(self,patient_id):
+        if patient_id not in self._locations:
+            raise KeyError(patient_id)
+        return self._locations[patient_id].get(self.stage_name,patient_id,mmap=self.mmap)
+
+    def __contains__(self,patient_id):
+        return patient_id in self._locations
+
+    def __iter__(self):
+        return iter(self._order)
+
+    def __len__(self):
+        return len(self._order)
+
+def merge_shards(root,output_store=None,logger=None):
+    """Combines the shard stores into the outputs of a single streaming run
+
+    Returns the SUV volumes and cropped masks by patient (lazy views over the shards, or copies committed to
+    output_store when given), the statistics by patient and the mean SUVs by vertebral level, in manifest order
+    """
+    with open(os.path.join(root,MANIFEST_FILENAME),'r') as file:
+        manifest=json.load(file)
+    stores=[
+        ResultStore(shard_store_path(root,shard_index)) for shard_index in range(manifest['n_shards'])
+        if os.path.isdir(shard_store_path(root,shard_index))
+    ]
+    views={stage:ShardedStageView(stores,stage,manifest['patients']) for stage in (SUV_STAGE,MASK_STAGE,STATISTICS_STAGE)}
+    missing=set(cohort_patients(manifest))-set(views[STATISTICS_STAGE])
+    if missing and logger:
+        logger.warning(f"{len(missing)} patients have no results yet: {sorted(missing)}")
+    if output_store is not None:
+        for stage,view in views.items():
+            for patient_id in view:
+                if not output_store.has(stage,patient_id):
+                    output_store.put(stage,patient_id,view[patient_id])
+        views={stage:output_store.stage(stage) for stage in views}
+    statistics_by_patient,mean_suv_by_vertebral_level_across_patients=collect_streamed_statistics(
+        (patient_id,views[STATISTICS_STAGE][patient_id]) for patient_id in views[STATISTICS_STAGE]
+    )
+    return views[SUV_STAGE],views[MASK_STAGE],statistics_by_patient,mean_suv_by_vertebral_level_across_patients
+
+def _run_shard_process(data_folder,root,shard_index,n_shards,limit,n_workers):
+    """Entry point of a local shard process"""
+    logging.basicConfig(level=config.LOG_LEVEL,format=config.LOG_FORMAT)
+    run_shard(data_folder,root,shard_index,n_shards,logging.getLogger(f"shard{shard_index}"),limit=limit,n_workers=n_workers)
+
+def run_local(data_folder,root,n_shards,logger,limit=None,n_workers=1):
+    """Runs every shard in its own local process, as separate machines would, then merges them"""
+    load_or_create_manifest(root,data_folder,n_shards,limit)
+    processes=[
+        multiprocessing.Process(target=_run_shard_process,args=(data_folder,root,shard_index,n_shards,limit,n_workers))
+        for shard_index in range(n_shards)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    failed=[shard_index for shard_index,process in enumerate(processes) if process.exitcode!=0]
+    if failed:
+        logger.error(f"Shards {failed} exited with an error")
+    return merge_shards(root,logger=logger)
+
+def main(argv=None):
+    """Runs one shard, all shards locally, or the merge step of a sharded cohort run"""
+    parser=argparse.ArgumentParser(description="Sharded cohort runner on a shared filesystem")
+    parser.add_argument("data_folder",nargs="?",default=config.DATA_FOLDER)
+    parser.add_argument("--root",default=config.SHARD_ROOT,help="shared folder for the manifest, locks and shard stores")
+    parser.add_argument("--shards",type=int,required=True)
+    parser.add_argument("--shard",type=int,default=None,help="index of the shard to run on this machine")
+    parser.add_argument("--local",action="store_true",help="run every shard in a local process, then merge")
+    parser.add_argument("--merge",action="store_true",help="merge the shard stores")
+    parser.add_argument("--output",default=None,help="pickle file for the merged statistics")
+    parser.add_argument("--limit",type=int,default=None)
+    parser.add_argument("--workers",type=int,default=None)
+    args=parser.parse_args(argv)
+
+    logging.basicConfig(level=config.LOG_LEVEL,format=config.LOG_FORMAT)
+    logger=logging.getLogger("sharding")
+    if args.shard is not None:
+        run_shard(args.data_folder,args.root,args.shard,args.shards,logger,limit=args.limit,n_workers=args.workers)
+    if args.local:
+        _,_,statistics_by_patient,mean_suv_by_level=run_local(args.data_folder,args.root,args.shards,logger,args.limit,args.workers or 1)
+    elif args.merge:
+        _,_,statistics_by_patient,mean_suv_by_level=merge_shards(args.root,logger=logger)
+    else:
+        return 0
+    logger.info(f"Merged results of {len(statistics_by_patient)} patients")
+    if args.output:
+        save_dictionary_to_file({
+            'statistics_by_patient':statistics_by_patient,
+            'mean_suv_by_vertebral_level_across_patients':mean_suv_by_level
+        },args.output)
+    return 0
+
+if __name__=="__main__":
+    sys.exit(main())
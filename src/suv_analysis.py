@@ -1,22 +1,74 @@
 import numpy as np
+from . import config
+from .instrumentation import instrumented, patient_scope
 
 
+@instrumented("suv_statistics")
+def compute_suv_statistics_for_patient(suv_volume,masked_image,percentiles=None,boxes=None):
+    "Compute count, mean, std, min, max, median and percentiles of SUV for every vertebra in one pass"
+    percentiles=config.SUV_PERCENTILES if percentiles is None else percentiles
+    if boxes is not None:
+        slices=boxes.slices()
+        if slices is None:
+            return {}
+        suv_volume,masked_image=suv_volume[slices],masked_image[slices]
+    labels=np.asarray(masked_image).ravel()
+    labeled=np.flatnonzero(labels)
+    if labeled.size==0:
+        return {}
+    label_values=labels[labeled]
+    suv_values=np.asarray(suv_volume).ravel()[labeled].astype(np.float64)
+    label_index=label_values.astype(np.intp)
+
+    order=np.lexsort((suv_values,label_index))
+    sorted_labels=label_index[order]
+    sorted_values=suv_values[order]
+    present,starts,counts=np.unique(sorted_labels,return_index=True,return_counts=True)
+    ends=starts+counts-1
+
+    sums=np.add.reduceat(sorted_values,starts)
+    means=sums/counts
+    deviations=sorted_values-np.repeat(means,counts)
+    stds=np.sqrt(np.add.reduceat(deviations*deviations,starts)/counts)
+
+    def group_percentile(q):
+        positions=starts+(counts-1)*(q/100.0)
+        lower=np.floor(positions).astype(np.intp)
+        upper=np.minimum(lower+1,ends)
+        fraction=positions-lower
+        return sorted_values[lower]+(sorted_values[upper]-sorted_values[lower])*fraction
+
+    medians=group_percentile(50)
+    percentile_values={q:group_percentile(q) for q in percentiles}
+    label_type=np.asarray(masked_image).dtype.type
+    statistics_by_vertebra={}
+    for i,label in enumerate(present):
+        statistics_by_vertebra[label_type(label)]={
+            'count':int(counts[i]),
+            'mean':float(means[i]),
+            'std':float(stds[i]),
+            'min':float(sorted_values[starts[i]]),
+            'max':float(sorted_values[ends[i]]),
+            'median':float(medians[i]),
+            'percentiles':{q:float(values[i]) for q,values in percentile_values.items()}
+        }
+    return statistics_by_vertebra
+
 def compute_mean_suv_for_patient(suv_volume,masked_image):
     "Compute mean SUV for each vertebra in a single patient"
-    mean_suv_by_vertebra={}
-    unique_labels=np.unique(masked_image)
-    
-    for label in unique_labels:
-        if label==0:
-            continue
-        vertebra_mask=(masked_image==label)
-        vertebra_suv_values=suv_volume[vertebra_mask]
-        
-        if vertebra_suv_values.size>0:
-            mean_suv_by_vertebra[label]=np.mean(vertebra_suv_values)
-        else:
-            mean_suv_by_vertebra[label]=None
-    return mean_suv_by_vertebra
+    statistics_by_vertebra=compute_suv_statistics_for_patient(suv_volume,masked_image,percentiles=())
+    return {label:statistics['mean'] for label,statistics in statistics_by_vertebra.items()}
+
+def compute_suv_statistics_across_patients(suv_volume_dict,masked_images_dict,percentiles=None,boxes_dict=None):
+    "Compute SUV statistics for each vertebra of every patient"
+    statistics_by_patient={}
+    for patient_id,suv_volume in suv_volume_dict.items():
+        with patient_scope(patient_id):
+            statistics_by_patient[patient_id]=compute_suv_statistics_for_patient(
+                suv_volume,masked_images_dict[patient_id],percentiles=percentiles,
+                boxes=boxes_dict.get(patient_id) if boxes_dict is not None else None
+            )
+    return statistics_by_patient
 
 def compute_mean_suv_across_patients(suv_volume_dict,masked_images_dict):
     "Compute mean SUV for each vertebra across all patients"
@@ -25,7 +77,8 @@ def compute_mean_suv_across_patients(suv_volume_dict,masked_images_dict):
     
     for patient_id,suv_volume in suv_volume_dict.items():
         masked_image=masked_images_dict[patient_id]
-        mean_suv_by_vertebra=compute_mean_suv_for_patient(suv_volume,masked_image)
+        with patient_scope(patient_id):
+            mean_suv_by_vertebra=compute_mean_suv_for_patient(suv_volume,masked_image)
         mean_suv_by_vertebra_by_patient[patient_id]=mean_suv_by_vertebra
         
         for label,mean_suv in mean_suv_by_vertebra.items():
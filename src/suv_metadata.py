@@ -0,0 +1,148 @@
+import os
+import logging
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+from . import config
+from .dicom_index import get_series_index
+from .parallel import map_patients
+from .SUVpipeline import SUVProcessor
+
+SECONDS_PER_DAY=24*3600
+TIME_COLUMNS=['injection_time','acquisition_time']
+
+def parse_dicom_times(times):
+    """Converts DICOM TM strings to seconds since midnight for a whole column at once (NaN when missing or malformed)"""
+    times=pd.Series(times,dtype='string').str.strip()
+    parts=times.str.partition('.')
+    whole=parts[0].where(parts[0].str.fullmatch(r'\d{1,6}').fillna(False)).str.zfill(6)
+    fraction=pd.to_numeric(("0."+parts[2].where(parts[2].str.fullmatch(r'\d+').fillna(False),"0")),errors='coerce')
+    seconds=(
+        pd.to_numeric(whole.str[:2],errors='coerce')*3600
+        +pd.to_numeric(whole.str[2:4],errors='coerce')*60
+        +pd.to_numeric(whole.str[4:6],errors='coerce')
+        +fraction
+    )
+    return seconds.to_numpy(dtype=np.float64,na_value=np.nan)
+
+def time_differences(start_seconds,end_seconds):
+    """Vectorized SUVProcessor.calculate_time_difference on seconds since midnight, accounting for day rollover"""
+    difference=np.asarray(end_seconds,dtype=np.float64)-np.asarray(start_seconds,dtype=np.float64)
+    return np.where(difference<0,difference+SECONDS_PER_DAY,difference)
+
+def read_metadata_record(patient_folder,target_description=None):
+    """Reads the SUV fields of the lowest-InstanceNumber PET slice of a patient from the header index, or None"""
+    target_description=config.TARGET_DESCRIPTION_PET if target_description is None else target_description
+    records=[
+        record for record in get_series_index(patient_folder).select(
+            series_description=target_description,dcm_only=True,require_pixels=True,require_position=True
+        )
+        if record['InstanceNumber'] is not None
+    ]
+    if not records:
+        return None
+    first=min(records,key=lambda record:record['InstanceNumber'])
+    return {
+        'patient_weight_g':first['PatientWeight']*1000 if first['PatientWeight'] is not None else np.nan,
+        'injected_dose_bq':first['RadionuclideTotalDose'],
+        'half_life_seconds':first['RadionuclideHalfLife'],
+        'injection_time':first['RadiopharmaceuticalStartTime'],
+        'acquisition_time':first['AcquisitionTime'],
+        'rescale_slope':first['RescaleSlope'] if first['RescaleSlope'] is not None else 1.0,
+        'rescale_intercept':first['RescaleIntercept'] if first['RescaleIntercept'] is not None else 0.0,
+        'units':first['Units'],
+        'n_slices':len(records)
+    }
+
+def compute_decay_columns(table):
+    """Adds time differences, decay constants, decayed doses and SUV factors to a metadata table, vectorized"""
+    table['injection_seconds']=parse_dicom_times(table['injection_time'])
+    table['acquisition_seconds']=parse_dicom_times(table['acquisition_time'])
+    table['time_diff_seconds']=time_differences(table['injection_seconds'],table['acquisition_seconds'])
+    table['decay_constant']=SUVProcessor.calculate_decay_constant(table['half_life_seconds'].to_numpy(dtype=np.float64))
+    table['decayed_dose_bq']=SUVProcessor.calculate_decayed_dose(
+        table['injected_dose_bq'].to_numpy(dtype=np.float64),table['decay_constant'].to_numpy(),table['time_diff_seconds'].to_numpy()
+    )
+    table['suv_factor']=table['patient_weight_g'].to_numpy(dtype=np.float64)/table['decayed_dose_bq'].to_numpy()
+    return table
+
+def build_metadata_table(path_patient,patient_ids,logger=None,target_description=None,n_workers=None):
+    """Builds the columnar SUV metadata table of a cohort, one row per patient with PET files, from indexed headers"""
+    logger=logger if logger is not None else logging.getLogger(__name__)
+    n_workers=config.N_WORKERS if n_workers is None else n_workers
+    tasks=[(patient_id,(os.path.join(path_patient,patient_id),target_description)) for patient_id in patient_ids]
+    rows={}
+    for patient_id,row in map_patients(read_metadata_record,tasks,logger,n_workers=n_workers):
+        if row is None:
+            logger.info(f"No PET DICOM files found for patient {patient_id}")
+            continue
+        rows[patient_id]=row
+    table=pd.DataFrame.from_dict(rows,orient='index',columns=[
+        'patient_weight_g','injected_dose_bq','half_life_seconds','injection_time','acquisition_time',
+        'rescale_slope','rescale_intercept','units','n_slices'
+    ])
+    table.index.name='patient_id'
+    for column in ['patient_weight_g','injected_dose_bq','half_life_seconds','rescale_slope','rescale_intercept']:
+        table[column]=pd.to_numeric(table[column],errors='coerce')
+    return compute_decay_columns(table)
+
+def valid_metadata_rows(table,logger=None):
+    """Keeps the patients whose metadata allows a BQML body-weight SUV, logging the others as errors"""
+    bqml=(table['units']=="BQML").to_numpy()
+    finite=np.isfinite(table['suv_factor'].to_numpy(dtype=np.float64))&(table['suv_factor'].to_numpy(dtype=np.float64)>0)
+    if logger:
+        for patient_id,units in table.loc[~bqml,'units'].items():
+            logger.error(f"Error processing patient {patient_id}: Units are {units}, but 'BQML' is required for SUV calculation")
+        for patient_id in table.index[bqml&~finite]:
+            logger.error(f"Error processing patient {patient_id}: incomplete dose, weight or timing metadata")
+    return table[bqml&finite]
+
+def _time_to_seconds(value):
+    """Converts a datetime from SUVProcessor.parse_time, or a DICOM TM string, to seconds since midnight"""
+    if isinstance(value,datetime):
+        return value.hour*3600+value.minute*60+value.second+value.microsecond/1e6
+    return parse_dicom_times([value])[0]
+
+def _seconds_to_time(seconds):
+    """Converts seconds since midnight to the datetime SUVProcessor.parse_time would return"""
+    return datetime(1900,1,1)+timedelta(seconds=float(seconds))
+
+def metadata_table_to_dict(table):
+    """Converts the metadata table to the per-patient dictionaries of SUVProcessor.extract_metadata plus the decayed dose"""
+    metadata_dict={}
+    for patient_id,row in zip(table.index,table.to_dict('records')):
+        metadata_dict[patient_id]={
+            'patient_weight_g':row['patient_weight_g'],
+            'injected_dose_bq':row['injected_dose_bq'],
+            'half_life_seconds':row['half_life_seconds'],
+            'injection_time':_seconds_to_time(row['injection_seconds']),
+            'acquisition_time':_seconds_to_time(row['acquisition_seconds']),
+            'rescale_slope':row['rescale_slope'],
+            'rescale_intercept':row['rescale_intercept'],
+            'units':row['units'],
+            'decayed_dose_bq':row['decayed_dose_bq']
+        }
+    return metadata_dict
+
+def slice_decay_table(patient_folder,metadata,target_description=None):
+    """Per-slice decay table of a patient's PET series, ordered by slice position
+
+    Each slice gets the dose decayed to its own acquisition time and the matching SUV factor, plus its
+    factor relative to the patient-level SUV factor (1 for the reference slice)
+    """
+    target_description=config.TARGET_DESCRIPTION_PET if target_description is None else target_description
+    records=get_series_index(patient_folder).select(
+        series_description=target_description,dcm_only=True,require_pixels=True,require_position=True
+    )
+    table=pd.DataFrame({
+        'instance_number':[record['InstanceNumber'] for record in records],
+        'z_position':[record['ImagePositionPatient'][2] for record in records],
+        'acquisition_time':[record['AcquisitionTime'] for record in records]
+    }).sort_values('z_position',kind='stable').reset_index(drop=True)
+    table['acquisition_seconds']=parse_dicom_times(table['acquisition_time'])
+    table['time_diff_seconds']=time_differences(_time_to_seconds(metadata['injection_time']),table['acquisition_seconds'])
+    decay_constant=SUVProcessor.calculate_decay_constant(metadata['half_life_seconds'])
+    table['decayed_dose_bq']=SUVProcessor.calculate_decayed_dose(metadata['injected_dose_bq'],decay_constant,table['time_diff_seconds'].to_numpy())
+    table['suv_factor']=metadata['patient_weight_g']/table['decayed_dose_bq']
+    table['relative_factor']=metadata['decayed_dose_bq']/table['decayed_dose_bq']
+    return table
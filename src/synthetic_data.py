@@ -0,0 +1,171 @@
+import os
+import numpy as np
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+from . import config
+from .label_maps import write_label_masks
+
+CT_IMAGE_STORAGE="1.2.840.10008.5.1.4.1.1.2"
+PET_IMAGE_STORAGE="1.2.840.10008.5.1.4.1.1.128"
+F18_HALF_LIFE_SECONDS=6586.2
+
+def _save_dataset(ds,path):
+    """Writes a dataset as a DICOM file with an explicit VR little endian transfer syntax"""
+    try:
+        ds.save_as(path,enforce_file_format=True)
+    except TypeError:
+        ds.is_little_endian=True
+        ds.is_implicit_VR=False
+        ds.save_as(path,write_like_original=False)
+
+def _base_dataset(sop_class_uid,study,series_uid,series_number,series_description,modality):
+    """Creates a dataset with the patient, study and series modules shared by all slices of a series"""
+    file_meta=FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID=sop_class_uid
+    file_meta.MediaStorageSOPInstanceUID=generate_uid()
+    file_meta.TransferSyntaxUID=ExplicitVRLittleEndian
+    ds=Dataset()
+    ds.file_meta=file_meta
+    ds.SOPClassUID=sop_class_uid
+    ds.SOPInstanceUID=file_meta.MediaStorageSOPInstanceUID
+    ds.PatientID=study['patient_id']
+    ds.PatientWeight=study['weight_kg']
+    ds.StudyInstanceUID=study['study_uid']
+    ds.StudyDescription=study['study_description']
+    ds.FrameOfReferenceUID=study['frame_of_reference_uid']
+    ds.SeriesInstanceUID=series_uid
+    ds.SeriesNumber=series_number
+    ds.SeriesDescription=series_description
+    ds.Modality=modality
+    ds.ImageOrientationPatient=[1,0,0,0,1,0]
+    ds.SamplesPerPixel=1
+    ds.PhotometricInterpretation="MONOCHROME2"
+    ds.BitsAllocated=16
+    ds.BitsStored=16
+    ds.HighBit=15
+    return ds
+
+def _spine_centre(shape):
+    """Returns the (row, column) of the synthetic spinal column in a slice"""
+    return int(shape[1]*0.65),shape[2]//2
+
+def make_ct_volume(shape,seed=0):
+    """Builds a body phantom in Hounsfield units with a bony spinal column, in DICOM (z,y,x) order"""
+    rng=np.random.default_rng(seed)
+    z,y,x=shape
+    rows,cols=np.ogrid[:y,:x]
+    body=((rows-y/2)/(0.42*y))**2+((cols-x/2)/(0.45*x))**2<=1
+    spine_row,spine_col=_spine_centre(shape)
+    spine=((rows-spine_row)/(0.06*y))**2+((cols-spine_col)/(0.06*x))**2<=1
+    slice_hu=np.full((y,x),-1000,dtype=np.float32)
+    slice_hu[body]=40
+    slice_hu[spine]=700
+    volume=np.broadcast_to(slice_hu,shape)+rng.normal(0,10,shape).astype(np.float32)
+    return volume.astype(np.float32)
+
+def make_vertebra_labels(shape,vertebrae=None):
+    """Builds a label map with one block per vertebra along the spinal column, in DICOM (z,y,x) order"""
+    vertebrae=config.VERTEBRAE if vertebrae is None else vertebrae
+    labels=np.zeros(shape,dtype=np.uint8)
+    z,y,x=shape
+    rows,cols=np.ogrid[:y,:x]
+    spine_row,spine_col=_spine_centre(shape)
+    spine=((rows-spine_row)/(0.06*y))**2+((cols-spine_col)/(0.06*x))**2<=1
+    block=max(z//(len(vertebrae)+2),1)
+    for label in range(1,len(vertebrae)+1):
+        start=label*block
+        labels[start:start+block-1][:,spine]=label
+    return labels
+
+def write_ct_series(folder,shape=(64,128,128),spacing=(1.0,1.0,1.0),series_number=3,study=None,seed=0):
+    """Writes a synthetic CT series (uint16 with a -1024 rescale intercept) and returns its volume in HU"""
+    os.makedirs(folder,exist_ok=True)
+    volume=make_ct_volume(shape,seed=seed)
+    series_uid=generate_uid()
+    stored=np.clip(np.rint(volume+1024),0,65535).astype(np.uint16)
+    for index in range(shape[0]):
+        ds=_base_dataset(CT_IMAGE_STORAGE,study,series_uid,series_number,"CT WB 1.0",'CT')
+        ds.InstanceNumber=index+1
+        ds.ImagePositionPatient=[-shape[2]*spacing[2]/2,-shape[1]*spacing[1]/2,float(index*spacing[0])]
+        ds.SliceLocation=float(index*spacing[0])
+        ds.SliceThickness=spacing[0]
+        ds.PixelSpacing=[spacing[1],spacing[2]]
+        ds.Rows,ds.Columns=shape[1],shape[2]
+        ds.PixelRepresentation=0
+        ds.RescaleSlope=1
+        ds.RescaleIntercept=-1024
+        ds.PixelData=stored[index].tobytes()
+        _save_dataset(ds,os.path.join(folder,f"CT_{series_number}_{index:04d}.dcm"))
+    return volume
+
+def write_pet_series(folder,ct_shape=(64,128,128),ct_spacing=(1.0,1.0,1.0),pet_spacing=(4.0,4.0,4.0),study=None,
+                     series_description=None,injected_dose_bq=3.7e8,seed=0):
+    """Writes a synthetic BQML PET series covering the CT field of view and returns its activity volume"""
+    os.makedirs(folder,exist_ok=True)
+    rng=np.random.default_rng(seed+1)
+    series_description=config.TARGET_DESCRIPTION_PET if series_description is None else series_description
+    shape=tuple(max(int(round(n*c/p)),1) for n,c,p in zip(ct_shape,ct_spacing,pet_spacing))
+    ct_volume=make_ct_volume(shape,seed=seed)
+    activity=np.where(ct_volume>500,12000.0,np.where(ct_volume>-500,4000.0,0.0))
+    activity=(activity*rng.gamma(20,1/20,shape)).astype(np.float32)
+    series_uid=generate_uid()
+    for index in range(shape[0]):
+        slice_activity=activity[index]
+        slope=max(float(slice_activity.max())/65535,1e-6)
+        ds=_base_dataset(PET_IMAGE_STORAGE,study,series_uid,study['pet_series_number'],series_description,'PT')
+        ds.InstanceNumber=index+1
+        ds.ImagePositionPatient=[-ct_shape[2]*ct_spacing[2]/2,-ct_shape[1]*ct_spacing[1]/2,float(index*pet_spacing[0])]
+        ds.SliceThickness=pet_spacing[0]
+        ds.PixelSpacing=[pet_spacing[1],pet_spacing[2]]
+        ds.Rows,ds.Columns=shape[1],shape[2]
+        ds.PixelRepresentation=0
+        ds.RescaleSlope=f"{slope:.8g}"
+        ds.RescaleIntercept=0
+        ds.Units="BQML"
+        ds.DecayCorrection="START"
+        ds.AcquisitionTime=f"1030{index%60:02d}.000000"
+        radiopharmaceutical=Dataset()
+        radiopharmaceutical.Radiopharmaceutical="Fluorodeoxyglucose"
+        radiopharmaceutical.RadiopharmaceuticalStartTime="093000.00"
+        radiopharmaceutical.RadionuclideTotalDose=injected_dose_bq
+        radiopharmaceutical.RadionuclideHalfLife=F18_HALF_LIFE_SECONDS
+        ds.RadiopharmaceuticalInformationSequence=Sequence([radiopharmaceutical])
+        ds.PixelData=np.clip(np.rint(slice_activity/float(ds.RescaleSlope)),0,65535).astype(np.uint16).tobytes()
+        _save_dataset(ds,os.path.join(folder,f"PT_{index:04d}.dcm"))
+    return activity
+
+def write_vertebra_masks(output_dir,ct_shape=(64,128,128),spacing=(1.0,1.0,1.0),vertebrae=None):
+    """Writes fake TotalSegmentator outputs (one binary vertebrae_<name>.nii.gz per vertebra) for a CT"""
+    vertebrae=config.VERTEBRAE if vertebrae is None else vertebrae
+    return write_label_masks(output_dir,make_vertebra_labels(ct_shape,vertebrae),spacing,vertebrae)
+
+def generate_patient(data_folder,patient_id,ct_shape=(64,128,128),ct_spacing=(1.0,1.0,1.0),pet_spacing=(4.0,4.0,4.0),
+                     segmentation_folder=None,seed=0):
+    """Writes the CT and PET series of one synthetic patient, plus fake vertebra masks if a folder is given"""
+    patient_folder=os.path.join(data_folder,str(patient_id))
+    study={
+        'patient_id':str(patient_id),
+        'weight_kg':70+seed%20,
+        'study_uid':generate_uid(),
+        'study_description':"PET-CT",
+        'frame_of_reference_uid':generate_uid(),
+        'pet_series_number':6
+    }
+    write_ct_series(patient_folder,ct_shape,ct_spacing,series_number=int(config.TARGET_NUMBER),study=study,seed=seed)
+    write_pet_series(patient_folder,ct_shape,ct_spacing,pet_spacing,study=study,seed=seed)
+    paths={'patient_folder':patient_folder}
+    if segmentation_folder is not None:
+        paths['segmentation_folder']=os.path.join(segmentation_folder,str(patient_id))
+        write_vertebra_masks(paths['segmentation_folder'],ct_shape,ct_spacing)
+    return paths
+
+def generate_cohort(data_folder,n_patients=2,ct_shape=(64,128,128),ct_spacing=(1.0,1.0,1.0),pet_spacing=(4.0,4.0,4.0),
+                    segmentation_folder=None,seed=0):
+    """Writes a synthetic cohort with numeric patient folders and returns the paths of each patient"""
+    return {
+        f"{9000000+index:07d}":generate_patient(
+            data_folder,f"{9000000+index:07d}",ct_shape,ct_spacing,pet_spacing,segmentation_folder,seed=seed+index
+        )
+        for index in range(n_patients)
+    }
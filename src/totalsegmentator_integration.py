@@ -1,9 +1,68 @@
-import subprocess
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+from . import config
+from .io_utils import link_dicom_files
+from .instrumentation import instrumented
+from .segmentation_worker import build_totalsegmentator_arguments, segment_with_backend, BACKENDS
 
-def run_totalsegmentator(input_path, output_prefix):
-    """Runs the totalsegmentator command to segment the given input volume"""
-    command=["TotalSegmentator","-i",input_path,"-o",output_prefix]
-    subprocess.run(command,check=True)
+SEGMENTATION_CACHE_VERSION=1
+COMPLETE_MARKER=".complete"
 
+@instrumented("segmentation")
+def run_totalsegmentator(input_path, output_prefix, options=None, roi_subset=None):
+    """Segments the given input volume with the configured backend (the totalsegmentator command by default)"""
+    return segment_with_backend(input_path,output_prefix,options,roi_subset)
 
+def segmentation_cache_key(sop_instance_uids, options=None, roi_subset=None, model="totalsegmentator"):
+    """Hashes the input series' SOP Instance UIDs, the model options, the requested subset and the model into a cache key"""
+    description={
+        'version':SEGMENTATION_CACHE_VERSION,
+        'uids':sorted(sop_instance_uids),
+        'options':build_totalsegmentator_arguments(options)
+    }
+    if roi_subset:
+        description['roi_subset']=sorted(roi_subset)
+    if model!="totalsegmentator":
+        description['model']=model
+    return hashlib.sha256(json.dumps(description).encode()).hexdigest()
 
+def segment_series(records, options=None, cache_dir=None, roi_subset=None):
+    """Segments the series of the given index records, reusing the cached output when the inputs are unchanged
+
+    Inputs are staged with links in a private temporary work directory, so several patients can be
+    segmented at the same time. roi_subset restricts the structures to segment, e.g. ["vertebrae_L1"].
+    Returns the folder holding the segmentation outputs.
+    """
+    if not records:
+        raise FileNotFoundError("No DICOM files found for segmentation")
+    if any(record.get('SOPInstanceUID') is None for record in records):
+        raise ValueError("SOPInstanceUID is required to cache segmentations")
+    options=config.TOTALSEGMENTATOR_OPTIONS if options is None else options
+    cache_dir=cache_dir if cache_dir is not None else os.path.join(config.CACHE_DIR,"segmentations")
+    model=BACKENDS[config.SEGMENTATION_BACKEND].model if config.SEGMENTATION_BACKEND in BACKENDS else config.SEGMENTATION_BACKEND
+    cache_path=os.path.join(cache_dir,segmentation_cache_key([record['SOPInstanceUID'] for record in records],options,roi_subset,model))
+    if os.path.exists(os.path.join(cache_path,COMPLETE_MARKER)):
+        return cache_path
+
+    os.makedirs(cache_dir,exist_ok=True)
+    workdir=tempfile.mkdtemp(prefix="totalsegmentator_",dir=config.SEGMENTATION_WORK_DIR)
+    try:
+        input_path=os.path.join(workdir,"input")
+        output_path=os.path.join(workdir,"output")
+        link_dicom_files(records,input_path)
+        os.makedirs(output_path,exist_ok=True)
+        run_totalsegmentator(input_path,output_path,options,roi_subset)
+        open(os.path.join(output_path,COMPLETE_MARKER),'w').close()
+        if os.path.exists(cache_path) and not os.path.exists(os.path.join(cache_path,COMPLETE_MARKER)):
+            shutil.rmtree(cache_path,ignore_errors=True)
+        try:
+            os.replace(output_path,cache_path)
+        except OSError:
+            if not os.path.exists(os.path.join(cache_path,COMPLETE_MARKER)):
+                raise
+    finally:
+        shutil.rmtree(workdir,ignore_errors=True)
+    return cache_path
@@ -1,17 +1,16 @@
 import numpy as np
-import SimpleITK as sitk
-from .image_processing import custom_transform
+from .orientation import CUSTOM_TRANSFORM_PLAN
+from .volume_assembly import assemble_from_datasets
+from .volume_cache import load_records_volume, records_for_datasets
 
 def transform_data_dict(data_dict,ct_masks_flipped):
     "Applies transformations to the data dictionary, flipping certain entries if specified"
     transformed_dict={}
     
     for key,value in data_dict.items():
-        transformed_first=custom_transform(value[0])
-        transformed_second=custom_transform(value[1])
-        
-        if key in ct_masks_flipped:
-            transformed_first=transformed_first[::-1]
+        ct_plan=CUSTOM_TRANSFORM_PLAN.flipud() if key in ct_masks_flipped else CUSTOM_TRANSFORM_PLAN
+        transformed_first=ct_plan.apply(value[0])
+        transformed_second=CUSTOM_TRANSFORM_PLAN.apply(value[1])
         transformed_dict[key]=[transformed_first,transformed_second]
     return transformed_dict
 
@@ -44,17 +43,16 @@ def transform_and_extract_arrays(ct_masks_dictionary,ct_masks_flipped):
     
     return ct_list_new,masks_multilabel_list
 
+def load_datasets_volume(dicom_datasets,rescale):
+    "Assembles datasets into a float32 volume through the decoded-series cache when they come from indexed files"
+    records=records_for_datasets(dicom_datasets)
+    if records is None:
+        return assemble_from_datasets(dicom_datasets,dtype=np.float32,rescale=rescale)
+    return load_records_volume(records,rescale=rescale)
+
 def extract_pixel_array(dicom_dataset_list):
     "Extracts and applies rescale slope and intercept to pixel arrays"
-    pixel_data_list=[]
-    
-    for ds in dicom_dataset_list:
-        pixel_array=ds.pixel_array.astype(np.float32)
-        if hasattr(ds,'RescaleSlope') and hasattr(ds,'RescaleIntercept'):
-            pixel_array=pixel_array*ds.RescaleSlope+ds.RescaleIntercept
-        pixel_data_list.append(pixel_array)
-    
-    return np.stack(pixel_data_list,axis=0)
+    return load_datasets_volume(dicom_dataset_list,rescale=True)
 
 def compute_spacing_and_origin(first_dataset):
     "Extracts spacing and origin from the first dataset"
@@ -80,17 +78,10 @@ def dicom_to_numpy(dicom_datasets):
         dicom_datasets.sort(key=lambda x:x.InstanceNumber)
     elif hasattr(dicom_datasets[0],'SliceLocation'):
         dicom_datasets.sort(key=lambda x:x.SliceLocation)
-    images=[]
-    
-    for ds in dicom_datasets:
-        img=ds.pixel_array.astype(np.float32)
-        images.append(img)
-    return np.stack(images)
+    return load_datasets_volume(dicom_datasets,rescale=False)
 
 def find_first_nonzero_slice(volume):
     "Finds the first slice in the volume containing non-zero values"
     mid_z=volume.shape[2]//2
-    for x in range(volume.shape[0]):
-        if np.any(volume[x,:,mid_z]!=0):
-            return x
-    return None
+    nonzero_rows=np.flatnonzero(np.any(volume[:,:,mid_z]!=0,axis=1))
+    return int(nonzero_rows[0]) if nonzero_rows.size else None
@@ -1,22 +1,22 @@
 
-import matplotlib as plt
+import matplotlib.pyplot as plt
 import seaborn as sns
 
-def visualize_slice_sag(ct_list_new, masks_multilabel_list, slice_index=None):
-    """Visualizes a single slice of the CT data and its corresponding mask"""
+def visualize_slice_sag(ct_list_new, masks_multilabel_list, slice_index=None, patient_index=1):
+    """Visualizes a single slice of the CT data and its corresponding mask, see qa_rendering for whole cohorts"""
     if slice_index is None:
-        slice_index=int(ct_list_new[0].shape[1]//2)
-    plt.imshow(ct_list_new[1][:, :, slice_index], aspect=5, cmap="gray")
-    plt.imshow(masks_multilabel_list[1][:, :, slice_index], aspect=5, cmap="gray", alpha=0.3)
+        slice_index=int(ct_list_new[patient_index].shape[2]//2)
+    plt.imshow(ct_list_new[patient_index][:, :, slice_index], aspect=5, cmap="gray")
+    plt.imshow(masks_multilabel_list[patient_index][:, :, slice_index], aspect=5, cmap="gray", alpha=0.3)
     plt.show()
     
     
-def visualize_slice_coronal(ct_list_new, masks_multilabel_list, slice_index=None):
+def visualize_slice_coronal(ct_list_new, masks_multilabel_list, slice_index=None, patient_index=1):
     """Visualizes a single coronal slice of the CT data and its corresponding mask, using 2/3 of the dimension by default"""
     if slice_index is None:
-        slice_index=int(ct_list_new[0].shape[1]*2/3)
-    plt.imshow(ct_list_new[1][:, slice_index, :], aspect=5, cmap="gray")
-    plt.imshow(masks_multilabel_list[1][:, slice_index, :], aspect=5, cmap="gray", alpha=0.3)
+        slice_index=int(ct_list_new[patient_index].shape[1]*2/3)
+    plt.imshow(ct_list_new[patient_index][:, slice_index, :], aspect=5, cmap="gray")
+    plt.imshow(masks_multilabel_list[patient_index][:, slice_index, :], aspect=5, cmap="gray", alpha=0.3)
     plt.show()
 
 
@@ -39,3 +39,24 @@ def plot_mean_suv_by_spinal_level(mean_suv_by_vertebral_level_across_patients,la
     plt.title('Mean SUV by Spinal Level Across Patients',fontsize=16)
     plt.tight_layout()
     plt.show()
+
+def plot_suv_aggregates_by_spinal_level(aggregates,label_to_spinal_level,stratum="all",palette="Blues"):
+    "Plot mean SUV by spinal level from streaming cohort aggregates, with boxes drawn from their quantile sketches"
+    levels=aggregates.levels.get(stratum,{})
+    stats=[
+        levels[label].boxplot_stats(label_to_spinal_level.get(label,f'Level {label}'))
+        for label in sorted(levels)
+    ]
+    sns.set(style="whitegrid")
+    palette_colors=sns.color_palette(palette,len(stats))
+    fig,ax=plt.subplots(figsize=(5,4))
+    boxes=ax.bxp(stats,showfliers=False,patch_artist=True)
+    for patch,color in zip(boxes['boxes'],palette_colors):
+        patch.set_facecolor(color)
+    ax.tick_params(labelsize=12)
+    ax.set_xlabel('Spinal Level',fontsize=14)
+    ax.set_ylabel('Mean SUV',fontsize=14)
+    title='Mean SUV by Spinal Level Across Patients'
+    ax.set_title(title if stratum=="all" else f"{title}\n{stratum}",fontsize=16)
+    plt.tight_layout()
+    plt.show()
@@ -0,0 +1,98 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from . import config
+from .instrumentation import instrumented
+
+PIXEL_DATA_TAG=b'\xe0\x7f\x10\x00'
+NATIVE_HEADER_LENGTHS={
+    '1.2.840.10008.1.2':8,
+    '1.2.840.10008.1.2.1':12
+}
+
+def _decode_threads(n_threads):
+    """Returns the number of decoding threads to use"""
+    n_threads=config.DECODE_THREADS if n_threads is None else n_threads
+    return n_threads or min(32,os.cpu_count() or 1)
+
+def _native_dtype(record):
+    """Returns the little-endian dtype of an uncompressed single-frame record, or None if unsupported"""
+    bits=record.get('BitsAllocated')
+    if bits not in (8,16,32):
+        return None
+    if (record.get('SamplesPerPixel') or 1)!=1 or (record.get('NumberOfFrames') or 1)!=1:
+        return None
+    if record.get('PixelRepresentation')==1 and record.get('BitsStored')!=bits:
+        return None
+    kind='i' if record.get('PixelRepresentation')==1 else 'u'
+    return np.dtype(f"<{kind}{bits//8}")
+
+def read_native_slice(record):
+    """Reads the pixels of a native (uncompressed) file at its PixelData offset, or returns None if not possible"""
+    header_length=NATIVE_HEADER_LENGTHS.get(record.get('TransferSyntaxUID'))
+    dtype=_native_dtype(record)
+    offset=record.get('PixelDataOffset')
+    if header_length is None or dtype is None or offset is None:
+        return None
+    count=record['Rows']*record['Columns']
+    with open(record['path'],'rb') as fp:
+        fp.seek(offset)
+        header=fp.read(header_length)
+        if header[:4]!=PIXEL_DATA_TAG:
+            return None
+        data=fp.read(count*dtype.itemsize)
+    if len(data)!=count*dtype.itemsize:
+        return None
+    return np.frombuffer(data,dtype=dtype).reshape(record['Rows'],record['Columns'])
+
+def _rescale_in_place(slice_array,slope,intercept):
+    """Applies rescale slope and intercept to a slice without temporaries"""
+    if slope is None or intercept is None:
+        return
+    if slope!=1:
+        slice_array*=slope
+    if intercept!=0:
+        slice_array+=intercept
+
+def _fill_volume(volume,decode_slice,n_threads):
+    """Decodes every slice straight into its z-position of the preallocated volume"""
+    n_threads=_decode_threads(n_threads)
+    if n_threads<=1 or volume.shape[0]<=1:
+        for z in range(volume.shape[0]):
+            decode_slice(z)
+        return volume
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        list(executor.map(decode_slice,range(volume.shape[0])))
+    return volume
+
+@instrumented("pixel_decode")
+def assemble_volume(records,dtype=np.float32,rescale=True,n_threads=None):
+    """Assembles a volume from index records in the given slice order, reading native pixel data directly"""
+    first=records[0]
+    volume=np.empty((len(records),first['Rows'],first['Columns']),dtype=dtype)
+
+    def decode_slice(z):
+        record=records[z]
+        pixels=read_native_slice(record)
+        if pixels is None:
+            import pydicom
+            pixels=pydicom.dcmread(record['path'],force=True).pixel_array
+        volume[z]=pixels
+        if rescale:
+            _rescale_in_place(volume[z],record.get('RescaleSlope'),record.get('RescaleIntercept'))
+
+    return _fill_volume(volume,decode_slice,n_threads)
+
+@instrumented("pixel_decode")
+def assemble_from_datasets(dicom_datasets,dtype=np.float32,rescale=True,n_threads=None):
+    """Assembles a volume from pydicom datasets in the given slice order"""
+    first=dicom_datasets[0]
+    volume=np.empty((len(dicom_datasets),int(first.Rows),int(first.Columns)),dtype=dtype)
+
+    def decode_slice(z):
+        ds=dicom_datasets[z]
+        volume[z]=ds.pixel_array
+        if rescale and hasattr(ds,'RescaleSlope') and hasattr(ds,'RescaleIntercept'):
+            _rescale_in_place(volume[z],float(ds.RescaleSlope),float(ds.RescaleIntercept))
+
+    return _fill_volume(volume,decode_slice,n_threads)
@@ -0,0 +1,187 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+from . import config
+from .dicom_index import get_series_index
+from .volume_assembly import assemble_volume, _rescale_in_place
+
+VOLUME_CACHE_VERSION=1
+
+def series_fingerprint(records):
+    """Hashes the names, sizes and modification times of a series' files, to detect changes behind a series UID"""
+    payload=json.dumps(sorted((record['filename'],record['mtime'],record['size']) for record in records))
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+class VolumeCache:
+    def __init__(self,max_bytes=None,disk_dir=None):
+        """Decoded series keyed by SeriesInstanceUID, in an in-memory LRU tier with a byte budget and an optional disk tier
+
+        Each entry is the unrescaled float32 volume of every slice of the series, with the SOP Instance UIDs of
+        its rows and their geometry; the disk tier keeps it as a raw .npy file next to a JSON description.
+        """
+        self.max_bytes=config.VOLUME_CACHE_BYTES if max_bytes is None else max_bytes
+        self.disk_dir=disk_dir
+        self.entries=OrderedDict()
+        self.bytes=0
+        self.hits=0
+        self.misses=0
+        self._lock=threading.Lock()
+
+    def _disk_paths(self,series_uid):
+        """Returns the array and description paths of a series in the disk tier"""
+        key=hashlib.sha1(series_uid.encode()).hexdigest()
+        return os.path.join(self.disk_dir,key+".npy"),os.path.join(self.disk_dir,key+".json")
+
+    def _load_from_disk(self,series_uid,fingerprint):
+        """Opens a series of the disk tier as a read-only memory map, or returns None if missing or stale"""
+        if not self.disk_dir:
+            return None
+        array_path,description_path=self._disk_paths(series_uid)
+        try:
+            with open(description_path,'r') as file:
+                description=json.load(file)
+            if description.get('version')!=VOLUME_CACHE_VERSION or description.get('fingerprint')!=fingerprint:
+                return None
+            return np.load(array_path,mmap_mode='r',allow_pickle=False),description
+        except (OSError,ValueError):
+            return None
+
+    def _save_to_disk(self,series_uid,volume,description):
+        """Atomically writes a series to the disk tier, array first so that a description always has its array"""
+        os.makedirs(self.disk_dir,exist_ok=True)
+        array_path,description_path=self._disk_paths(series_uid)
+        suffix=f".{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(array_path+suffix,'wb') as file:
+            np.save(file,volume,allow_pickle=False)
+        os.replace(array_path+suffix,array_path)
+        with open(description_path+suffix,'w') as file:
+            json.dump(description,file)
+        os.replace(description_path+suffix,description_path)
+
+    def _remember(self,series_uid,volume,description):
+        """Adds an entry to the memory tier, evicting the least recently used ones beyond the byte budget"""
+        if volume.nbytes>self.max_bytes:
+            return
+        previous=self.entries.pop(series_uid,None)
+        if previous is not None:
+            self.bytes-=previous[0].nbytes
+        self.entries[series_uid]=(volume,description)
+        self.bytes+=volume.nbytes
+        while self.bytes>self.max_bytes:
+            _,(evicted,_)=self.entries.popitem(last=False)
+            self.bytes-=evicted.nbytes
+
+    def get(self,series_uid,fingerprint):
+        """Returns the (volume,description) of a series from the memory or disk tier, or None"""
+        with self._lock:
+            entry=self.entries.get(series_uid)
+            if entry is not None and entry[1]['fingerprint']==fingerprint:
+                self.entries.move_to_end(series_uid)
+                self.hits+=1
+                return entry
+            entry=self._load_from_disk(series_uid,fingerprint)
+            if entry is not None:
+                self._remember(series_uid,*entry)
+                self.hits+=1
+                return entry
+            self.misses+=1
+            return None
+
+    def put(self,series_uid,volume,description):
+        """Stores a decoded series in both tiers"""
+        with self._lock:
+            self._remember(series_uid,volume,description)
+        if self.disk_dir:
+            self._save_to_disk(series_uid,volume,description)
+
+    def clear(self):
+        """Empties the memory tier"""
+        with self._lock:
+            self.entries.clear()
+            self.bytes=0
+
+_cache=None
+
+def get_volume_cache():
+    """Returns the volume cache of this process, configured by config.VOLUME_CACHE_BYTES and config.VOLUME_CACHE_DIR"""
+    global _cache
+    if _cache is None or _cache.max_bytes!=config.VOLUME_CACHE_BYTES or _cache.disk_dir!=config.VOLUME_CACHE_DIR:
+        _cache=VolumeCache(config.VOLUME_CACHE_BYTES,config.VOLUME_CACHE_DIR)
+    return _cache
+
+def clear_volume_cache():
+    """Empties the memory tier of this process's volume cache, if it has one; the disk tier is kept"""
+    if _cache is not None:
+        _cache.clear()
+
+def _decode_series(series_uid,series_records,cache):
+    """Returns the cached entry of a series, decoding and storing all its slices on a miss"""
+    fingerprint=series_fingerprint(series_records)
+    entry=cache.get(series_uid,fingerprint)
+    if entry is not None:
+        return entry
+    volume=assemble_volume(series_records,dtype=np.float32,rescale=False)
+    description={
+        'version':VOLUME_CACHE_VERSION,
+        'series_uid':series_uid,
+        'fingerprint':fingerprint,
+        'uids':[record['SOPInstanceUID'] for record in series_records],
+        'positions':[record['ImagePositionPatient'] for record in series_records],
+        'pixel_spacing':series_records[0]['PixelSpacing'],
+        'slice_thickness':series_records[0]['SliceThickness']
+    }
+    cache.put(series_uid,volume,description)
+    return volume,description
+
+def load_records_volume(records,rescale=False,cache=None):
+    """Returns the float32 volume of the given index records in their order, decoding each series at most once
+
+    The records' whole series is decoded into the cache the first time, so later loaders of the same series,
+    whatever their slice order or rescaling, only copy from it. Records without the UIDs needed as keys, or
+    series whose slices differ in size, are decoded directly.
+    """
+    cache=get_volume_cache() if cache is None else cache
+    series_uids={record.get('SeriesInstanceUID') for record in records}
+    if not cache.max_bytes and not cache.disk_dir or None in series_uids or any(record.get('SOPInstanceUID') is None for record in records):
+        return assemble_volume(records,dtype=np.float32,rescale=rescale)
+    index=get_series_index(os.path.dirname(records[0]['path']))
+    rows={}
+    for series_uid in series_uids:
+        series_records=[
+            record for record in index.select(require_pixels=True)
+            if record.get('SeriesInstanceUID')==series_uid and record.get('SOPInstanceUID') is not None
+        ]
+        if len({(record['Rows'],record['Columns']) for record in series_records})!=1:
+            return assemble_volume(records,dtype=np.float32,rescale=rescale)
+        volume,description=_decode_series(series_uid,series_records,cache)
+        rows.update({uid:(volume,row) for row,uid in enumerate(description['uids'])})
+    if any(record['SOPInstanceUID'] not in rows for record in records):
+        return assemble_volume(records,dtype=np.float32,rescale=rescale)
+    first_volume=rows[records[0]['SOPInstanceUID']][0]
+    out=np.empty((len(records),)+first_volume.shape[1:],dtype=np.float32)
+    for z,record in enumerate(records):
+        volume,row=rows[record['SOPInstanceUID']]
+        out[z]=volume[row]
+        if rescale:
+            _rescale_in_place(out[z],record.get('RescaleSlope'),record.get('RescaleIntercept'))
+    return out
+
+def records_for_datasets(dicom_datasets):
+    """Returns the index records of pydicom datasets read from files, or None when one cannot be matched"""
+    records=[]
+    by_folder={}
+    for ds in dicom_datasets:
+        path=getattr(ds,'filename',None)
+        if not isinstance(path,str):
+            return None
+        folder=os.path.dirname(os.path.abspath(path))
+        if folder not in by_folder:
+            by_folder[folder]={record['filename']:record for record in get_series_index(folder).records}
+        record=by_folder[folder].get(os.path.basename(path))
+        if record is None or not record['readable'] or record.get('SOPInstanceUID')!=str(ds.get('SOPInstanceUID')):
+            return None
+        records.append(record)
+    return records